@@ -38,6 +38,9 @@ deep_learning_folder = [
     "train",
     "predict",
     "call_variants",
+    "call_chunk",
+    "model_server",
+    "export_model",
 ]
 
 REPO_NAME = "clairs"
@@ -68,6 +71,7 @@ data_preprocess_folder = [
     'clair3_somatic_calling',
     'cal_metrics_in_af_range',
     'concat_files',
+    'schedule_chunks',
 ]
 
 
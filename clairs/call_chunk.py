@@ -0,0 +1,290 @@
+# BSD 3-Clause License
+#
+# Copyright 2023 The University of Hong Kong, Department of Computer Science
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import sys
+import json
+import fcntl
+import shlex
+import hashlib
+import logging
+import torch
+
+from time import time
+from argparse import ArgumentParser, SUPPRESS
+from subprocess import PIPE, Popen
+
+from clairs.predict import predict, predict_parser
+from clairs.inference import inference_model_from, load_model, INFERENCE_PRECISIONS, BACKENDS
+from shared.utils import str2bool, log_error
+
+logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+main_entry = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'clairs.py')
+
+
+def bam_fn_from(bam_fn, ctg_name):
+    """
+    Phased BAMs are split by contig, a non-existing bam path is treated as the prefix of the contig BAMs.
+    """
+    if os.path.exists(bam_fn):
+        return bam_fn
+    return bam_fn + ctg_name + '.bam'
+
+
+def phased_vcf_fn_from(phased_vcf_fn, ctg_name):
+    """
+    Phased VCFs are split by contig in the same way as the phased BAMs.
+    """
+    if os.path.exists(phased_vcf_fn):
+        return phased_vcf_fn
+    return phased_vcf_fn + ctg_name + '.vcf.gz'
+
+
+def tensor_command_from(args, candidates_bed_regions, ctg_name):
+    submodule = 'create_pair_tensor_pileup' if args.pileup else 'create_pair_tensor'
+    normal_bam_fn = args.normal_bam_fn if args.pileup else bam_fn_from(args.normal_bam_fn, ctg_name)
+    tumor_bam_fn = args.tumor_bam_fn if args.pileup else bam_fn_from(args.tumor_bam_fn, ctg_name)
+    command = args.pypy + ' ' + main_entry + ' ' + submodule
+    command += ' --normal_bam_fn ' + normal_bam_fn
+    command += ' --tumor_bam_fn ' + tumor_bam_fn
+    command += ' --ref_fn ' + args.ref_fn
+    command += ' --ctg_name ' + ctg_name
+    command += ' --samtools ' + args.samtools
+    command += ' --candidates_bed_regions ' + candidates_bed_regions
+    command += ' --tensor_can_fn PIPE'
+    command += ' --platform ' + args.platform
+    command += ' --binary_tensor True'
+    command += ' --pileup_engine ' + args.pileup_engine
+    if not args.pileup and args.normal_phased_vcf_fn is not None:
+        command += ' --normal_phased_vcf_fn ' + phased_vcf_fn_from(args.normal_phased_vcf_fn, ctg_name)
+    if not args.pileup and args.tumor_phased_vcf_fn is not None:
+        command += ' --tumor_phased_vcf_fn ' + phased_vcf_fn_from(args.tumor_phased_vcf_fn, ctg_name)
+    return command
+
+
+def predict_args_from(args, call_fn, ctg_name):
+    predict_args = ['--tensor_fn', 'PIPE',
+                    '--call_fn', call_fn,
+                    '--chkpnt_fn', args.chkpnt_fn,
+                    '--use_gpu', str(args.use_gpu),
+                    '--platform', args.platform,
+                    '--ctg_name', ctg_name,
+                    '--enable_indel_calling', str(args.enable_indel_calling),
+                    '--binary_tensor', 'True',
+                    '--inference_precision', args.inference_precision,
+                    '--channels_last', str(args.channels_last),
+                    '--backend', args.backend]
+    predict_args += ['--pileup'] if args.pileup else []
+    predict_args += ['--model_server_fn', args.model_server_fn, '--model_name', args.model_name] \
+        if args.model_server_fn is not None else []
+    predict_args += ['--show_ref'] if args.show_ref else []
+    predict_args += ['--show_germline'] if args.show_germline else []
+    return predict_parser().parse_args(predict_args)
+
+
+def queue_dir_from(args):
+    """
+    Directory of the chunk locks and done markers shared by the workers of a candidates list.
+    """
+    candidates_list_fn = os.path.abspath(args.candidates_list_fn)
+    return os.path.join(os.path.dirname(candidates_list_fn), 'queue',
+                        args.call_fn_prefix + os.path.basename(candidates_list_fn))
+
+
+def fingerprint_from(args):
+    options = dict((key, value) for key, value in vars(args).items() if key not in ('worker_id', 'worker_num'))
+    return hashlib.md5(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_chunk_done(done_fn, fingerprint, candidates_bed_regions, call_fn):
+    """
+    A chunk is done if it was called with the same options after its candidates were extracted.
+    """
+    if not os.path.exists(done_fn) or not os.path.exists(call_fn):
+        return False
+    if os.path.getmtime(done_fn) < os.path.getmtime(candidates_bed_regions):
+        return False
+    with open(done_fn) as done_file:
+        return done_file.read().strip() == fingerprint
+
+
+def call_chunk(args):
+    """
+    Stream the tensors of each candidate chunk from a tensor creation process into the predictor, the model is loaded
+    once per worker and the tensors are never written to disk. The workers share the chunks of the candidates list as
+    a queue: a worker takes the next chunk that is neither done nor locked by another worker, so a worker that is done
+    with its short chunks goes on with the remaining ones. The locks are released when a worker exits, and the chunks
+    left by a failed worker are taken again when the step is resumed.
+    """
+    candidates_list = [line.rstrip() for line in open(args.candidates_list_fn) if line.rstrip()]
+    queue_dir = queue_dir_from(args)
+    os.makedirs(queue_dir, exist_ok=True)
+    fingerprint = fingerprint_from(args)
+
+    device = 'cuda' if args.use_gpu and torch.cuda.is_available() else 'cpu'
+    model = None
+    chunk_count = 0
+    start_time = time()
+    for candidates_bed_regions in candidates_list:
+        chunk_fn = os.path.basename(candidates_bed_regions)
+        ctg_name = chunk_fn.rsplit('.', 1)[0]
+        call_fn = os.path.join(args.output_dir, args.call_fn_prefix + chunk_fn + '.vcf')
+        done_fn = os.path.join(queue_dir, chunk_fn + '.done')
+        if is_chunk_done(done_fn, fingerprint, candidates_bed_regions, call_fn):
+            continue
+
+        with open(os.path.join(queue_dir, chunk_fn + '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # taken by another worker
+                continue
+            if is_chunk_done(done_fn, fingerprint, candidates_bed_regions, call_fn):
+                continue
+
+            if model is None and args.model_server_fn is None:
+                model = load_model(args.chkpnt_fn, backend=args.backend, device=device)
+                # the reduced precision model is checked against fp32 once per worker
+                model = inference_model_from(model, args, device=device)
+
+            tensor_process = Popen(shlex.split(tensor_command_from(args, candidates_bed_regions, ctg_name)),
+                                   stdout=PIPE, stderr=sys.stderr, bufsize=8388608)
+            predict(predict_args_from(args, call_fn, ctg_name), model=model, tensor_fp=tensor_process.stdout)
+            tensor_process.stdout.close()
+            if tensor_process.wait() != 0:
+                sys.exit(log_error("[ERROR] Tensor creation failed for {}".format(chunk_fn)))
+            with open(done_fn, 'w') as done_file:
+                done_file.write(fingerprint + '\n')
+            chunk_count += 1
+
+    logging.info("[INFO] Worker {}/{} processed {} chunks, time elapsed: {:.1f}s".format(
+        args.worker_id, args.worker_num, chunk_count, time() - start_time))
+
+
+def main():
+    parser = ArgumentParser(description="Create tensors and call variants for candidate chunks in a single streaming pass")
+
+    parser.add_argument('--platform', type=str, default="ont",
+                        help="Select the sequencing platform of the input. Default: %(default)s")
+
+    parser.add_argument('--normal_bam_fn', type=str, default=None,
+                        help="Sorted normal BAM file input, or the prefix of the phased contig BAMs, required")
+
+    parser.add_argument('--tumor_bam_fn', type=str, default=None,
+                        help="Sorted tumor BAM file input, or the prefix of the phased contig BAMs, required")
+
+    parser.add_argument('--ref_fn', type=str, default=None,
+                        help="Reference fasta file input, required")
+
+    parser.add_argument('--chkpnt_fn', type=str, default=None,
+                        help="Input a trained model for calling, required")
+
+    parser.add_argument('--candidates_list_fn', type=str, default=None,
+                        help="File listing the candidate chunk files to process, required")
+
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help="VCF output directory, required")
+
+    parser.add_argument('--call_fn_prefix', type=str, default="p_",
+                        help="Prefix of the output VCF of each chunk. Default: %(default)s")
+
+    parser.add_argument('--samtools', type=str, default="samtools",
+                        help="Absolute path to the 'samtools', samtools version >= 1.10 is required. Default: %(default)s")
+
+    parser.add_argument('--pypy', type=str, default="pypy3",
+                        help="Absolute path of pypy3, pypy3 >= 3.6 is required. Default: %(default)s")
+
+    parser.add_argument('--show_ref', action='store_true',
+                        help="Show reference calls (0/0) in VCF file")
+
+    parser.add_argument('--show_germline', action='store_true',
+                        help="Show germline calls in VCF file")
+
+    parser.add_argument('--enable_indel_calling', type=str2bool, default=0,
+                        help="EXPERIMENTAL: Call Indel variants, default: disabled")
+
+    # options for internal process control
+    ## Use GPU for calling
+    parser.add_argument('--use_gpu', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## In pileup mode or not (full alignment mode), default: False
+    parser.add_argument('--pileup', action='store_true',
+                        help=SUPPRESS)
+
+    ## The 1-based worker index
+    parser.add_argument('--worker_id', type=int, default=1,
+                        help=SUPPRESS)
+
+    ## The total number of workers sharing the candidates list
+    parser.add_argument('--worker_num', type=int, default=1,
+                        help=SUPPRESS)
+
+    ## Pileup engine of tensor creation, samtools or pysam
+    parser.add_argument('--pileup_engine', type=str, default="samtools",
+                        help=SUPPRESS)
+
+    ## Assign the normal read haplotypes from the phased VCF (or the prefix of the contig VCFs) instead of the HP tags
+    parser.add_argument('--normal_phased_vcf_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Assign the tumor read haplotypes from the phased VCF (or the prefix of the contig VCFs) instead of the HP tags
+    parser.add_argument('--tumor_phased_vcf_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Run inference on a running model server instead of loading --chkpnt_fn
+    parser.add_argument('--model_server_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## The model name in the model server
+    parser.add_argument('--model_name', type=str, default="pileup",
+                        help=SUPPRESS)
+
+    ## Inference precision: fp32, bf16, fp16 or int8, see clairs/inference.py
+    parser.add_argument('--inference_precision', type=str, default='fp32', choices=INFERENCE_PRECISIONS,
+                        help=SUPPRESS)
+
+    ## Run the full-alignment model with channels-last input and weights
+    parser.add_argument('--channels_last', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Inference backend of --chkpnt_fn: torch, torchscript or onnxruntime, see clairs/export_model.py
+    parser.add_argument('--backend', type=str, default="torch", choices=BACKENDS,
+                        help=SUPPRESS)
+
+    args = parser.parse_args()
+
+    call_chunk(args)
+
+
+if __name__ == "__main__":
+    main()
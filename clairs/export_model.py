@@ -0,0 +1,155 @@
+# BSD 3-Clause License
+#
+# Copyright 2023 The University of Hong Kong, Department of Computer Science
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import logging
+import torch
+
+from argparse import ArgumentParser, SUPPRESS
+
+from clairs.model import BiGRU
+from clairs.inference import load_model, onnxruntime, EXPORTED_MODEL_SUFFIX
+from shared.utils import log_error, log_warning
+import shared.param as param
+
+logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+EXPORT_FORMATS = {'torchscript': 'torchscript', 'onnx': 'onnxruntime'}
+# number of random tensors to compare the exported model with the pickled model on
+CHECK_BATCH_SIZE = 16
+MAX_PROBABILITY_DIFF = 1e-4
+
+
+def example_input_from(model, platform, batch_size=2):
+    """
+    Return an input of the model, the shape is taken from the model layers except the full-alignment depth.
+    """
+    if isinstance(model, BiGRU):
+        no_of_positions = model.fc1.in_features // (model.lstm_hidden_size2 * 2)
+        return torch.rand(batch_size, no_of_positions, model.dim)
+    in_channels = model.conv1.conv[0].in_channels
+    return torch.rand(batch_size, in_channels, param.matrix_depth_dict[platform], param.no_of_positions)
+
+
+def export_torchscript(model, example_input, output_fn):
+    script_model = torch.jit.freeze(torch.jit.trace(model, example_input))
+    torch.jit.save(script_model, output_fn)
+
+
+def export_onnx(model, example_input, output_fn, opset):
+    torch.onnx.export(model,
+                      example_input,
+                      output_fn,
+                      input_names=['input'],
+                      output_names=['output'],
+                      dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+                      opset_version=opset)
+
+
+def check_exported_model(output_fn, backend, check_input, probabilities):
+    """
+    Compare the probabilities of the exported model with the pickled model, return False if they differ.
+    """
+    if backend == 'onnxruntime' and onnxruntime is None:
+        logging.info(log_warning("[WARNING] onnxruntime is not available, skip checking {}".format(output_fn)))
+        return True
+    exported_model = load_model(output_fn, backend=backend)
+    with torch.no_grad():
+        exported_probabilities = torch.softmax(exported_model(check_input).float(), dim=1)
+    max_probability_diff = float((exported_probabilities - probabilities).abs().max())
+    if max_probability_diff > MAX_PROBABILITY_DIFF:
+        logging.info(log_error("[ERROR] {} differs from the pickled model, maximum probability difference {:.6f}".format(
+            output_fn, max_probability_diff)))
+        return False
+    logging.info("[INFO] Exported {}, maximum probability difference {:.6f}".format(output_fn, max_probability_diff))
+    return True
+
+
+def export_model(args):
+    torch.manual_seed(0)
+    model = torch.load(args.chkpnt_fn, map_location=torch.device('cpu'))
+    model.eval()
+
+    output_prefix = args.output_prefix if args.output_prefix is not None else os.path.splitext(args.chkpnt_fn)[0]
+    output_dir = os.path.dirname(os.path.abspath(output_prefix))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    example_input = example_input_from(model, args.platform)
+    check_input = example_input_from(model, args.platform, batch_size=CHECK_BATCH_SIZE)
+    with torch.no_grad():
+        probabilities = torch.softmax(model(check_input), dim=1)
+
+    export_formats = list(EXPORT_FORMATS.keys()) if args.format == 'all' else [args.format]
+    is_all_checked = True
+    for export_format in export_formats:
+        backend = EXPORT_FORMATS[export_format]
+        output_fn = output_prefix + EXPORTED_MODEL_SUFFIX[backend]
+        if export_format == 'torchscript':
+            export_torchscript(model, example_input, output_fn)
+        else:
+            export_onnx(model, example_input, output_fn, opset=args.opset)
+        is_all_checked = check_exported_model(output_fn, backend, check_input, probabilities) and is_all_checked
+
+    if not is_all_checked:
+        sys.exit(1)
+
+
+def main():
+    parser = ArgumentParser(description="Export a trained model to TorchScript and ONNX for the predict backends")
+
+    parser.add_argument('--platform', type=str, default="ont",
+                        help="Select the sequencing platform of the model. Default: %(default)s")
+
+    parser.add_argument('--chkpnt_fn', type=str, default=None,
+                        help="Input a trained pileup or full-alignment model, required")
+
+    parser.add_argument('--output_prefix', type=str, default=None,
+                        help="Output prefix of the exported models, the model is written to <prefix>.pt (TorchScript) "
+                             "and <prefix>.onnx (ONNX). Default: --chkpnt_fn without its extension")
+
+    parser.add_argument('--format', type=str, default="all", choices=['torchscript', 'onnx', 'all'],
+                        help="Export format. Default: %(default)s")
+
+    # options for internal process control
+    ## ONNX opset version
+    parser.add_argument('--opset', type=int, default=17,
+                        help=SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.chkpnt_fn is None:
+        sys.exit(log_error("[ERROR] --chkpnt_fn is required"))
+
+    export_model(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Inference of the calling models, shared by predict, call_chunk and the model server.
+
+The full-alignment tensors stay in the integer dtype they are stored in (int8 binary tensors and bins) up to the
+first convolution: they are copied to the device and transposed to (batch, channel, depth, width) as they are, and
+InferenceModel scales them by 1/100 into float32, optionally laid out channels-last, right before running the ResNet.
+The model is run in one of the inference precisions:
+
+    fp32    the trained model as is
+    bf16    CPU/GPU autocast to bfloat16
+    fp16    CPU/GPU autocast to float16
+    int8    dynamic int8 quantization of the Linear and GRU layers (CPU only), the convolutions stay in fp32
+
+A reduced precision model is compared with the fp32 model on the first batch it predicts, it falls back to fp32 if
+the probabilities differ by more than MAX_PROBABILITY_DIFF or the predicted classes agree on less than
+MIN_CLASS_AGREEMENT of the candidates. tests/test_inference.py runs the same comparison for each precision on the
+test batch in tests/data.
+
+Besides the pickled torch models, the models exported by export_model are loaded with the backends:
+
+    torch           the pickled model, the only backend supporting the reduced precisions and channels-last
+    torchscript     the traced and frozen TorchScript model (.pt)
+    onnxruntime     the ONNX model (.onnx) run by ONNX Runtime, onnxruntime is optional
+"""
+
+import sys
+import copy
+import logging
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from shared.utils import log_error, log_warning
+import shared.param as param
+
+INFERENCE_PRECISIONS = ['fp32', 'bf16', 'fp16', 'int8']
+AUTOCAST_DTYPE = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+BACKENDS = ['torch', 'torchscript', 'onnxruntime']
+# suffix of the exported model of a backend, next to the pickled model by default
+EXPORTED_MODEL_SUFFIX = {'torchscript': '.pt', 'onnxruntime': '.onnx'}
+
+MAX_PROBABILITY_DIFF = 0.05
+MIN_CLASS_AGREEMENT = 0.99
+
+
+def input_matrix_from(input_tensor, pileup, device='cpu'):
+    """
+    Return the model input of a batch of tensors on the device. Full-alignment tensors of (batch, depth, width, channel)
+    keep their dtype and are only transposed to (batch, channel, depth, width), see scaled_input_from.
+    """
+    input_matrix = torch.from_numpy(np.ascontiguousarray(input_tensor)).to(device)
+    if pileup:
+        return input_matrix.float()
+    input_matrix = input_matrix.permute(0, 3, 1, 2)
+    if input_matrix.shape[1] != param.channel_size:
+        input_matrix = input_matrix[:, :param.channel_size, :, :]
+    return input_matrix
+
+
+def scaled_input_from(input_matrix, scale=True, channels_last=False):
+    """
+    Scale a full-alignment input of any dtype by 1/100 into float32, the input of the first convolution.
+    """
+    if not scale:
+        return input_matrix
+    # the permuted view already has the channels-last strides of the input tensor, kept as is unless channels_last
+    memory_format = torch.channels_last if channels_last else torch.preserve_format
+    return input_matrix.to(dtype=torch.float32, memory_format=memory_format) / 100.0
+
+
+def compare_probabilities(probabilities, fp32_probabilities, min_margin=0.0):
+    """
+    Return the maximum probability difference and the class agreement with the fp32 probabilities, the agreement is
+    taken over the candidates whose two most probable fp32 classes are at least min_margin apart.
+    """
+    max_probability_diff = float((probabilities - fp32_probabilities).abs().max())
+    top_probabilities = fp32_probabilities.topk(2, dim=1).values
+    is_decisive = (top_probabilities[:, 0] - top_probabilities[:, 1]) >= min_margin
+    is_agreed = probabilities.argmax(dim=1) == fp32_probabilities.argmax(dim=1)
+    class_agreement = float(is_agreed[is_decisive].float().mean()) if bool(is_decisive.any()) else 1.0
+    return max_probability_diff, class_agreement
+
+
+class OnnxRuntimeModel(nn.Module):
+    """
+    An ONNX Runtime session of an exported model, called with and returning torch tensors like the model it was
+    exported from.
+    """
+    def __init__(self, onnx_fn, device='cpu'):
+        super().__init__()
+        if onnxruntime is None:
+            sys.exit(log_error("[ERROR] onnxruntime is required for the onnxruntime backend"))
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = torch.get_num_threads()
+        providers = ['CPUExecutionProvider']
+        if device == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(onnx_fn, sess_options=session_options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, input_matrix):
+        input_tensor = np.ascontiguousarray(input_matrix.cpu().numpy(), dtype=np.float32)
+        output = self.session.run(None, {self.input_name: input_tensor})[0]
+        return torch.from_numpy(output).to(input_matrix.device)
+
+
+def load_model(chkpnt_fn, backend='torch', device='cpu'):
+    """
+    Load a pickled torch model, or a model exported by export_model for the torchscript and onnxruntime backends.
+    """
+    if backend == 'torchscript':
+        return torch.jit.load(chkpnt_fn, map_location=torch.device(device))
+    if backend == 'onnxruntime':
+        return OnnxRuntimeModel(chkpnt_fn, device=device)
+    return torch.load(chkpnt_fn, map_location=torch.device(device))
+
+
+class InferenceModel(object):
+    def __init__(self, model, precision='fp32', device='cpu', channels_last=False):
+        if precision not in INFERENCE_PRECISIONS:
+            raise ValueError("Unsupported inference precision {}".format(precision))
+        # the exported models are run as they were exported
+        is_exported_model = isinstance(model, (torch.jit.ScriptModule, OnnxRuntimeModel))
+        if is_exported_model and precision != 'fp32':
+            logging.info(log_warning("[WARNING] {} inference is only supported by the torch backend, use fp32 "
+                                     "instead".format(precision)))
+            precision = 'fp32'
+        if precision == 'int8' and device != 'cpu':
+            logging.info(log_warning("[WARNING] int8 inference is only supported on CPU, use fp32 instead"))
+            precision = 'fp32'
+        model.eval()
+        # the pileup BiGRU has no convolutions
+        self.channels_last = channels_last and not is_exported_model and any(
+            isinstance(module, nn.Conv2d) for module in model.modules())
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.fp32_model = model
+        self.model = model
+        self.precision = precision
+        self.device = device
+        self.softmax = nn.Softmax(dim=1)
+        if precision == 'int8':
+            self.model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear, nn.GRU},
+                                                                dtype=torch.qint8)
+        self.is_checked = precision == 'fp32'
+
+    def forward(self, model, input_matrix, precision, scale=False):
+        with torch.no_grad():
+            input_matrix = scaled_input_from(input_matrix, scale=scale, channels_last=self.channels_last)
+            if precision in AUTOCAST_DTYPE:
+                with torch.autocast(device_type=self.device, dtype=AUTOCAST_DTYPE[precision]):
+                    output = model(input_matrix)
+            else:
+                output = model(input_matrix)
+            return self.softmax(output.float())
+
+    def check_precision(self, input_matrix, scale=False):
+        """
+        Compare the probabilities of the reduced precision model with the fp32 model on a batch, and use the fp32
+        model from now on if they differ.
+        """
+        probabilities = self.forward(self.model, input_matrix, self.precision, scale=scale)
+        fp32_probabilities = self.forward(self.fp32_model, input_matrix, 'fp32', scale=scale)
+        max_probability_diff, class_agreement = compare_probabilities(probabilities, fp32_probabilities)
+        self.is_checked = True
+        if max_probability_diff > MAX_PROBABILITY_DIFF or class_agreement < MIN_CLASS_AGREEMENT:
+            logging.info(log_warning(
+                "[WARNING] {} inference differs from fp32 on {} candidates, maximum probability difference {:.4f}, "
+                "class agreement {:.4f}, use fp32 instead".format(self.precision, len(input_matrix),
+                                                                 max_probability_diff, class_agreement)))
+            self.model, self.precision = self.fp32_model, 'fp32'
+            return fp32_probabilities
+        logging.info("[INFO] {} inference checked against fp32 on {} candidates, maximum probability difference "
+                     "{:.4f}, class agreement {:.4f}".format(self.precision, len(input_matrix), max_probability_diff,
+                                                              class_agreement))
+        if self.model is not self.fp32_model:
+            self.fp32_model = None
+        return probabilities
+
+    def predict(self, input_matrix, scale=False):
+        """
+        Return the softmax probabilities of a batch of model inputs as a numpy array, scale the full-alignment inputs
+        of input_matrix_from.
+        """
+        if not self.is_checked:
+            probabilities = self.check_precision(input_matrix, scale=scale)
+        else:
+            probabilities = self.forward(self.model, input_matrix, self.precision, scale=scale)
+        return probabilities.cpu().numpy()
+
+
+def inference_model_from(model, args, device='cpu'):
+    """
+    Wrap a loaded model for inference with the precision options of args, a wrapped model is returned as is.
+    """
+    if isinstance(model, InferenceModel):
+        return model
+    return InferenceModel(model=model,
+                          precision=args.inference_precision,
+                          device=device,
+                          channels_last=args.channels_last)
@@ -0,0 +1,158 @@
+"""
+Memory-mapped training bin format, an alternative to the PyTables bins of create_bin.
+
+A bin is a directory holding each column in its own uncompressed file, so that training reads a chunk of rows as a
+slice of a memory map without any decompression:
+
+    input_matrix.raw        rows x tensor_shape cells of the tensor dtype (int8 full-alignment, int16 pileup)
+    label.raw               rows x label_size float32
+    proportion.raw          rows x 1 float32
+    position.txt            one row per line
+    normal_alt_info.txt     one row per line
+    tumor_alt_info.txt      one row per line
+    index.json              format version, rows, dtypes and shapes, written last once the bin is complete
+
+The rows are appended in blocks, the chunk of chunk_id starts at row chunk_id * chunk_size. MemmapBin exposes the
+columns under `root` as PyTables does, so that the training code reads both formats the same way.
+"""
+
+import os
+import json
+
+import numpy as np
+
+MEMMAP_BIN_VERSION = 1
+INDEX_FN = 'index.json'
+RAW_SUFFIX = '.raw'
+TEXT_SUFFIX = '.txt'
+
+TENSOR_DTYPE_RANGE = {'int8': (-128, 127), 'int16': (-32768, 32767)}
+ARRAY_COLUMNS = ('input_matrix', 'label', 'proportion')
+TEXT_COLUMNS = ('position', 'normal_alt_info', 'tumor_alt_info')
+
+
+def is_memmap_bin(bin_fn):
+    return os.path.isdir(bin_fn) and os.path.exists(os.path.join(bin_fn, INDEX_FN))
+
+
+class MemmapBinWriter(object):
+    def __init__(self, bin_fn, tensor_shape, label_size, tensor_dtype='int8'):
+        self.bin_fn = bin_fn
+        self.tensor_shape = list(tensor_shape)
+        self.label_size = label_size
+        self.tensor_dtype = tensor_dtype
+        self.dtype_dict = {'input_matrix': tensor_dtype, 'label': 'float32', 'proportion': 'float32'}
+        self.shape_dict = {'input_matrix': self.tensor_shape, 'label': [label_size], 'proportion': [1]}
+        self.rows = 0
+        if not os.path.exists(bin_fn):
+            os.makedirs(bin_fn)
+        # a rewritten bin is incomplete until its index is written again
+        if os.path.exists(os.path.join(bin_fn, INDEX_FN)):
+            os.remove(os.path.join(bin_fn, INDEX_FN))
+        self.file_dict = {}
+        for column in ARRAY_COLUMNS:
+            self.file_dict[column] = open(os.path.join(bin_fn, column + RAW_SUFFIX), 'wb')
+        for column in TEXT_COLUMNS:
+            self.file_dict[column] = open(os.path.join(bin_fn, column + TEXT_SUFFIX), 'w')
+
+    def append(self, input_matrix, label, position, normal_alt_info, tumor_alt_info, proportion):
+        """
+        Append a block of rows, input_matrix is clipped to the range of the tensor dtype.
+        """
+        input_matrix = np.asarray(input_matrix)
+        if input_matrix.dtype != np.dtype(self.tensor_dtype):
+            min_value, max_value = TENSOR_DTYPE_RANGE[self.tensor_dtype]
+            input_matrix = np.clip(input_matrix, min_value, max_value)
+        row_dict = {
+            'input_matrix': input_matrix.reshape([-1] + self.tensor_shape),
+            'label': np.asarray(label).reshape(-1, self.label_size),
+            'proportion': np.asarray(proportion).reshape(-1, 1),
+        }
+        for column in ARRAY_COLUMNS:
+            row_dict[column].astype('<' + np.dtype(self.dtype_dict[column]).str[1:], copy=False).tofile(
+                self.file_dict[column])
+        for column, rows in zip(TEXT_COLUMNS, (position, normal_alt_info, tumor_alt_info)):
+            rows = [row.decode() if isinstance(row, bytes) else str(row) for row in np.asarray(rows).reshape(-1)]
+            self.file_dict[column].write(''.join(row.rstrip('\n') + '\n' for row in rows))
+        self.rows += len(row_dict['input_matrix'])
+
+    def close(self):
+        for f in self.file_dict.values():
+            f.close()
+        index = {
+            'version': MEMMAP_BIN_VERSION,
+            'rows': self.rows,
+            'dtype': self.dtype_dict,
+            'shape': self.shape_dict,
+        }
+        index_fn = os.path.join(self.bin_fn, INDEX_FN)
+        with open(index_fn + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(index_fn + '.tmp', index_fn)
+
+
+class TextColumn(object):
+    """
+    A text column read on first access, sliced as a (rows, 1) bytes array like the PyTables string arrays.
+    """
+
+    def __init__(self, text_fn, rows):
+        self.text_fn = text_fn
+        self.rows = rows
+        self.values = None
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, item):
+        if self.values is None:
+            with open(self.text_fn, 'rb') as f:
+                values = [row.rstrip(b'\n') for _, row in zip(range(self.rows), f)]
+            self.values = np.array(values, dtype=np.bytes_).reshape(-1, 1) if len(values) else np.empty((0, 1), 'S1')
+        return self.values[item]
+
+
+class MemmapBinRoot(object):
+    pass
+
+
+class MemmapBin(object):
+    def __init__(self, bin_fn):
+        with open(os.path.join(bin_fn, INDEX_FN)) as f:
+            index = json.load(f)
+        if index['version'] != MEMMAP_BIN_VERSION:
+            raise ValueError("Unsupported memory-mapped bin version {} in {}".format(index['version'], bin_fn))
+        self.bin_fn = bin_fn
+        self.rows = index['rows']
+        self.root = MemmapBinRoot()
+        for column in ARRAY_COLUMNS:
+            shape = tuple([self.rows] + index['shape'][column])
+            dtype = '<' + np.dtype(index['dtype'][column]).str[1:]
+            column_fn = os.path.join(bin_fn, column + RAW_SUFFIX)
+            # np.memmap cannot map an empty file
+            array = np.memmap(column_fn, dtype=dtype, mode='r', shape=shape) if self.rows else np.empty(shape, dtype)
+            setattr(self.root, column, array)
+        for column in TEXT_COLUMNS:
+            setattr(self.root, column, TextColumn(os.path.join(bin_fn, column + TEXT_SUFFIX), self.rows))
+
+    def close(self):
+        # the maps are released once the slices still referring to them are gone
+        self.root = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_bin(bin_fn):
+    """
+    Open a training bin of either format for reading.
+    """
+    if is_memmap_bin(bin_fn):
+        return MemmapBin(bin_fn)
+    # pytables is only needed for the pytables bins
+    import tables
+    tables.set_blosc_max_threads(512)
+    return tables.open_file(bin_fn, 'r')
@@ -0,0 +1,292 @@
+# BSD 3-Clause License
+#
+# Copyright 2023 The University of Hong Kong, Department of Computer Science
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import sys
+import queue
+import signal
+import socket
+import struct
+import logging
+import socketserver
+import numpy as np
+import torch
+
+from time import time
+from argparse import ArgumentParser, SUPPRESS
+from threading import Thread, Event
+
+from shared.utils import str2bool, log_error
+from clairs.inference import inference_model_from, load_model, INFERENCE_PRECISIONS, BACKENDS
+import shared.param as param
+
+logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+# model name and the number of dimensions of the input tensor, followed by the dimensions
+REQUEST_HEADER = struct.Struct('<16sB')
+# number of rows and classes of the returned probabilities
+RESPONSE_HEADER = struct.Struct('<II')
+
+MODEL_NAMES = ['pileup', 'full_alignment', 'indel_pileup', 'indel_full_alignment']
+
+
+def recv_exact(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+class ModelServerClient(object):
+    """
+    Send input tensors to a running model server and receive the softmax probabilities, used by predict in place of
+    a locally loaded model.
+    """
+    def __init__(self, socket_fn, model_name):
+        self.model_name = model_name
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(socket_fn)
+        except (IOError, OSError):
+            sys.exit(log_error("[ERROR] Cannot connect to the model server {}".format(socket_fn)))
+
+    def predict(self, input_tensor):
+        input_tensor = np.ascontiguousarray(input_tensor, dtype='<f4')
+        header = REQUEST_HEADER.pack(self.model_name.encode(), input_tensor.ndim)
+        header += struct.pack('<%dI' % input_tensor.ndim, *input_tensor.shape)
+        self.socket.sendall(header)
+        self.socket.sendall(input_tensor.tobytes())
+        response = recv_exact(self.socket, RESPONSE_HEADER.size)
+        if response is None:
+            sys.exit(log_error("[ERROR] Model server closed the connection, model {}".format(self.model_name)))
+        rows, classes = RESPONSE_HEADER.unpack(response)
+        prediction = recv_exact(self.socket, rows * classes * 4)
+        if prediction is None:
+            sys.exit(log_error("[ERROR] Model server closed the connection, model {}".format(self.model_name)))
+        return np.frombuffer(prediction, dtype='<f4').reshape(rows, classes)
+
+    def close(self):
+        try:
+            self.socket.close()
+        except:
+            pass
+
+
+class BatchedModel(object):
+    """
+    Collect the requests of one model from all connections and run them in dynamic batches, a batch is run once it
+    reaches max_batch_size rows or when no more requests arrive within batch_timeout seconds.
+    """
+    def __init__(self, model, device, max_batch_size, batch_timeout):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.request_queue = queue.Queue()
+        Thread(target=self.run, daemon=True).start()
+
+    def predict(self, input_tensor):
+        request = [input_tensor, Event(), None]
+        self.request_queue.put(request)
+        request[1].wait()
+        if isinstance(request[2], Exception):
+            raise request[2]
+        return request[2]
+
+    def batch_requests(self):
+        requests = [self.request_queue.get()]
+        batch_size = len(requests[0][0])
+        deadline = time() + self.batch_timeout
+        while batch_size < self.max_batch_size:
+            remaining_time = deadline - time()
+            if remaining_time <= 0:
+                break
+            try:
+                request = self.request_queue.get(timeout=remaining_time)
+            except queue.Empty:
+                break
+            requests.append(request)
+            batch_size += len(request[0])
+        return requests
+
+    def run(self):
+        while True:
+            requests = self.batch_requests()
+            # requests of different tensor shapes could not be stacked into one batch
+            requests_by_shape = {}
+            for request in requests:
+                requests_by_shape.setdefault(request[0].shape[1:], []).append(request)
+            for shape_requests in requests_by_shape.values():
+                try:
+                    input_matrix = torch.from_numpy(np.concatenate([request[0] for request in shape_requests]))
+                    input_matrix = input_matrix.to(self.device)
+                    if self.model.channels_last:
+                        input_matrix = input_matrix.contiguous(memory_format=torch.channels_last)
+                    prediction = self.model.predict(input_matrix)
+                    offset = 0
+                    for request in shape_requests:
+                        request[2] = prediction[offset: offset + len(request[0])]
+                        offset += len(request[0])
+                except Exception as e:
+                    for request in shape_requests:
+                        request[2] = e
+                for request in shape_requests:
+                    request[1].set()
+
+
+class ModelRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        models = self.server.models
+        while True:
+            header = recv_exact(self.request, REQUEST_HEADER.size)
+            if header is None:
+                return
+            model_name, ndim = REQUEST_HEADER.unpack(header)
+            model_name = model_name.rstrip(b'\0').decode()
+            # the client may close the connection within a request, e.g. when predict is killed
+            shape = recv_exact(self.request, 4 * ndim)
+            if shape is None:
+                return
+            shape = struct.unpack('<%dI' % ndim, shape)
+            input_tensor = recv_exact(self.request, int(np.prod(shape)) * 4)
+            if input_tensor is None:
+                return
+            input_tensor = np.frombuffer(input_tensor, dtype='<f4').reshape(shape)
+            if model_name not in models:
+                logging.info(log_error("[ERROR] Model {} is not loaded in the model server".format(model_name)))
+                return
+            prediction = np.ascontiguousarray(models[model_name].predict(input_tensor), dtype='<f4')
+            self.request.sendall(RESPONSE_HEADER.pack(*prediction.shape))
+            self.request.sendall(prediction.tobytes())
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def model_server(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    use_gpu = args.use_gpu
+    if use_gpu and not torch.cuda.is_available():
+        print("[WARNING] --use_gpu is enabled, but cuda is not found")
+        use_gpu = False
+    device = 'cuda' if use_gpu else 'cpu'
+
+    max_batch_size = args.max_batch_size if args.max_batch_size is not None else param.predictBatchSize * args.threads
+    models = {}
+    for model_name in MODEL_NAMES:
+        chkpnt_fn = getattr(args, model_name + '_model_path')
+        if chkpnt_fn is None:
+            continue
+        model = load_model(chkpnt_fn, backend=args.backend, device=device)
+        model = inference_model_from(model, args, device=device)
+        models[model_name] = BatchedModel(model=model,
+                                          device=device,
+                                          max_batch_size=max_batch_size,
+                                          batch_timeout=args.batch_timeout / 1000.0)
+    if len(models) == 0:
+        sys.exit(log_error("[ERROR] No model provided for the model server"))
+
+    if os.path.exists(args.socket_fn):
+        os.remove(args.socket_fn)
+    # the socket file is created only after all models are loaded, callers wait for it to show up
+    server = ModelServer(args.socket_fn, ModelRequestHandler)
+    server.models = models
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info("[INFO] Model server started with models: {}".format(', '.join(models.keys())))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket_fn):
+            os.remove(args.socket_fn)
+
+
+def main():
+    parser = ArgumentParser(description="Serve the calling models to predict processes over a Unix socket")
+
+    parser.add_argument('--socket_fn', type=str, default=None,
+                        help="Unix socket file to listen on, required")
+
+    parser.add_argument('--pileup_model_path', type=str, default=None,
+                        help="Pileup model to serve")
+
+    parser.add_argument('--full_alignment_model_path', type=str, default=None,
+                        help="Full-alignment model to serve")
+
+    parser.add_argument('--indel_pileup_model_path', type=str, default=None,
+                        help="Indel pileup model to serve")
+
+    parser.add_argument('--indel_full_alignment_model_path', type=str, default=None,
+                        help="Indel full-alignment model to serve")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of torch threads used for inference. Default: %(default)s")
+
+    # options for internal process control
+    ## Use GPU for calling
+    parser.add_argument('--use_gpu', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Maximum number of rows in a dynamic batch, default: predictBatchSize x threads
+    parser.add_argument('--max_batch_size', type=int, default=None,
+                        help=SUPPRESS)
+
+    ## Time in milliseconds to wait for more requests before running a partial batch
+    parser.add_argument('--batch_timeout', type=float, default=5,
+                        help=SUPPRESS)
+
+    ## Inference precision: fp32, bf16, fp16 or int8, see clairs/inference.py
+    parser.add_argument('--inference_precision', type=str, default='fp32', choices=INFERENCE_PRECISIONS,
+                        help=SUPPRESS)
+
+    ## Run the full-alignment models with channels-last input and weights
+    parser.add_argument('--channels_last', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Inference backend of the models: torch, torchscript or onnxruntime, see clairs/export_model.py
+    parser.add_argument('--backend', type=str, default="torch", choices=BACKENDS,
+                        help=SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.socket_fn is None:
+        sys.exit(log_error("[ERROR] --socket_fn is required"))
+
+    model_server(args)
+
+
+if __name__ == "__main__":
+    main()
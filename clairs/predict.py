@@ -42,8 +42,11 @@ from sys import stderr
 from subprocess import PIPE, run, Popen
 
 from clairs.call_variants import output_vcf_from_probability, OutputConfig
+from clairs.inference import input_matrix_from, scaled_input_from, inference_model_from, load_model, \
+    INFERENCE_PRECISIONS, BACKENDS
 from shared.utils import IUPAC_base_to_ACGT_base_dict as BASE2ACGT, BASIC_BASES, str2bool, file_path_from, log_error, \
     log_warning, subprocess_popen, TensorStdout
+from shared.tensor_io import binary_tensor_generator_from, is_binary_tensor_file, NUMPY_DTYPE
 import shared.param as param
 
 
@@ -95,10 +98,19 @@ def print_output_message(
 
 
 def tensor_generator_from(tensor_file_path, batch_size, pileup=False, min_rescale_cov=None, phase_tumor=False,
-                          platform='ont'):
+                          platform='ont', binary_tensor=False, tensor_fp=None):
     float_type = 'float32'
 
+    if tensor_fp is not None:
+        # tensors streamed from a tensor creation process, see clairs/call_chunk.py
+        tensor_file_path = "PIPE"
     if tensor_file_path != "PIPE":
+        binary_tensor = is_binary_tensor_file(tensor_file_path)
+    if binary_tensor:
+        fo = binary_tensor_generator_from(tensor_file_path, tensor_fp=tensor_fp)
+    elif tensor_fp is not None:
+        fo = tensor_fp
+    elif tensor_file_path != "PIPE":
         f = subprocess_popen(shlex.split("{} -fdc {}".format(param.zstd, tensor_file_path)))
         fo = f.stdout
     else:
@@ -115,41 +127,13 @@ def tensor_generator_from(tensor_file_path, batch_size, pileup=False, min_rescal
 
     def item_from(row):
         contig, coord, seq, normal_tensor, normal_alt_info, tumor_tensor, tumor_alt_info, variant_type = row.split("\t")
-        normal_matrix = [float(item) for item in normal_tensor.split()]
-        tumor_matrix = [float(item) for item in tumor_tensor.split()]
 
         if pileup:
-            apply_normalize = False
-            if min_rescale_cov is not None:
-                normal_coverage = float(normal_alt_info.split('-')[0])
-                tumor_coverage = float(tumor_alt_info.split('-')[0])
-                normal_rescale = float(min_rescale_cov) / normal_coverage if normal_coverage > min_rescale_cov else None
-                tumor_rescale = float(min_rescale_cov) / tumor_coverage if tumor_coverage > min_rescale_cov else None
-
-            channel_size = param.pileup_channel_size
-            tumor_channel_size = param.tumor_channel_size
-            tensor = []
-            for idx in range(param.no_of_positions):
-                if apply_normalize:
-
-                    tensor += [float(item) / normal_coverage for item in
-                               normal_matrix[idx * channel_size: (idx + 1) * channel_size]]
-                    tensor += [float(item) / tumor_coverage for item in
-                               tumor_matrix[idx * channel_size: (idx + 1) * channel_size]]
-                else:
-                    if normal_rescale is not None:
-                        tensor += [item * normal_rescale for item in
-                                   normal_matrix[idx * channel_size: (idx + 1) * channel_size]]
-                    else:
-                        tensor += normal_matrix[idx * channel_size: (idx + 1) * channel_size]
-
-                    if tumor_rescale is not None:
-                        tensor += [item * tumor_rescale for item in
-                                   tumor_matrix[idx * tumor_channel_size: (idx + 1) * tumor_channel_size]]
-                    else:
-                        tensor += tumor_matrix[idx * tumor_channel_size: (idx + 1) * tumor_channel_size]
-
+            # parsed for the whole batch in pileup_tensors_from
+            tensor = (normal_tensor, tumor_tensor)
         else:
+            normal_matrix = [float(item) for item in normal_tensor.split()]
+            tumor_matrix = [float(item) for item in tumor_tensor.split()]
             normal_depth = len(normal_matrix) // tensor_shape[1] // tensor_shape[2]
             tumor_depth = len(tumor_matrix) // tensor_shape[1] // tensor_shape[2]
             tensor_depth = normal_depth + tumor_depth
@@ -161,13 +145,70 @@ def tensor_generator_from(tensor_file_path, batch_size, pileup=False, min_rescal
             center_zero_padding = [0] * center_padding_depth * tensor_shape[1] * tensor_shape[2]
             suffix_zero_padding = [0] * suffix_padding_depth * tensor_shape[1] * tensor_shape[2]
             tensor = prefix_zero_padding + normal_matrix + center_zero_padding + tumor_matrix + suffix_zero_padding
-        tensor = np.array(tensor, dtype=np.dtype(float_type))
+            tensor = np.array(tensor, dtype=np.dtype(float_type))
 
         pos = contig + ":" + coord + ":" + seq
         return tensor, pos, seq, normal_alt_info, tumor_alt_info, variant_type
 
-    for batch in batches_from(fo, item_from=item_from, batch_size=batch_size):
-        tensors = np.empty(([batch_size, prod_tensor_shape]), dtype=np.dtype(float_type))
+    def binary_item_from(record):
+        contig, coord, seq, normal_alt_info, tumor_alt_info, variant_type, dtype, buffer, normal_offset, normal_shape, \
+            tumor_offset, tumor_shape = record
+        normal_matrix = np.frombuffer(buffer, dtype=NUMPY_DTYPE[dtype], count=normal_shape[0] * normal_shape[1],
+                                      offset=normal_offset).reshape(normal_shape)
+        tumor_matrix = np.frombuffer(buffer, dtype=NUMPY_DTYPE[dtype], count=tumor_shape[0] * tumor_shape[1],
+                                     offset=tumor_offset).reshape(tumor_shape)
+
+        if pileup:
+            # stacked for the whole batch in pileup_tensors_from
+            tensor = (normal_matrix, tumor_matrix)
+        else:
+            # only the read rows, scattered into the zero padded batch array in scatter_full_alignment_rows
+            tensor = (normal_matrix.reshape([normal_shape[0]] + tensor_shape[1:]),
+                      tumor_matrix.reshape([tumor_shape[0]] + tensor_shape[1:]))
+
+        pos = contig + ":" + str(coord) + ":" + seq
+        return tensor, pos, seq, normal_alt_info, tumor_alt_info, variant_type
+
+    def rescale_factors_from(alt_info_list):
+        coverage = np.array([float(alt_info.split('-')[0]) for alt_info in alt_info_list])
+        rescale = float(min_rescale_cov) / np.maximum(coverage, 1.0)
+        return np.where(coverage > min_rescale_cov, rescale, 1.0)[:, np.newaxis, np.newaxis]
+
+    def pileup_tensors_from(normal_tensors, tumor_tensors, normal_alt_info_list, tumor_alt_info_list):
+        """
+        Assemble a batch of pileup tensors with array operations: (batch, position, channel) normal and tumor arrays
+        are rescaled by the per-candidate coverage factor and concatenated along the channel axis. Rescaling is done
+        in float64 as in the per-element implementation.
+        """
+        batch_shape = [len(normal_tensors), param.no_of_positions, -1]
+        if binary_tensor:
+            normal_matrix = np.stack(normal_tensors).astype(np.float64).reshape(batch_shape)
+            tumor_matrix = np.stack(tumor_tensors).astype(np.float64).reshape(batch_shape)
+        else:
+            normal_matrix = np.fromstring(' '.join(normal_tensors), dtype=np.float64, sep=' ').reshape(batch_shape)
+            tumor_matrix = np.fromstring(' '.join(tumor_tensors), dtype=np.float64, sep=' ').reshape(batch_shape)
+        if min_rescale_cov is not None:
+            normal_matrix *= rescale_factors_from(normal_alt_info_list)
+            tumor_matrix *= rescale_factors_from(tumor_alt_info_list)
+        return np.concatenate((normal_matrix, tumor_matrix), axis=2).astype(float_type)
+
+    def scatter_full_alignment_rows(tensor, normal_matrix, tumor_matrix):
+        normal_depth, tumor_depth = len(normal_matrix), len(tumor_matrix)
+        padding_depth = tensor_shape[0] - normal_depth - tumor_depth - param.center_padding_depth
+        prefix_padding_depth = int(padding_depth / 2)
+        tumor_start = prefix_padding_depth + normal_depth + param.center_padding_depth
+        tensor[prefix_padding_depth: prefix_padding_depth + normal_depth] = normal_matrix
+        tensor[tumor_start: tumor_start + tumor_depth] = tumor_matrix
+
+    is_binary_full_alignment = binary_tensor and not pileup
+    for batch in batches_from(fo, item_from=binary_item_from if binary_tensor else item_from, batch_size=batch_size):
+        if is_binary_full_alignment:
+            # kept in the tensor dtype, scaled to float in the model input, see clairs/inference.py
+            tensors = None
+        elif not pileup:
+            tensors = np.empty(([batch_size, prod_tensor_shape]), dtype=np.dtype(float_type))
+        normal_tensors = []
+        tumor_tensors = []
         positions = []
         normal_alt_info_list = []
         tumor_alt_info_list = []
@@ -175,14 +216,21 @@ def tensor_generator_from(tensor_file_path, batch_size, pileup=False, min_rescal
         for tensor, pos, seq, normal_alt_info, tumor_alt_info, variant_type in batch:
             if seq[param.flankingBaseNum] not in "ACGT":
                 continue
-            tensors[len(positions)] = tensor
+            if pileup:
+                normal_tensors.append(tensor[0])
+                tumor_tensors.append(tensor[1])
+            elif is_binary_full_alignment:
+                if tensors is None:
+                    tensors = np.zeros(([batch_size] + tensor_shape), dtype=tensor[0].dtype)
+                scatter_full_alignment_rows(tensors[len(positions)], *tensor)
+            else:
+                tensors[len(positions)] = tensor
             positions.append(pos)
             normal_alt_info_list.append(normal_alt_info)
             tumor_alt_info_list.append(tumor_alt_info)
             variant_type_list.append(variant_type)
 
         current_batch_size = len(positions)
-        X = np.reshape(tensors, ([batch_size] + tensor_shape))
 
         if processed_tensors > 0 and processed_tensors % 20000 == 0:
             print("Processed %d tensors" % processed_tensors, file=sys.stderr)
@@ -191,12 +239,13 @@ def tensor_generator_from(tensor_file_path, batch_size, pileup=False, min_rescal
 
         if current_batch_size <= 0:
             continue
-        yield X[:current_batch_size], positions[:current_batch_size], normal_alt_info_list[
-                                                                      :current_batch_size], tumor_alt_info_list[
-                                                                                            :current_batch_size], variant_type_list[
-                                                                                                                  :current_batch_size]
+        if pileup:
+            X = pileup_tensors_from(normal_tensors, tumor_tensors, normal_alt_info_list, tumor_alt_info_list)
+        else:
+            X = np.reshape(tensors, ([batch_size] + tensor_shape))
+        yield X[:current_batch_size], positions, normal_alt_info_list, tumor_alt_info_list, variant_type_list
 
-    if tensor_file_path != "PIPE":
+    if tensor_file_path != "PIPE" and not binary_tensor:
         fo.close()
         f.wait()
 
@@ -350,7 +399,11 @@ def DataGenerator(dataset, num_epoch, batch_size, chunk_start_pos, chunk_end_pos
         yield input_matrix, position, normal_alt_info_list, tumor_alt_info_list
 
 
-def predict(args):
+def predict(args, model=None, tensor_fp=None):
+    """
+    model: loaded model to reuse across calls, loaded from --chkpnt_fn if not provided.
+    tensor_fp: stream of tensors to read instead of --tensor_fn.
+    """
     global output_config
     global call_fn
 
@@ -414,18 +467,18 @@ def predict(args):
     global test_pos
     test_pos = None
 
-    if param.use_tf:
-        import clairs.model_tf as model_path
-        model = model_path.Clair3_P()
-        model.load_weights(args.chkpnt_fn)
+    model_client = None
 
-    else:
-        model = torch.load(chkpnt_fn, map_location=torch.device(device))
+    if args.model_server_fn is not None:
+        from clairs.model_server import ModelServerClient
+        model_client = ModelServerClient(socket_fn=args.model_server_fn, model_name=args.model_name)
 
-        model.eval()
+    else:
+        if model is None:
+            model = load_model(chkpnt_fn, backend=args.backend, device=device)
+        model = inference_model_from(model, args, device=device)
 
     total = 0
-    softmax = torch.nn.Softmax(dim=1)
     if not args.is_from_tables:
         is_finish_loaded_all_mini_batches = False
         mini_batches_loaded = []
@@ -442,7 +495,9 @@ def predict(args):
                                                  pileup=args.pileup,
                                                  min_rescale_cov=param.min_rescale_cov,
                                                  phase_tumor=args.phase_tumor,
-                                                 platform=platform)
+                                                 platform=platform,
+                                                 binary_tensor=args.binary_tensor,
+                                                 tensor_fp=tensor_fp)
 
         while True:
             thread_pool = []
@@ -450,20 +505,12 @@ def predict(args):
                 mini_batch = mini_batches_to_output.pop(0)
                 input_tensor, position, normal_alt_info_list, tumor_alt_info_list, variant_type_list = mini_batch
 
-                if param.use_tf:
-                    prediction = model.predict_on_batch(input_tensor)[0]
+                input_matrix = input_matrix_from(input_tensor, pileup=args.pileup, device=device)
+                if model_client is not None:
+                    input_matrix = scaled_input_from(input_matrix, scale=not args.pileup)
+                    prediction = model_client.predict(input_matrix.cpu().numpy())
                 else:
-                    if args.pileup:
-                        input_matrix = torch.from_numpy(input_tensor).to(device)
-                    else:
-                        input_matrix = torch.from_numpy(np.transpose(input_tensor, (0, 3, 1, 2)) / 100.0).float().to(
-                            device)
-                        if input_matrix.shape[1] != param.channel_size:
-                            input_matrix = input_matrix[:, :param.channel_size, :, :]
-                    with torch.no_grad():
-                        prediction = model(input_matrix)
-                    prediction = softmax(prediction)
-                    prediction = prediction.cpu().numpy()
+                    prediction = model.predict(input_matrix, scale=not args.pileup)
 
                 total += len(input_tensor)
                 thread_pool.append(Thread(
@@ -510,14 +557,18 @@ def predict(args):
         dataset_iter = iter(data_generator)
         for idx in range(num_epoch):
             input_tensor, position, normal_alt_info_list, tumor_alt_info_list = next(dataset_iter)
-            input_matrix = torch.from_numpy(np.transpose(input_tensor, (0, 3, 1, 2)) / 100.0).float().to(device)
-            with torch.no_grad():
-                prediction = model(input_matrix)
-            prediction = softmax(prediction)
-            prediction = prediction.cpu().numpy()
+            input_matrix = input_matrix_from(input_tensor, pileup=args.pileup, device=device)
+            if model_client is not None:
+                input_matrix = scaled_input_from(input_matrix, scale=not args.pileup)
+                prediction = model_client.predict(input_matrix.cpu().numpy())
+            else:
+                prediction = model.predict(input_matrix, scale=not args.pileup)
             batch_output(output_file, position, normal_alt_info_list, tumor_alt_info_list, prediction)
             total += len(input_tensor)
 
+    if model_client is not None:
+        model_client.close()
+
     run_time = "%.1fs" % (time() - variant_call_start_time)
     logging.info("[INFO] {} total processed positions: {}, time elapsed: {}".format(args.ctg_name, total, run_time))
 
@@ -538,7 +589,7 @@ def predict(args):
         predict_fn_fpo.close()
 
 
-def main():
+def predict_parser():
     parser = ArgumentParser(description="Candidate variants probability prediction using tensors and a trained model")
 
     parser.add_argument('--platform', type=str, default="ont",
@@ -578,6 +629,10 @@ def main():
     parser.add_argument('--enable_indel_calling', type=str2bool, default=0,
                         help="EXPERIMENTAL: Call Indel variants, default: disabled")
 
+    parser.add_argument('--backend', type=str, default="torch", choices=BACKENDS,
+                        help="EXPERIMENTAL: Inference backend, torch loads a pickled model as --chkpnt_fn, torchscript "
+                             "and onnxruntime load a model exported by export_model. Default: %(default)s")
+
     # options for debug purpose
     parser.add_argument('--predict_fn', type=str, default="PIPE",
                         help="DEBUG: Output network output probabilities for further analysis")
@@ -623,6 +678,32 @@ def main():
     parser.add_argument('--flanking', type=int, default=None,
                         help=SUPPRESS)
 
+    ## Read binary tensors from stdin, binary tensor files are detected automatically
+    parser.add_argument('--binary_tensor', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Run inference on a running model server instead of loading --chkpnt_fn, see clairs/model_server.py
+    parser.add_argument('--model_server_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## The model name in the model server: pileup, full_alignment, indel_pileup or indel_full_alignment
+    parser.add_argument('--model_name', type=str, default="pileup",
+                        help=SUPPRESS)
+
+    ## Inference precision: fp32, bf16 or fp16 autocast, or int8 dynamic quantization (CPU), see clairs/inference.py
+    parser.add_argument('--inference_precision', type=str, default='fp32', choices=INFERENCE_PRECISIONS,
+                        help=SUPPRESS)
+
+    ## Run the full-alignment model with channels-last input and weights
+    parser.add_argument('--channels_last', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    return parser
+
+
+def main():
+    parser = predict_parser()
+
     args = parser.parse_args()
 
     predict(args)
@@ -29,7 +29,6 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
-import tables
 import sys
 import os
 import random
@@ -42,14 +41,15 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from subprocess import run
 from argparse import ArgumentParser, SUPPRESS
+from torch.utils.data import Dataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from shared.utils import str2bool
 import shared.param as param
 import clairs.model as model_path
+from clairs.memmap_bin import open_bin
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
-tables.set_blosc_max_threads(512)
 os.environ['NUMEXPR_MAX_THREADS'] = '256'
 os.environ['NUMEXPR_NUM_THREADS'] = '32'
 gamma = 0.7
@@ -145,6 +145,105 @@ def get_chunk_list(chunk_offset, train_chunk_num, chunks_per_batch=10, training_
     return np.array(all_shuffle_chunk_list[:train_chunk_num]), np.array(all_shuffle_chunk_list[train_chunk_num:])
 
 
+def tumor_label_from(label, discard_germline, smoothing=None):
+    """
+    Return the one-hot tumor labels of a batch of labels, the class of a row is the argmax of its first three
+    columns, germline calls are negatives if discard_germline.
+    """
+    positive = 1 - smoothing if smoothing is not None else 1
+    negative = smoothing if smoothing is not None else 0
+    label_class = np.argmax(label[:, :3], axis=1)
+    if discard_germline:
+        label_class = (label_class == 2).astype(np.int64)
+    label_for_tumor = np.full((len(label), 2 if discard_germline else 3), negative, dtype=np.float32)
+    label_for_tumor[np.arange(len(label)), label_class] = positive
+    return label_for_tumor
+
+
+class BinChunkDataset(Dataset):
+    """
+    Batches of the training bins, item i is the i-th batch of chunks_per_batch chunks of the chunk list.
+
+    The bins are opened in each process reading them, so that the DataLoader workers do not share the PyTables file
+    handles. With shuffle, the chunk order and the start offset of the chunks are drawn from seed and the epoch set by
+    set_epoch, so that the batches of an epoch are the same for any number of workers.
+    """
+
+    def __init__(self, bin_fn_list, chunk_list, tensor_shape, chunk_size, chunks_per_batch, pileup=False,
+                 discard_germline=False, smoothing=None, shuffle=True, seed=0, debug_mode=False):
+        self.bin_fn_list = bin_fn_list
+        self.chunk_list = np.array(chunk_list)
+        self.tensor_shape = tensor_shape
+        self.chunk_size = chunk_size
+        self.chunks_per_batch = chunks_per_batch
+        self.batch_size = chunk_size * chunks_per_batch
+        self.pileup = pileup
+        self.discard_germline = discard_germline
+        self.smoothing = smoothing
+        self.shuffle = shuffle
+        self.seed = seed
+        self.debug_mode = debug_mode
+        self.table_dataset_list = None
+        self.table_pid = None
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.shuffle_chunk_list = self.chunk_list
+        self.random_start_position = 0
+        if self.shuffle:
+            random_state = np.random.RandomState(self.seed + epoch)
+            self.random_start_position = random_state.randint(0, self.batch_size)
+            self.shuffle_chunk_list = self.chunk_list[random_state.permutation(len(self.chunk_list))]
+
+    def __len__(self):
+        return len(self.chunk_list) // self.chunks_per_batch
+
+    def tables_of_process(self):
+        if self.table_dataset_list is None or self.table_pid != os.getpid():
+            self.table_dataset_list = [open_bin(bin_fn) for bin_fn in self.bin_fn_list]
+            self.table_pid = os.getpid()
+        return self.table_dataset_list
+
+    def close(self):
+        if self.table_dataset_list is not None and self.table_pid == os.getpid():
+            for table_dataset in self.table_dataset_list:
+                table_dataset.close()
+        self.table_dataset_list = None
+
+    def __getitem__(self, batch_idx):
+        x = self.tables_of_process()
+        chunk_size = self.chunk_size
+        input_matrix = np.empty([self.batch_size] + self.tensor_shape, np.float32)
+        label = np.empty((self.batch_size, param.label_size), np.float32)
+        if self.debug_mode:
+            position_info = np.empty((self.batch_size, 1), "S100")
+            normal_info = np.empty((self.batch_size, 1), "S1000")
+            tumor_info = np.empty((self.batch_size, 1), "S1000")
+
+        for chunk_idx in range(self.chunks_per_batch):
+            bin_id, chunk_id = self.shuffle_chunk_list[batch_idx * self.chunks_per_batch + chunk_idx]
+            start = self.random_start_position + chunk_id * chunk_size
+            output_slice = slice(chunk_idx * chunk_size, (chunk_idx + 1) * chunk_size)
+            input_matrix[output_slice] = x[bin_id].root.input_matrix[start:start + chunk_size]
+            label[output_slice] = x[bin_id].root.label[start:start + chunk_size, :param.label_size]
+            if self.debug_mode:
+                position_info[output_slice] = x[bin_id].root.position[start:start + chunk_size]
+                normal_info[output_slice] = x[bin_id].root.normal_alt_info[start:start + chunk_size]
+                tumor_info[output_slice] = x[bin_id].root.tumor_alt_info[start:start + chunk_size]
+
+        label_for_tumor = tumor_label_from(label, self.discard_germline, self.smoothing)
+        af_tensor = None
+        if param.add_af_in_label:
+            af_list = label[:, 3:4]
+            af_tensor = np.concatenate([af_list, af_list, 1 / np.maximum(af_list, 0.05) / 20.0], axis=1)
+
+        if not self.pileup:
+            input_matrix = np.ascontiguousarray(np.transpose(input_matrix, (0, 3, 1, 2))) / 100.0
+        if self.debug_mode:
+            return input_matrix, label_for_tumor, position_info, normal_info, tumor_info
+        return input_matrix, label_for_tumor, af_tensor, None, None
+
+
 def exist_file_prefix(exclude_training_samples, f):
     for prefix in exclude_training_samples:
         if prefix in f:
@@ -226,7 +325,7 @@ def train_model(args):
     failed_bin_set = set()
     for bin_file in bin_list:
         try:
-            table = tables.open_file(os.path.join(args.bin_fn, bin_file), 'r')
+            table = open_bin(os.path.join(args.bin_fn, bin_file))
             table.close()
         except:
             print("[WARNING] {} cannot open!".format(bin_file))
@@ -240,21 +339,22 @@ def train_model(args):
 
     def populate_dataset_table(file_list, file_path):
         chunk_offset = np.zeros(len(file_list), dtype=int)
-        table_dataset_list = []
+        bin_fn_list = []
         for bin_idx, bin_file in enumerate(file_list):
-            table_dataset = tables.open_file(os.path.join(file_path, bin_file), 'r')
-            table_dataset_list.append(table_dataset)
-            chunk_num = (len(table_dataset.root.label) - batch_size) // chunk_size
+            bin_fn = os.path.join(file_path, bin_file)
+            with open_bin(bin_fn) as table_dataset:
+                chunk_num = (len(table_dataset.root.label) - batch_size) // chunk_size
+            bin_fn_list.append(bin_fn)
             chunk_offset[bin_idx] = chunk_num
-        return table_dataset_list, chunk_offset
+        return bin_fn_list, chunk_offset
 
-    table_dataset_list, chunk_offset = populate_dataset_table(bin_list, args.bin_fn)
+    bin_fn_list, chunk_offset = populate_dataset_table(bin_list, args.bin_fn)
 
-    validate_table_dataset_list = []
+    validate_bin_fn_list = []
     if validation_fn:
         val_list = os.listdir(validation_fn)
         logging.info("[INFO] total {} validation bin files: {}".format(len(val_list), ','.join(val_list)))
-        validate_table_dataset_list, validate_chunk_offset = populate_dataset_table(val_list, args.validation_fn)
+        validate_bin_fn_list, validate_chunk_offset = populate_dataset_table(val_list, args.validation_fn)
 
         train_chunk_num = int(sum(chunk_offset))
         train_shuffle_chunk_list, _ = get_chunk_list(chunk_offset, train_chunk_num)
@@ -280,80 +380,6 @@ def train_model(args):
     train_data_size = train_chunk_num * chunk_size
     validate_data_size = validate_chunk_num * chunk_size
 
-    def DataGenerator(x, shuffle_chunk_list, train_flag=True):
-
-        batch_num = len(shuffle_chunk_list) // chunks_per_batch
-        input_matrix = np.empty([batch_size] + tensor_shape, np.float32)
-        label = np.empty((batch_size, param.label_size), np.float32)
-        if debug_mode:
-            position_info = np.empty((batch_size, 1), "S100")
-            normal_info = np.empty((batch_size, 1), "S1000")
-            tumor_info = np.empty((batch_size, 1), "S1000")
-        for epoch in range(max_epoch):
-            random_start_position = np.random.randint(0, batch_size) if train_flag else 0
-            if train_flag:
-                np.random.shuffle(shuffle_chunk_list)
-            for batch_idx in range(batch_num):
-
-                for chunk_idx in range(chunks_per_batch):
-                    offset_chunk_id = shuffle_chunk_list[batch_idx * chunks_per_batch + chunk_idx]
-                    bin_id, chunk_id = offset_chunk_id
-
-                    current_tensor = x[bin_id].root.input_matrix[
-                                     random_start_position + chunk_id * chunk_size:random_start_position + (
-                                                 chunk_id + 1) * chunk_size]
-                    # if not args.pileup:
-                    #     current_tensor = current_tensor[:, :, :, :param.channel_size]
-
-
-                    input_matrix[chunk_idx * chunk_size:(chunk_idx + 1) * chunk_size] = current_tensor
-
-                    label[chunk_idx * chunk_size:(chunk_idx + 1) * chunk_size] = x[bin_id].root.label[
-                                                                                 random_start_position + chunk_id * chunk_size:random_start_position + (
-                                                                                             chunk_id + 1) * chunk_size,
-                                                                                 :param.label_size]
-                    if debug_mode:
-                        position_info[chunk_idx * chunk_size:(chunk_idx + 1) * chunk_size] = x[bin_id].root.position[
-                                                                                             random_start_position + chunk_id * chunk_size:random_start_position + (
-                                                                                                         chunk_id + 1) * chunk_size]
-                        normal_info[chunk_idx * chunk_size:(chunk_idx + 1) * chunk_size] = x[
-                                                                                               bin_id].root.normal_alt_info[
-                                                                                           random_start_position + chunk_id * chunk_size:random_start_position + (
-                                                                                                       chunk_id + 1) * chunk_size]
-                        tumor_info[chunk_idx * chunk_size:(chunk_idx + 1) * chunk_size] = x[bin_id].root.tumor_alt_info[
-                                                                                          random_start_position + chunk_id * chunk_size:random_start_position + (
-                                                                                                      chunk_id + 1) * chunk_size]
-
-                positive = 1 - smoothing if smoothing is not None else 1
-                negative = smoothing if smoothing is not None else 0
-                if discard_germline:
-                    label_for_tumor = [[negative, positive] if np.argmax(item[:3]) == 2 else \
-                                           ([positive, negative] if np.argmax(item[:3]) == 1 else [positive, negative])
-                                       for item in label]
-                else:
-                    label_for_tumor = [[negative, negative, positive] if np.argmax(item[:3]) == 2 else \
-                                           ([negative, positive, negative] if np.argmax(item[:3]) == 1 else [positive,
-                                                                                                             negative,
-                                                                                                             negative])
-                                       for item in label]
-
-                label_for_tumor = np.array(label_for_tumor, dtype=np.float32)
-                af_tensor = []
-                if param.add_af_in_label:
-                    af_list = [item[3] for item in label]
-                    af_list = [[item, item, 1 / float(max(item, 0.05)) / 20.0] for item in af_list]
-                    af_tensor = torch.from_numpy(np.array(af_list)).to(device)
-
-                if not args.pileup:
-                    input_tensor = torch.from_numpy(np.transpose(input_matrix, (0, 3, 1, 2)) / 100.0).to(device)
-                else:
-                    input_tensor = torch.from_numpy(input_matrix).to(device)
-                label_tensor = torch.from_numpy(label_for_tumor).to(device)
-                if debug_mode:
-                    yield input_tensor, label_tensor, position_info, normal_info, tumor_info
-                else:
-                    yield input_tensor, label_tensor, af_tensor, None, None
-
     if args.pileup:
         try:
             from torchinfo import summary
@@ -369,9 +395,35 @@ def train_model(args):
         except:
             pass
 
-    train_dataset_loder = DataGenerator(table_dataset_list, train_shuffle_chunk_list, True)
-    validate_dataset_loder = DataGenerator(validate_table_dataset_list if validation_fn else table_dataset_list,
-                                           validate_shuffle_chunk_list, False)
+    def dataset_from(bin_fn_list, chunk_list, shuffle):
+        return BinChunkDataset(bin_fn_list=bin_fn_list,
+                               chunk_list=chunk_list,
+                               tensor_shape=tensor_shape,
+                               chunk_size=chunk_size,
+                               chunks_per_batch=chunks_per_batch,
+                               pileup=args.pileup,
+                               discard_germline=discard_germline,
+                               smoothing=smoothing,
+                               shuffle=shuffle,
+                               seed=seed,
+                               debug_mode=debug_mode)
+
+    def data_loader_from(dataset):
+        # each item is a whole batch, the workers prefetch the next batches into pinned memory for the GPU
+        num_workers = max(args.num_workers, 0)
+        worker_options = dict(prefetch_factor=max(args.prefetch_batches, 1)) if num_workers > 0 else {}
+        return DataLoader(dataset,
+                          batch_size=None,
+                          shuffle=False,
+                          num_workers=num_workers,
+                          pin_memory=device == 'cuda',
+                          **worker_options)
+
+    train_dataset = dataset_from(bin_fn_list, train_shuffle_chunk_list, True)
+    validate_dataset = dataset_from(validate_bin_fn_list if validation_fn else bin_fn_list,
+                                    validate_shuffle_chunk_list, False)
+    train_dataset_loder = data_loader_from(train_dataset)
+    validate_dataset_loder = data_loader_from(validate_dataset)
 
     criterion = FocalLoss() if apply_focal_loss else nn.CrossEntropyLoss()
     criterion = criterion.to(device)
@@ -400,6 +452,7 @@ def train_model(args):
     training_step, validation_step = 0, 0
     echo_each_step = 200
     for epoch in range(1, max_epoch + 1):
+        train_dataset.set_epoch(epoch)
         epoch_loss = 0
         fp, tp, fn = 0, 0, 0
         t = tqdm(enumerate(train_dataset_loder), total=train_steps, position=0, leave=True)
@@ -408,8 +461,10 @@ def train_model(args):
         model.train()
         for batch_idx, (data, label, af_list, _, _) in t:
             t.set_description('EPOCH {}'.format(epoch))
-            data = data.to(device)
-            label = label.to(device)
+            data = data.to(device, non_blocking=True)
+            label = label.to(device, non_blocking=True)
+            if param.add_af_in_label:
+                af_list = af_list.to(device, non_blocking=True)
             output_logit = model(data).contiguous()
             y_truth = torch.argmax(label, axis=1)
             optimizer.zero_grad()
@@ -453,8 +508,8 @@ def train_model(args):
         for batch_idx, (data, label, position_info, normal_info, tumor_info) in v:
             if not debug_mode:
                 v.set_description('VAL EPOCH {}'.format(epoch))
-            data = data.to(device)
-            label = label.to(device)
+            data = data.to(device, non_blocking=True)
+            label = label.to(device, non_blocking=True)
             with torch.no_grad():
                 output_logit = model(data)
 
@@ -507,11 +562,8 @@ def train_model(args):
 
     if add_writer:
         writer.close()
-    for table_dataset in table_dataset_list:
-        table_dataset.close()
-
-    for table_dataset in validate_table_dataset_list:
-        table_dataset.close()
+    train_dataset.close()
+    validate_dataset.close()
 
 def main():
     parser = ArgumentParser(description="Train a somatic model")
@@ -523,7 +575,7 @@ def main():
                         help="The name of sequence to be processed")
 
     parser.add_argument('--bin_fn', type=str, default="", required=True,
-                        help="Binary tensor input, support multiple bin readers using pytables")
+                        help="Binary tensor input, support multiple bin readers using pytables or memory-mapped bins")
 
     parser.add_argument('--chkpnt_fn', type=str, default=None,
                         help="Input a model to resume training or for fine-tuning")
@@ -544,6 +596,12 @@ def main():
     parser.add_argument('--exclude_training_samples', type=str, default=None,
                         help="Define training samples to be excluded")
 
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="Number of worker processes loading the training batches, 0 to load them in the training process, default: %(default)s")
+
+    parser.add_argument('--prefetch_batches', type=int, default=2,
+                        help="Number of batches prefetched by each loading worker, default: %(default)s")
+
     # mutually-incompatible validation options
     vgrp = parser.add_mutually_exclusive_group()
     vgrp.add_argument('--random_validation', action='store_true',
@@ -41,9 +41,12 @@ from itertools import product
 
 from shared.interval_tree import bed_tree_from, is_region_in
 from shared.utils import subprocess_popen, IUPAC_base_to_num_dict as BASE2NUM
+from clairs.memmap_bin import MemmapBinWriter
 
 FILTERS = tables.Filters(complib='blosc:lz4hc', complevel=5)
 shuffle_bin_size = 3000
+# rows of the batch buffers flushed into the bin
+TABLE_BUFFER_ROWS = 500
 PREFIX_CHAR_STR = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
 
@@ -163,8 +166,11 @@ def variant_map_from(var_fn, tree, is_tree_empty):
 
 def write_table_dict(table_dict, normal_matrix, tumor_matrix, label, pos, total, normal_alt_info, tumor_alt_info,
                      tensor_shape, pileup, proportion=None, max_normal_depth=None, max_tumor_depth=None):
-    normal_depth = len(normal_matrix) // tensor_shape[1] // tensor_shape[2]
-    tumor_depth = len(tumor_matrix) // tensor_shape[1] // tensor_shape[2]
+    row_size = tensor_shape[1] * tensor_shape[2]
+    normal_matrix = np.fromstring(normal_matrix, dtype=np.int32, sep=' ')
+    tumor_matrix = np.fromstring(tumor_matrix, dtype=np.int32, sep=' ')
+    normal_depth = len(normal_matrix) // row_size
+    tumor_depth = len(tumor_matrix) // row_size
     tensor_depth = normal_depth + tumor_depth
     if max_normal_depth is not None and normal_depth > max_normal_depth:
         print("[WARNING] Skip adding high normal coverage data for position {}!".format('-'.join(pos.split(':')[:2])))
@@ -175,13 +181,16 @@ def write_table_dict(table_dict, normal_matrix, tumor_matrix, label, pos, total,
 
     center_padding_depth = param.center_padding_depth
     padding_depth = tensor_shape[0] - tensor_depth - center_padding_depth
+    if padding_depth < 0:
+        return total
     prefix_padding_depth = int(padding_depth / 2)
-    suffix_padding_depth = padding_depth - int(padding_depth / 2)
-    prefix_zero_padding = ['0'] * prefix_padding_depth * tensor_shape[1] * tensor_shape[2]
-    center_zero_padding = ['0'] * center_padding_depth * tensor_shape[1] * tensor_shape[2]
-    suffix_zero_padding = ['0'] * suffix_padding_depth * tensor_shape[1] * tensor_shape[2]
-    table_dict['input_matrix'].append(
-        prefix_zero_padding + normal_matrix + center_zero_padding + tumor_matrix + suffix_zero_padding)
+
+    # the tensor is written into its row of the batch buffer, the paddings are the zeros of the row
+    row = table_buffer_row_from(table_dict, tensor_shape, np.int8).reshape(-1)
+    offset = prefix_padding_depth * row_size
+    row[offset:offset + len(normal_matrix)] = normal_matrix
+    offset += len(normal_matrix) + center_padding_depth * row_size
+    row[offset:offset + len(tumor_matrix)] = tumor_matrix
     table_dict['position'].append(pos)
     table_dict['label'].append(label)
     table_dict['normal_alt_info'].append(normal_alt_info)
@@ -193,7 +202,8 @@ def write_table_dict(table_dict, normal_matrix, tumor_matrix, label, pos, total,
 
 def update_table_dict():
     table_dict = {}
-    table_dict['input_matrix'] = []
+    # numpy buffer of the batch tensors, allocated by the first row
+    table_dict['input_matrix'] = None
     table_dict['normal_alt_info'] = []
     table_dict['tumor_alt_info'] = []
     table_dict['position'] = []
@@ -202,6 +212,22 @@ def update_table_dict():
     return table_dict
 
 
+def table_buffer_row_from(table_dict, tensor_shape, dtype):
+    """
+    Return the zeroed buffer row of the next tensor of the batch, the buffer is doubled once it is full.
+    """
+    row_idx = len(table_dict['position'])
+    input_matrix = table_dict['input_matrix']
+    if input_matrix is None:
+        input_matrix = np.zeros([TABLE_BUFFER_ROWS] + tensor_shape, dtype)
+    elif row_idx >= len(input_matrix):
+        input_matrix = np.concatenate([input_matrix, np.zeros_like(input_matrix)])
+    table_dict['input_matrix'] = input_matrix
+    row = input_matrix[row_idx]
+    row[...] = 0
+    return row
+
+
 def write_table_file(table_file, table_dict, tensor_shape, label_size, float_type):
     """
     Write pileup or full alignment tensor into compressed bin file.
@@ -213,21 +239,87 @@ def write_table_file(table_file, table_dict, tensor_shape, label_size, float_typ
     non_variant_subsample_ratio: define a maximum non variant ratio for training, we always expect use more non variant data, while it would greatly increase training
     time, especially in ont data, here we usually use 1:1 or 1:2 for variant candidate: non variant candidate.
     """
+    row_num = len(table_dict['position'])
+    if not row_num:
+        return table_dict
+    append_bin_rows(table_file=table_file,
+                    input_matrix=table_dict['input_matrix'][:row_num].astype(np.dtype(float_type), copy=False),
+                    label=np.array(table_dict['label'], np.dtype('float32')).reshape(-1, label_size),
+                    position=table_dict['position'],
+                    normal_alt_info=table_dict['normal_alt_info'],
+                    tumor_alt_info=table_dict['tumor_alt_info'],
+                    proportion=np.array(table_dict['proportion'], np.dtype('float32')))
+    return update_table_dict()
+
+
+def bin_writer_from(bin_fn, tensor_shape, label_size, bin_format='tables', tensor_dtype='int8'):
+    """
+    Create an empty training bin, a compressed PyTables file or a memory-mapped bin directory of tensor_dtype.
+    """
+    if bin_format == 'memmap':
+        # uncompressed integer tensors, read by training as slices of memory maps
+        return MemmapBinWriter(bin_fn=bin_fn, tensor_shape=tensor_shape, label_size=label_size,
+                               tensor_dtype=tensor_dtype)
+    from shared.param import no_of_positions
+    tables.set_blosc_max_threads(64)
+    float_atom = tables.Atom.from_dtype(np.dtype('float32'))
+    string_atom = tables.StringAtom(itemsize=no_of_positions + 50)
+    long_string_atom = tables.StringAtom(itemsize=30000)  # max alt_info length
+    table_file = tables.open_file(bin_fn, mode='w', filters=FILTERS)
+    table_file.create_earray(where='/', name='input_matrix', atom=float_atom, shape=[0] + list(tensor_shape),
+                             filters=FILTERS)
+    table_file.create_earray(where='/', name='position', atom=string_atom, shape=(0, 1), filters=FILTERS)
+    table_file.create_earray(where='/', name='label', atom=float_atom, shape=(0, label_size), filters=FILTERS)
+    table_file.create_earray(where='/', name='normal_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
+    table_file.create_earray(where='/', name='tumor_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
+    table_file.create_earray(where='/', name='proportion', atom=float_atom, shape=(0, 1), filters=FILTERS)
+    return table_file
 
-    try:
-        input_matrix = np.array(table_dict['input_matrix'], np.dtype(float_type)).reshape([-1] + tensor_shape)
-    except:
-            return table_dict
+
+def append_bin_rows(table_file, input_matrix, label, position, normal_alt_info, tumor_alt_info, proportion):
+    """
+    Append a block of rows to a bin created by bin_writer_from.
+    """
+    if isinstance(table_file, MemmapBinWriter):
+        table_file.append(input_matrix=input_matrix,
+                          label=label,
+                          position=position,
+                          normal_alt_info=normal_alt_info,
+                          tumor_alt_info=tumor_alt_info,
+                          proportion=proportion)
+        return
     table_file.root.input_matrix.append(input_matrix)
+    table_file.root.normal_alt_info.append(np.array(normal_alt_info).reshape(-1, 1))
+    table_file.root.tumor_alt_info.append(np.array(tumor_alt_info).reshape(-1, 1))
+    table_file.root.position.append(np.array(position).reshape(-1, 1))
+    table_file.root.label.append(label)
+    table_file.root.proportion.append(np.array(proportion, np.dtype('float32')).reshape(-1, 1))
 
-    table_file.root.normal_alt_info.append(np.array(table_dict['normal_alt_info']).reshape(-1, 1))
-    table_file.root.tumor_alt_info.append(np.array(table_dict['tumor_alt_info']).reshape(-1, 1))
-    table_file.root.position.append(np.array(table_dict['position']).reshape(-1, 1))
-    table_file.root.label.append(np.array(table_dict['label'], np.dtype(float_type)).reshape(-1, label_size))
-    table_file.root.proportion.append(np.array(table_dict['proportion'], np.dtype('float32')).reshape(-1, 1))
-    table_dict = update_table_dict()
 
-    return table_dict
+def tensor_file_pairs_from(normal_tensor_fn, tumor_tensor_fn):
+    """
+    Return [(normal_tensor_fn, tumor_tensor_fn)] of a pair of tensor files, or of all tensor files sharing the file
+    prefix in the normal and tumor directories. Return None if only one file of a pair exists.
+    """
+    if os.path.exists(tumor_tensor_fn) or os.path.exists(normal_tensor_fn):
+        if not (os.path.exists(tumor_tensor_fn) and os.path.exists(normal_tensor_fn)):
+            return None
+        return [(normal_tensor_fn, tumor_tensor_fn)]
+
+    tensor_file_pairs = []
+    tumor_tensor_info = tumor_tensor_fn.split('/')
+    tumor_directry, file_prefix = '/'.join(tumor_tensor_info[:-1]), tumor_tensor_info[-1]
+
+    normal_tensor_info = normal_tensor_fn.split('/')
+    normal_directry, file_prefix = '/'.join(normal_tensor_info[:-1]), normal_tensor_info[-1]
+
+    for file_name in os.listdir(tumor_directry):
+        if file_name.startswith(file_prefix + '_') or file_name.startswith(
+                file_prefix + '.'):  # add '_.' to avoid add other prefix chr
+            if os.path.exists(os.path.join(normal_directry, file_name)):
+                tensor_file_pairs.append((os.path.join(normal_directry, file_name),
+                                          os.path.join(tumor_directry, file_name)))
+    return tensor_file_pairs
 
 
 def print_bin_size(path, prefix=None):
@@ -381,7 +473,8 @@ def heapq_merge_generator_from(normal_bin_reader_generator, tumor_bin_reader_gen
             continue
         tensor_infos_set.add(key)
         tumor_flag = 'tumor' if is_tumor else 'normal'
-        tensor_list = string.split(" ")
+        # the tensor string is parsed once the row is written
+        tensor_list = string
 
         if batch_count >= shuffle_bin_size and is_tumor and dup_pos_end_flag:
             yield X, batch_count
@@ -413,7 +506,9 @@ def get_training_array(args,
                        maximum_non_variant_ratio=None,
                        phase_tumor=False,
                        candidate_details_fn_prefix=None,
-                       merge_bins=False):
+                       merge_bins=False,
+                       bin_format='tables',
+                       tensor_file_pairs=None):
     tree = bed_tree_from(bed_file_path=bed_fn)
     is_tree_empty = len(tree.keys()) == 0
     Y, miss_variant_set = variant_map_from(var_fn, tree, is_tree_empty)
@@ -432,45 +527,18 @@ def get_training_array(args,
 
     non_variant_subsample_ratio = maximum_non_variant_ratio if maximum_non_variant_ratio is not None else 1.0
 
-    normal_tensor_list = []
-    tumor_tensor_list = []
-    if os.path.exists(tumor_tensor_fn) or os.path.exists(normal_tensor_fn):
-        if not (os.path.exists(tumor_tensor_fn) and os.path.exists(normal_tensor_fn)):
+    if tensor_file_pairs is None:
+        tensor_file_pairs = tensor_file_pairs_from(normal_tensor_fn, tumor_tensor_fn)
+        if tensor_file_pairs is None:
             return 0
-        normal_tensor_list.append(normal_tensor_fn)
-        tumor_tensor_list.append(tumor_tensor_fn)
-    else:
-        tumor_tensor_info = tumor_tensor_fn.split('/')
-        tumor_directry, file_prefix = '/'.join(tumor_tensor_info[:-1]), tumor_tensor_info[-1]
-
-        normal_tensor_info = normal_tensor_fn.split('/')
-        normal_directry, file_prefix = '/'.join(normal_tensor_info[:-1]), normal_tensor_info[-1]
 
-        for file_name in os.listdir(tumor_directry):
-            if file_name.startswith(file_prefix + '_') or file_name.startswith(
-                    file_prefix + '.'):  # add '_.' to avoid add other prefix chr
-                if os.path.exists(os.path.join(normal_directry, file_name)):
-                    normal_tensor_list.append(os.path.join(normal_directry, file_name))
-                    tumor_tensor_list.append(os.path.join(tumor_directry, file_name))
-
-    tables.set_blosc_max_threads(64)
-    int_atom = tables.Atom.from_dtype(np.dtype(float_type))
-    float_atom = tables.Atom.from_dtype(np.dtype('float32'))
-    string_atom = tables.StringAtom(itemsize=param.no_of_positions + 50)
-    long_string_atom = tables.StringAtom(itemsize=30000)  # max alt_info length
-    table_file = tables.open_file(bin_fn, mode='w', filters=FILTERS)
-    table_file.create_earray(where='/', name='input_matrix', atom=float_atom, shape=[0] + tensor_shape,
-                             filters=FILTERS)
-    table_file.create_earray(where='/', name='position', atom=string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='label', atom=float_atom, shape=(0, param.label_size), filters=FILTERS)
-    table_file.create_earray(where='/', name='normal_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='tumor_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='proportion', atom=float_atom, shape=(0, 1), filters=FILTERS)
+    table_file = bin_writer_from(bin_fn=bin_fn, tensor_shape=tensor_shape, label_size=param.label_size,
+                                 bin_format=bin_format, tensor_dtype=float_type)
 
     table_dict = update_table_dict()
     total_compressed = 0
     total = 0
-    for normal_tensor_fn, tumor_tensor_fn in zip(normal_tensor_list, tumor_tensor_list):
+    for normal_tensor_fn, tumor_tensor_fn in tensor_file_pairs:
 
         normal_subprocess_process = subprocess_popen(shlex.split("{} -fdc {}".format(param.zstd, normal_tensor_fn)))
         tumor_subprocess_process = subprocess_popen(shlex.split("{} -fdc {}".format(param.zstd, tumor_tensor_fn)))
@@ -41,6 +41,7 @@ from itertools import product
 
 from shared.interval_tree import bed_tree_from, is_region_in
 from shared.utils import subprocess_popen, IUPAC_base_to_num_dict as BASE2NUM
+from clairs.utils import bin_writer_from, append_bin_rows, tensor_file_pairs_from, table_buffer_row_from
 
 FILTERS = tables.Filters(complib='blosc:lz4hc', complevel=5)
 shuffle_bin_size = 3000
@@ -163,30 +164,19 @@ def variant_map_from(var_fn, tree, is_tree_empty):
 
 def write_table_dict(table_dict, normal_matrix, tumor_matrix, label, pos, total, normal_alt_info, tumor_alt_info,
                      tensor_shape, pileup, proportion=None):
-    input_matrix = []
     from shared.param import pileup_channel_size
     channel_size = pileup_channel_size
     tumor_channel_size = param.tumor_channel_size
-    apply_normalize = False
-    if apply_normalize:
-        normal_coverage = float(normal_alt_info.split('-')[0])
-        tumor_coverage = float(tumor_alt_info.split('-')[0])
-
-        if normal_coverage == 0 or tumor_coverage == 0:
-            return total
-        for idx in range(param.no_of_positions):
-            input_matrix += [float(item) / normal_coverage for item in
-                             normal_matrix[idx * channel_size: (idx + 1) * channel_size]]
-            input_matrix += [float(item) / tumor_coverage for item in
-                             tumor_matrix[idx * tumor_channel_size: (idx + 1) * tumor_channel_size]]
-    else:
-        for idx in range(param.no_of_positions):
-            input_matrix += normal_matrix[idx * channel_size: (idx + 1) * channel_size]
-            input_matrix += tumor_matrix[idx * tumor_channel_size: (idx + 1) * tumor_channel_size]
-
-    if len(input_matrix) != param.no_of_positions * (channel_size + tumor_channel_size):
+    normal_matrix = np.fromstring(normal_matrix, dtype=np.float32, sep=' ')
+    tumor_matrix = np.fromstring(tumor_matrix, dtype=np.float32, sep=' ')
+    if len(normal_matrix) != param.no_of_positions * channel_size or len(
+            tumor_matrix) != param.no_of_positions * tumor_channel_size:
         return total
-    table_dict['input_matrix'].append(input_matrix)
+
+    # the normal and tumor channels of each position side by side, written into the row of the batch buffer
+    row = table_buffer_row_from(table_dict, tensor_shape, np.float32)
+    row[:, :channel_size] = normal_matrix.reshape(param.no_of_positions, channel_size)
+    row[:, channel_size:] = tumor_matrix.reshape(param.no_of_positions, tumor_channel_size)
     table_dict['position'].append(pos)
     table_dict['label'].append(label)
     table_dict['normal_alt_info'].append(normal_alt_info)
@@ -198,7 +188,8 @@ def write_table_dict(table_dict, normal_matrix, tumor_matrix, label, pos, total,
 
 def update_table_dict():
     table_dict = {}
-    table_dict['input_matrix'] = []
+    # numpy buffer of the batch tensors, allocated by the first row
+    table_dict['input_matrix'] = None
     table_dict['normal_alt_info'] = []
     table_dict['tumor_alt_info'] = []
     table_dict['position'] = []
@@ -219,20 +210,17 @@ def write_table_file(table_file, table_dict, tensor_shape, label_size, float_typ
     time, especially in ont data, here we usually use 1:1 or 1:2 for variant candidate: non variant candidate.
     """
     float_type = 'float32'
-    try:
-        input_matrix = np.array(table_dict['input_matrix'], np.dtype(float_type)).reshape([-1] + tensor_shape)
-    except:
-        return
-    table_file.root.input_matrix.append(input_matrix)
-
-    table_file.root.normal_alt_info.append(np.array(table_dict['normal_alt_info']).reshape(-1, 1))
-    table_file.root.tumor_alt_info.append(np.array(table_dict['tumor_alt_info']).reshape(-1, 1))
-    table_file.root.position.append(np.array(table_dict['position']).reshape(-1, 1))
-    table_file.root.label.append(np.array(table_dict['label'], np.dtype(float_type)).reshape(-1, label_size))
-    table_file.root.proportion.append(np.array(table_dict['proportion'], np.dtype(float_type)).reshape(-1, 1))
-    table_dict = update_table_dict()
-
-    return table_dict
+    row_num = len(table_dict['position'])
+    if not row_num:
+        return table_dict
+    append_bin_rows(table_file=table_file,
+                    input_matrix=table_dict['input_matrix'][:row_num],
+                    label=np.array(table_dict['label'], np.dtype(float_type)).reshape(-1, label_size),
+                    position=table_dict['position'],
+                    normal_alt_info=table_dict['normal_alt_info'],
+                    tumor_alt_info=table_dict['tumor_alt_info'],
+                    proportion=np.array(table_dict['proportion'], np.dtype(float_type)))
+    return update_table_dict()
 
 
 def print_bin_size(path, prefix=None):
@@ -386,7 +374,8 @@ def heapq_merge_generator_from(normal_bin_reader_generator, tumor_bin_reader_gen
             continue
         tensor_infos_set.add(key)
         tumor_flag = 'tumor' if is_tumor else 'normal'
-        tensor_list = string.split(" ")
+        # the tensor string is parsed once the row is written
+        tensor_list = string
 
         if batch_count >= shuffle_bin_size and is_tumor and dup_pos_end_flag:
             yield X, batch_count
@@ -417,7 +406,9 @@ def get_training_array(args,
                        pileup=False,
                        maximum_non_variant_ratio=None,
                        candidate_details_fn_prefix=None,
-                       merge_bins=False):
+                       merge_bins=False,
+                       bin_format='tables',
+                       tensor_file_pairs=None):
     phase_tumor = args.phase_tumor
     tree = bed_tree_from(bed_file_path=bed_fn)
     is_tree_empty = len(tree.keys()) == 0
@@ -438,45 +429,19 @@ def get_training_array(args,
     tensor_shape = [param.no_of_positions, channel_size + param.tumor_channel_size]  # normal and tumor
     non_variant_subsample_ratio = maximum_non_variant_ratio if maximum_non_variant_ratio is not None else 1.0
 
-    normal_tensor_list = []
-    tumor_tensor_list = []
-    if os.path.exists(tumor_tensor_fn) or os.path.exists(normal_tensor_fn):
-        if not (os.path.exists(tumor_tensor_fn) and os.path.exists(normal_tensor_fn)):
+    if tensor_file_pairs is None:
+        tensor_file_pairs = tensor_file_pairs_from(normal_tensor_fn, tumor_tensor_fn)
+        if tensor_file_pairs is None:
             return 0
-        normal_tensor_list.append(normal_tensor_fn)
-        tumor_tensor_list.append(tumor_tensor_fn)
-    else:
-        tumor_tensor_info = tumor_tensor_fn.split('/')
-        tumor_directry, file_prefix = '/'.join(tumor_tensor_info[:-1]), tumor_tensor_info[-1]
-
-        normal_tensor_info = normal_tensor_fn.split('/')
-        normal_directry, file_prefix = '/'.join(normal_tensor_info[:-1]), normal_tensor_info[-1]
-
-        for file_name in os.listdir(tumor_directry):
-            if file_name.startswith(file_prefix + '_') or file_name.startswith(
-                    file_prefix + '.'):  # add '_.' to avoid add other prefix chr
-                if os.path.exists(os.path.join(normal_directry, file_name)):
-                    normal_tensor_list.append(os.path.join(normal_directry, file_name))
-                    tumor_tensor_list.append(os.path.join(tumor_directry, file_name))
-
-    tables.set_blosc_max_threads(64)
-    int_atom = tables.Atom.from_dtype(np.dtype(float_type))
-    float_atom = tables.Atom.from_dtype(np.dtype('float32'))
-    string_atom = tables.StringAtom(itemsize=param.no_of_positions + 50)
-    long_string_atom = tables.StringAtom(itemsize=30000)  # max alt_info length
-    table_file = tables.open_file(bin_fn, mode='w', filters=FILTERS)
-    table_file.create_earray(where='/', name='input_matrix', atom=float_atom, shape=[0] + tensor_shape,
-                             filters=FILTERS)
-    table_file.create_earray(where='/', name='position', atom=string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='label', atom=float_atom, shape=(0, param.label_size), filters=FILTERS)
-    table_file.create_earray(where='/', name='normal_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='tumor_alt_info', atom=long_string_atom, shape=(0, 1), filters=FILTERS)
-    table_file.create_earray(where='/', name='proportion', atom=float_atom, shape=(0, 1), filters=FILTERS)
+
+    # the pileup counts are kept as int16 in a memory-mapped bin
+    table_file = bin_writer_from(bin_fn=bin_fn, tensor_shape=tensor_shape, label_size=param.label_size,
+                                 bin_format=bin_format, tensor_dtype='int16')
 
     table_dict = update_table_dict()
     total_compressed = 0
     total = 0
-    for normal_tensor_fn, tumor_tensor_fn in zip(normal_tensor_list, tumor_tensor_list):
+    for normal_tensor_fn, tumor_tensor_fn in tensor_file_pairs:
 
         normal_subprocess_process = subprocess_popen(shlex.split("{} -fdc {}".format(param.zstd, normal_tensor_fn)))
         tumor_subprocess_process = subprocess_popen(shlex.split("{} -fdc {}".format(param.zstd, tumor_tensor_fn)))
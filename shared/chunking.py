@@ -0,0 +1,183 @@
+"""
+Work-aware chunking of contigs for the chunked calling steps.
+
+The work of a region is estimated from the BAM indexes without reading any alignment: the BAI linear index holds the
+virtual file offset of the first alignment of each 16kb window, so the compressed bytes between consecutive windows
+approximate the amount of alignments to decode there. The chunks of the --chunk_size count are then shared among the
+contigs by their work and each contig is cut at window boundaries into chunks of about the same estimated work, so that
+high-depth regions get shorter chunks and low-depth regions longer ones.
+"""
+
+import os
+import heapq
+import shlex
+import struct
+from bisect import bisect_left
+
+from shared.utils import subprocess_popen
+
+BAI_MAGIC = b'BAI\x01'
+LINEAR_INDEX_WINDOW = 16384  # 2^14
+
+
+def bai_fn_from(bam_fn):
+    for bai_fn in (bam_fn + '.bai', os.path.splitext(bam_fn)[0] + '.bai'):
+        if os.path.exists(bai_fn):
+            return bai_fn
+    return None
+
+
+def linear_index_list_from(bai_fn):
+    """
+    Return the linear index (compressed file offsets of the 16kb windows) of each reference in the BAM header order,
+    or None if bai_fn is not a BAI file.
+    """
+    with open(bai_fn, 'rb') as f:
+        data = f.read()
+    if data[:4] != BAI_MAGIC:
+        return None
+    offset = 4
+    n_ref, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    linear_index_list = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            n_chunk, = struct.unpack_from('<i', data, offset + 4)
+            offset += 8 + n_chunk * 16
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        ioffsets = struct.unpack_from('<{}Q'.format(n_intv), data, offset)
+        offset += n_intv * 8
+        linear_index_list.append([ioffset >> 16 for ioffset in ioffsets])
+    return linear_index_list
+
+
+def idxstats_from(bam_fn, samtools):
+    """
+    Return [(contig_name, contig_length, mapped_reads)] in the BAM header order.
+    """
+    idxstats_process = subprocess_popen(shlex.split("{} idxstats {}".format(samtools, bam_fn)))
+    idxstats = []
+    for row in idxstats_process.stdout:
+        columns = row.rstrip().split('\t')
+        if len(columns) != 4 or columns[0] == '*':
+            continue
+        idxstats.append((columns[0], int(columns[1]), int(columns[2])))
+    idxstats_process.stdout.close()
+    idxstats_process.wait()
+    return idxstats
+
+
+def window_work_dict_from(bam_fn, samtools, contig_set):
+    """
+    Return {contig_name: [estimated work of each 16kb window]} of a BAM. The work is the compressed bytes of each
+    window, or the mapped reads of the contig spread evenly over its windows if the BAM has no BAI index.
+    """
+    idxstats = idxstats_from(bam_fn, samtools)
+    bai_fn = bai_fn_from(bam_fn)
+    linear_index_list = linear_index_list_from(bai_fn) if bai_fn is not None else None
+    if linear_index_list is not None and len(linear_index_list) < len(idxstats):
+        linear_index_list = None
+
+    window_work_dict = {}
+    for ref_idx, (contig_name, contig_length, mapped_reads) in enumerate(idxstats):
+        if contig_name not in contig_set:
+            continue
+        window_num = contig_length // LINEAR_INDEX_WINDOW + 1
+        if linear_index_list is None or not len(linear_index_list[ref_idx]):
+            window_work_dict[contig_name] = [mapped_reads / float(window_num)] * window_num
+            continue
+        # windows without alignments keep the offset of the previous window, leading empty windows the first offset
+        linear_index = []
+        previous_coffset = next((coffset for coffset in linear_index_list[ref_idx] if coffset), 0)
+        for coffset in linear_index_list[ref_idx]:
+            previous_coffset = max(coffset, previous_coffset)
+            linear_index.append(previous_coffset)
+        window_work = [next_coffset - coffset for coffset, next_coffset in zip(linear_index, linear_index[1:])]
+        # the last window has no next offset, assume the average
+        window_work.append(sum(window_work) / float(len(window_work)) if len(window_work) else 1.0)
+        window_work += [0] * (window_num - len(window_work))
+        window_work_dict[contig_name] = window_work
+    return window_work_dict
+
+
+def contig_chunk_num_dict_from(contig_work_dict, chunk_num, min_chunk_num_dict, max_chunk_num_dict):
+    """
+    Share chunk_num chunks among the contigs, one chunk at a time to the contig with the largest work per chunk, within
+    [min_chunk_num, max_chunk_num] chunks of each contig. The total is chunk_num unless the bounds do not allow it.
+    """
+    contig_chunk_num_dict = dict(min_chunk_num_dict)
+    chunk_heap = [(-contig_work / contig_chunk_num_dict[contig_name], contig_name)
+                  for contig_name, contig_work in contig_work_dict.items()
+                  if contig_chunk_num_dict[contig_name] < max_chunk_num_dict[contig_name]]
+    heapq.heapify(chunk_heap)
+    while sum(contig_chunk_num_dict.values()) < chunk_num and len(chunk_heap):
+        _, contig_name = heapq.heappop(chunk_heap)
+        contig_chunk_num_dict[contig_name] += 1
+        if contig_chunk_num_dict[contig_name] < max_chunk_num_dict[contig_name]:
+            heapq.heappush(chunk_heap, (-contig_work_dict[contig_name] / contig_chunk_num_dict[contig_name],
+                                        contig_name))
+    return contig_chunk_num_dict
+
+
+def work_aware_chunks_from(contig_length_dict, window_work_dict, chunk_num, min_chunk_length, max_chunk_length):
+    """
+    Split the contigs into chunk_num chunks of similar estimated work, return [(contig_name, chunk_id,
+    contig_chunk_num, ctg_start, ctg_end, work)] with 1-based inclusive ranges tiling each contig, ordered by the
+    estimated work from the largest. The chunks are shared among the contigs by their work, and each contig is cut at
+    the window boundaries nearest to the even shares of its work. The chunk length is kept within [min_chunk_length,
+    max_chunk_length] where the contig length allows it, a contig gets more or fewer chunks than its work share if
+    needed, so the total may then differ from chunk_num.
+    """
+    contig_window_work_dict = {}
+    for contig_name, contig_length in contig_length_dict.items():
+        window_num = (contig_length - 1) // LINEAR_INDEX_WINDOW + 1
+        window_work = list(window_work_dict.get(contig_name, []))[:window_num]
+        window_work += [0] * (window_num - len(window_work))
+        if not sum(window_work):
+            # a contig without estimated work is split by length
+            window_work = [1.0] * window_num
+        contig_window_work_dict[contig_name] = window_work
+
+    contig_work_dict = dict((contig_name, float(sum(window_work)))
+                            for contig_name, window_work in contig_window_work_dict.items())
+    min_chunk_num_dict, max_chunk_num_dict = {}, {}
+    for contig_name, contig_length in contig_length_dict.items():
+        min_chunk_num_dict[contig_name] = max((contig_length - 1) // max_chunk_length + 1, 1)
+        max_chunk_num_dict[contig_name] = max(min(len(contig_window_work_dict[contig_name]),
+                                                  contig_length // max(min_chunk_length, 1)),
+                                              min_chunk_num_dict[contig_name])
+    contig_chunk_num_dict = contig_chunk_num_dict_from(contig_work_dict=contig_work_dict,
+                                                       chunk_num=chunk_num,
+                                                       min_chunk_num_dict=min_chunk_num_dict,
+                                                       max_chunk_num_dict=max_chunk_num_dict)
+
+    chunk_list = []
+    for contig_name, contig_length in contig_length_dict.items():
+        window_work = contig_window_work_dict[contig_name]
+        window_num = len(window_work)
+        contig_chunk_num = contig_chunk_num_dict[contig_name]
+        # cumulative_work[idx]: work of the first idx windows
+        cumulative_work = [0]
+        for work in window_work:
+            cumulative_work.append(cumulative_work[-1] + work)
+        # chunk boundaries in windows, a chunk ends at the end of a window
+        boundaries = [0]
+        for chunk_idx in range(1, contig_chunk_num):
+            remaining_chunk_num = contig_chunk_num - chunk_idx
+            boundary = bisect_left(cumulative_work, cumulative_work[-1] * chunk_idx / contig_chunk_num)
+            previous_start = boundaries[-1] * LINEAR_INDEX_WINDOW
+            lower = max(previous_start + min_chunk_length, contig_length - remaining_chunk_num * max_chunk_length)
+            upper = min(previous_start + max_chunk_length, contig_length - remaining_chunk_num * min_chunk_length)
+            if lower <= upper:
+                boundary = min(max(boundary, (lower - 1) // LINEAR_INDEX_WINDOW + 1), upper // LINEAR_INDEX_WINDOW)
+            boundaries.append(min(max(boundary, boundaries[-1] + 1), window_num - remaining_chunk_num))
+        boundaries.append(window_num)
+        for chunk_idx in range(contig_chunk_num):
+            start_window, end_window = boundaries[chunk_idx], boundaries[chunk_idx + 1]
+            chunk_list.append((contig_name, chunk_idx + 1, contig_chunk_num, start_window * LINEAR_INDEX_WINDOW + 1,
+                               min(end_window * LINEAR_INDEX_WINDOW, contig_length),
+                               cumulative_work[end_window] - cumulative_work[start_window]))
+    return sorted(chunk_list, key=lambda chunk: -chunk[5])
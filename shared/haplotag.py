@@ -0,0 +1,187 @@
+"""
+Read haplotype assignment from a phased VCF, the in-process counterpart of `whatshap haplotag`.
+
+Instead of writing and indexing a haplotagged copy of the BAM, the reads of the original BAM are streamed once with
+`samtools view` and each read is assigned an HP from the phased heterozygous SNVs it covers, with the rule of
+`whatshap haplotag`: the read alleles are taken at the SNV positions by walking the CIGAR, each allele matching a
+haplotype adds its base quality to the score of that haplotype in the phase set (PS) of the SNV, and the read is
+assigned to the phase set with the largest score difference and to the haplotype with the higher score within it.
+Reads without informative SNVs or with a zero difference stay untagged, the same as reads without an HP tag in the
+haplotagged BAM. whatshap detects the alleles by realigning the read around each SNV instead (with --reference), so a
+few reads with indels or mismatches next to an SNV may be tagged differently.
+
+The reads are streamed in a pass of their own, the mpileup streams of the tensor creation and haplotype filtering are
+restricted to the candidate regions and reach a candidate before the phased SNVs at the far end of the long reads
+covering it. The pass replaces the `whatshap haplotag` step which reads, realigns, writes and indexes the whole BAM.
+
+Only the standard library is used, so that the pypy tensor creators can use it.
+"""
+
+import os
+import re
+import shlex
+from bisect import bisect_left
+from collections import defaultdict
+
+from shared.utils import subprocess_popen, is_command_exists
+import shared.param as param
+
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# drop the phased SNVs behind the current read start in blocks to keep the deletion amortized
+SNV_DROP_SIZE = 10000
+
+
+def phased_snv_from(row, ctg_name):
+    """
+    Return (pos, hap1_base, hap2_base, phase_set) of a phased heterozygous SNV VCF row, or None otherwise.
+    """
+    columns = row.rstrip().split('\t')
+    if len(columns) < 10 or columns[0] != ctg_name:
+        return None
+    ref_base, alt_base = columns[3].upper(), columns[4].upper()
+    alleles = [ref_base] + alt_base.split(',')
+    if any(len(allele) != 1 for allele in alleles):
+        return None
+    format_list = columns[8].split(':')
+    sample_list = columns[9].split(':')
+    if 'GT' not in format_list:
+        return None
+    genotype = sample_list[format_list.index('GT')]
+    if '|' not in genotype:
+        return None
+    gt1, gt2 = genotype.split('|')[:2]
+    if not gt1.isdigit() or not gt2.isdigit() or gt1 == gt2:
+        return None
+    gt1, gt2 = int(gt1), int(gt2)
+    if gt1 >= len(alleles) or gt2 >= len(alleles):
+        return None
+    phase_set = sample_list[format_list.index('PS')] if 'PS' in format_list and format_list.index('PS') < len(
+        sample_list) else '.'
+    return int(columns[1]), alleles[gt1], alleles[gt2], phase_set
+
+
+class ReadHaplotypeAssigner(object):
+    def __init__(self, phased_vcf_fn, ctg_name, samtools="samtools", tabix="tabix", min_mq=0,
+                 excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG):
+        self.phased_vcf_fn = phased_vcf_fn
+        self.ctg_name = ctg_name
+        self.samtools = samtools
+        self.tabix = tabix
+        self.min_mq = min_mq
+        self.excl_flags = excl_flags
+
+    def phased_snv_rows_from(self, start):
+        """
+        Yield the VCF rows of the contig from start (1-based) on, through the tabix index if there is one.
+        """
+        if os.path.exists(self.phased_vcf_fn + '.tbi') and is_command_exists(self.tabix):
+            vcf_command = "{} {} {}:{}".format(self.tabix, self.phased_vcf_fn, self.ctg_name, max(start, 1))
+        else:
+            vcf_command = "gzip -fdc {}".format(self.phased_vcf_fn)
+        vcf_process = subprocess_popen(shlex.split(vcf_command))
+        try:
+            for row in vcf_process.stdout:
+                if row[0] == '#':
+                    continue
+                yield row
+        finally:
+            vcf_process.stdout.close()
+            vcf_process.wait()
+
+    def read_haplotypes_from(self, sam_rows, strand_suffix=False):
+        """
+        Assign HP to the reads of position sorted SAM rows, return {read_name: 1 or 2} of the tagged reads.
+        strand_suffix: append '_0'/'_1' of the read strand to the read name, the same as the illumina read names in
+        the tensor creation.
+        """
+        hap_dict = {}
+        snv_pos_list = []
+        snv_info_list = []
+        snv_rows = None
+        snv_exhausted = False
+
+        for row in sam_rows:
+            if row[0] == '@':
+                continue
+            columns = row.split('\t', 11)
+            if len(columns) < 11:
+                continue
+            flag = int(columns[1])
+            cigar, seq, qual = columns[5], columns[9], columns[10]
+            if flag & self.excl_flags or int(columns[4]) < self.min_mq or cigar == '*' or seq == '*':
+                continue
+            read_start = int(columns[3])
+            cigar_list = [(int(length), op) for length, op in CIGAR_PATTERN.findall(cigar)]
+            read_end = read_start + sum(length for length, op in cigar_list if op in 'MDN=X')
+
+            if snv_rows is None:
+                snv_rows = self.phased_snv_rows_from(read_start)
+            # reads are sorted by start, the SNVs before it are no longer needed
+            drop_idx = bisect_left(snv_pos_list, read_start)
+            if drop_idx >= SNV_DROP_SIZE:
+                del snv_pos_list[:drop_idx]
+                del snv_info_list[:drop_idx]
+            while not snv_exhausted and (not len(snv_pos_list) or snv_pos_list[-1] < read_end):
+                snv_row = next(snv_rows, None)
+                if snv_row is None:
+                    snv_exhausted = True
+                    break
+                snv = phased_snv_from(snv_row, self.ctg_name)
+                if snv is None or snv[0] < read_start or (len(snv_pos_list) and snv[0] <= snv_pos_list[-1]):
+                    continue
+                snv_pos_list.append(snv[0])
+                snv_info_list.append(snv[1:])
+
+            snv_idx = bisect_left(snv_pos_list, read_start)
+            if snv_idx == len(snv_pos_list) or snv_pos_list[snv_idx] >= read_end:
+                continue
+
+            # phase set: [base quality sum of the hap1 alleles, base quality sum of the hap2 alleles]
+            phase_set_score = defaultdict(lambda: [0, 0])
+            ref_pos, query_pos = read_start, 0
+            for length, op in cigar_list:
+                if op in 'M=X':
+                    while snv_idx < len(snv_pos_list) and snv_pos_list[snv_idx] < ref_pos + length:
+                        snv_pos = snv_pos_list[snv_idx]
+                        if snv_pos >= ref_pos:
+                            hap1_base, hap2_base, phase_set = snv_info_list[snv_idx]
+                            query_idx = query_pos + snv_pos - ref_pos
+                            base = seq[query_idx].upper()
+                            base_quality = 1 if qual == '*' else ord(qual[query_idx]) - 33
+                            if base == hap1_base:
+                                phase_set_score[phase_set][0] += base_quality
+                            elif base == hap2_base:
+                                phase_set_score[phase_set][1] += base_quality
+                        snv_idx += 1
+                    ref_pos += length
+                    query_pos += length
+                elif op in 'IS':
+                    query_pos += length
+                elif op in 'DN':
+                    ref_pos += length
+
+            if not len(phase_set_score):
+                continue
+            hap1_score, hap2_score = max(phase_set_score.values(), key=lambda score: abs(score[0] - score[1]))
+            if hap1_score == hap2_score:
+                continue
+            read_name = columns[0]
+            if strand_suffix:
+                read_name += '_1' if flag & 16 else '_0'
+            hap_dict[read_name] = 1 if hap1_score > hap2_score else 2
+
+        if snv_rows is not None:
+            snv_rows.close()
+        return hap_dict
+
+    def read_haplotypes_of_bam(self, bam_fn, regions, strand_suffix=False):
+        """
+        Assign HP to the reads of a BAM overlapping regions ("ctg:start-end" strings), each read is streamed once.
+        """
+        samtools_view_process = subprocess_popen(shlex.split("{} view -M -F {} -q {} {} {}".format(
+            self.samtools, self.excl_flags, self.min_mq, bam_fn, ' '.join(regions))))
+        hap_dict = self.read_haplotypes_from(samtools_view_process.stdout, strand_suffix=strand_suffix)
+        samtools_view_process.stdout.close()
+        samtools_view_process.wait()
+        return hap_dict
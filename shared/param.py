@@ -91,7 +91,6 @@ apply_focal_loss = True
 discard_germline = False
 add_af_in_label = False
 add_l2_regulation_loss = True
-use_tf = False
 smoothing = None
 somatic_arg_index = 1 if discard_germline else 2
 # label_size = 2
@@ -0,0 +1,272 @@
+"""
+Pileup engines shared by candidate extraction and tensor creation.
+
+Both engines yield one (pos, base_list, raw_base_quality, raw_mapping_quality, read_name_list, phasing_info) tuple
+per covered position, where base_list holds [base, indel] pairs in the samtools `mpileup --reverse-del` alphabet
+(uppercase for forward strand, lowercase for reverse strand, '*'/'#' for forward/reverse deletions, indel as
+'+ACG'/'-NN'), and the qualities are phred+33 strings as in the mpileup text output.
+
+The samtools engine decodes `samtools mpileup` text rows, the pysam engine reads the pileup columns in process with
+htslib and skips the text formatting and re-parsing altogether. pysam is optional and usually only available under
+CPython, the samtools engine is used when it could not be imported.
+"""
+
+import sys
+from functools import partial
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+SAMTOOLS_ENGINE = 'samtools'
+PYSAM_ENGINE = 'pysam'
+PILEUP_ENGINES = (SAMTOOLS_ENGINE, PYSAM_ENGINE)
+
+# samtools mpileup default
+DEFAULT_MAX_DEPTH = 8000
+
+
+def pileup_engine_from(pileup_engine):
+    if pileup_engine == PYSAM_ENGINE and pysam is None:
+        print("[WARNING] pysam is not available, fall back to the samtools pileup engine", file=sys.stderr)
+        return SAMTOOLS_ENGINE
+    return pileup_engine
+
+
+def base_list_from(pileup_bases):
+    """
+    Decode a samtools mpileup base string into [base, indel] pairs, read start/end markers are skipped.
+    """
+    base_idx = 0
+    base_list = []
+    while base_idx < len(pileup_bases):
+        base = pileup_bases[base_idx]
+        if base == '+' or base == '-':
+            base_idx += 1
+            advance = 0
+            while True:
+                num = pileup_bases[base_idx]
+                if num.isdigit():
+                    advance = advance * 10 + int(num)
+                    base_idx += 1
+                else:
+                    break
+            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
+            base_idx += advance - 1
+
+        elif base in "ACGTNacgtn#*":
+            base_list.append([base, ""])
+        elif base == '^':  # start of read, next base is mq, update mq info
+            base_idx += 1
+        # skip $, the end of read
+        base_idx += 1
+    return base_list
+
+
+def base_list_with_read_ends_from(pileup_bases):
+    """
+    Decode a samtools mpileup base string like base_list_from, and also return the base indices at the read start (^)
+    and read end ($) markers. Both markers are recorded at the index of the last base decoded before them, which is the
+    base of the ending read for $.
+    """
+    base_idx = 0
+    base_list = []
+    read_start_set = set()
+    read_end_set = set()
+    while base_idx < len(pileup_bases):
+        base = pileup_bases[base_idx]
+        if base == '+' or base == '-':
+            base_idx += 1
+            advance = 0
+            while True:
+                num = pileup_bases[base_idx]
+                if num.isdigit():
+                    advance = advance * 10 + int(num)
+                    base_idx += 1
+                else:
+                    break
+            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
+            base_idx += advance - 1
+
+        elif base in "ACGTNacgtn#*":
+            base_list.append([base, ""])
+        elif base == '^':  # start of read, next base is mq
+            base_idx += 1
+            read_start_set.add(len(base_list) - 1)
+        elif base == '$':
+            read_end_set.add(len(base_list) - 1)
+        base_idx += 1
+    return base_list, read_start_set, read_end_set
+
+
+def samtools_pileup_columns_from(samtools_mpileup_process, output_mq=False, output_read_name=False,
+                                 output_phasing_info=False, lazy_base_list=False):
+    """
+    Yield pileup columns from the stdout of `samtools mpileup`, the optional columns are in the order of MQ, QNAME and
+    the extra HP tag. With lazy_base_list, a callable returning the base list is yielded instead, so that positions
+    which turn out to be irrelevant are never decoded.
+    """
+    for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ mapping_quality read_name phasing_info
+        columns = row.strip().split('\t')
+        column_idx = 6
+        raw_mapping_quality = None
+        read_name_list = None
+        phasing_info = None
+        if output_mq:
+            raw_mapping_quality = columns[column_idx]
+            column_idx += 1
+        if output_read_name:
+            read_name_list = columns[column_idx].split(',')
+            column_idx += 1
+        if output_phasing_info:
+            phasing_info = columns[column_idx].split(',')
+        base_list = partial(base_list_from, columns[4]) if lazy_base_list else base_list_from(columns[4])
+        yield int(columns[1]), base_list, columns[5], raw_mapping_quality, read_name_list, phasing_info
+
+
+def regions_from(reads_regions, bed_fn=None, ctg_name=None):
+    """
+    Convert samtools style regions ("ctg:start-end", 1-based inclusive) and an optional bed file into sorted and
+    merged (ctg_name, start, end) 0-based half-open regions, the bed regions are intersected with the reads regions.
+    """
+    regions = []
+    for region in reads_regions:
+        if ':' in region:
+            ctg, coordinates = region.rsplit(':', 1)
+            start, end = coordinates.split('-')
+            regions.append((ctg, int(start) - 1, int(end)))
+        else:
+            regions.append((region, 0, None))
+
+    if bed_fn is None:
+        return regions
+
+    bed_regions = []
+    with open(bed_fn) as bed_fp:
+        for row in bed_fp:
+            columns = row.strip().split()
+            if len(columns) < 3 or (ctg_name is not None and columns[0] != ctg_name):
+                continue
+            bed_regions.append((columns[0], int(columns[1]), int(columns[2])))
+    bed_regions.sort()
+
+    merged_regions = []
+    for ctg, start, end in bed_regions:
+        if len(merged_regions) and merged_regions[-1][0] == ctg and start <= merged_regions[-1][2]:
+            merged_regions[-1][2] = max(end, merged_regions[-1][2])
+        else:
+            merged_regions.append([ctg, start, end])
+
+    if len(regions) == 0:
+        return [tuple(region) for region in merged_regions]
+    intersected_regions = []
+    for ctg, start, end in merged_regions:
+        for region_ctg, region_start, region_end in regions:
+            if ctg != region_ctg:
+                continue
+            region_end = end if region_end is None else region_end
+            if max(start, region_start) < min(end, region_end):
+                intersected_regions.append((ctg, max(start, region_start), min(end, region_end)))
+    return intersected_regions
+
+
+def padded_regions_from(regions, padding):
+    """
+    Extend (ctg_name, start, end) regions by padding bp on both sides, overlapping regions are merged.
+    """
+    padded_regions = []
+    for ctg_name, start, end in sorted(regions, key=lambda region: (region[0], region[1])):
+        start = max(start - padding, 0)
+        end = end + padding if end is not None else None
+        if len(padded_regions) and padded_regions[-1][0] == ctg_name and (
+                padded_regions[-1][2] is None or start <= padded_regions[-1][2]):
+            padded_regions[-1][2] = None if end is None or padded_regions[-1][2] is None else max(end, padded_regions[-1][2])
+        else:
+            padded_regions.append([ctg_name, start, end])
+    return [tuple(region) for region in padded_regions]
+
+
+def pysam_pileup_columns_from(bam_fn, regions, min_mq, min_bq, excl_flags, max_depth=None, output_mq=False,
+                              output_read_name=False, output_phasing_info=False, lazy_base_list=False):
+    """
+    Yield pileup columns of (ctg_name, start, end) regions with pysam, filtered in the same way as `samtools mpileup
+    --reverse-del --min-MQ --min-BQ --excl-flags` without a reference (no BAQ). pysam columns are only valid until
+    the iterator advances, so lazy_base_list only wraps the decoded list for interface compatibility.
+    """
+    with pysam.AlignmentFile(bam_fn, 'rb') as bam_file:
+        for ctg_name, start, end in regions:
+            for column in bam_file.pileup(ctg_name,
+                                          start,
+                                          end,
+                                          truncate=True,
+                                          stepper='samtools',
+                                          compute_baq=False,
+                                          min_base_quality=min_bq,
+                                          min_mapping_quality=min_mq,
+                                          flag_filter=excl_flags,
+                                          max_depth=max_depth if max_depth is not None else DEFAULT_MAX_DEPTH):
+                # column level accessors decode only the pileup base of each read instead of the whole read sequence
+                query_sequences = column.get_query_sequences(mark_matches=False, mark_ends=False, add_indels=True)
+                query_qualities = column.get_query_qualities()
+                base_list = []
+                base_quality = []
+                mapping_quality = []
+                read_name_list = []
+                phasing_info = []
+                for pileup_read, query_sequence, query_quality in zip(column.pileups, query_sequences, query_qualities):
+                    if pileup_read.is_refskip:
+                        continue
+                    alignment = pileup_read.alignment
+                    is_reverse = alignment.is_reverse
+                    if pileup_read.is_del:
+                        base = '#' if is_reverse else '*'
+                    else:
+                        base = query_sequence[0].lower() if is_reverse else query_sequence[0].upper()
+
+                    indel = ""
+                    if pileup_read.indel > 0:
+                        insertion = query_sequence[-pileup_read.indel:]
+                        indel = '+' + (insertion.lower() if is_reverse else insertion.upper())
+                    elif pileup_read.indel < 0:
+                        indel = '-' + ('n' if is_reverse else 'N') * -pileup_read.indel
+                    base_list.append([base, indel])
+
+                    base_quality.append(chr(min(query_quality, 93) + 33))
+                    if output_mq:
+                        mapping_quality.append(chr(min(alignment.mapping_quality, 93) + 33))
+                    if output_read_name:
+                        read_name_list.append(alignment.query_name)
+                    if output_phasing_info:
+                        phasing_info.append(str(alignment.get_tag('HP')) if alignment.has_tag('HP') else '*')
+
+                if len(base_list) == 0:
+                    continue
+                if lazy_base_list:
+                    base_list = partial(list, base_list)
+                yield column.reference_pos + 1, base_list, ''.join(base_quality), \
+                    ''.join(mapping_quality) if output_mq else None, \
+                    read_name_list if output_read_name else None, \
+                    phasing_info if output_phasing_info else None
+
+
+def paired_pileup_columns_from(tumor_pileup_columns, normal_pileup_columns):
+    """
+    Merge the tumor and normal pileup columns of the same region by position, yield (pos, tumor_column, normal_column)
+    with None for the side without any coverage at pos.
+    """
+    tumor_pileup_columns = iter(tumor_pileup_columns)
+    normal_pileup_columns = iter(normal_pileup_columns)
+    tumor_column = next(tumor_pileup_columns, None)
+    normal_column = next(normal_pileup_columns, None)
+    while tumor_column is not None or normal_column is not None:
+        if normal_column is None or (tumor_column is not None and tumor_column[0] < normal_column[0]):
+            yield tumor_column[0], tumor_column, None
+            tumor_column = next(tumor_pileup_columns, None)
+        elif tumor_column is None or normal_column[0] < tumor_column[0]:
+            yield normal_column[0], None, normal_column
+            normal_column = next(normal_pileup_columns, None)
+        else:
+            yield tumor_column[0], tumor_column, normal_column
+            tumor_column = next(tumor_pileup_columns, None)
+            normal_column = next(normal_pileup_columns, None)
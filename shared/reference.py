@@ -0,0 +1,190 @@
+"""
+Reference store shared by all processes of a run.
+
+The FASTA is converted once into one uppercase byte per base without line breaks, with the contigs concatenated in a
+`.seq` file and their offsets and lengths in a `.idx` file. Each process memory-maps the `.seq` file, so that the pages
+are shared by all processes through the page cache and a region of the reference is a slice of the map instead of a
+`samtools faidx` subprocess.
+
+run_clairs builds the store and exports its directory in REFERENCE_STORE_ENV, `reference_sequence_from` then reads the
+reference of the same FASTA from the store and falls back to `samtools faidx` otherwise. The `.idx` header keeps the
+size and modification time of the FASTA, so that a store of a changed FASTA is not used.
+
+Only the standard library is used, so that the pypy submodules can use it.
+"""
+
+import os
+import re
+import gzip
+import mmap
+
+REFERENCE_STORE_ENV = 'CLAIRS_REFERENCE_STORE'
+SEQ_SUFFIX = '.seq'
+IDX_SUFFIX = '.idx'
+
+UPPERCASE_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+LINE_BREAKS = b'\r\n'
+# lines of a contig copied at a time when converting a FASTA with a .fai index
+COPY_LINES = 1 << 20
+
+REGION_PATTERN = re.compile(r'^(.+):(\d+)(?:-(\d+))?$')
+
+# fasta_file_path: ReferenceStore or None, the stores opened by this process
+reference_store_dict = {}
+
+
+def store_prefix_from(store_dir, fasta_file_path):
+    return os.path.join(store_dir, os.path.basename(fasta_file_path))
+
+
+def fasta_stamp_from(fasta_file_path):
+    fasta_stat = os.stat(fasta_file_path)
+    return '#{}\t{}\t{}'.format(os.path.abspath(fasta_file_path), fasta_stat.st_size, int(fasta_stat.st_mtime))
+
+
+def contig_sequences_from_fai(fasta_file_path, fai_fn):
+    """
+    Yield (contig_name, sequence blocks) of a plain FASTA, copying whole blocks of lines located by the .fai index.
+    """
+    with open(fai_fn) as fai_fp:
+        fai_rows = [row.rstrip('\n').split('\t') for row in fai_fp if row.strip()]
+    with open(fasta_file_path, 'rb') as fasta_fp:
+        for columns in fai_rows:
+            contig_name, contig_length, offset, line_bases, line_width = columns[0], int(columns[1]), int(
+                columns[2]), int(columns[3]), int(columns[4])
+
+            def blocks():
+                fasta_fp.seek(offset)
+                remaining_bases = contig_length
+                while remaining_bases > 0:
+                    block = fasta_fp.read(min(COPY_LINES * line_width, (remaining_bases // line_bases + 1) * line_width))
+                    block = block.translate(UPPERCASE_TABLE, LINE_BREAKS)[:remaining_bases]
+                    if not len(block):
+                        break
+                    remaining_bases -= len(block)
+                    yield block
+
+            yield contig_name, blocks()
+
+
+def contig_sequences_from_text(fasta_file_path):
+    """
+    Yield (contig_name, sequence blocks) of a (gzipped) FASTA without a usable .fai index, line by line.
+    """
+    fasta_fp = gzip.open(fasta_file_path, 'rb') if fasta_file_path.endswith('.gz') else open(fasta_file_path, 'rb')
+    with fasta_fp:
+        contig_name = None
+        lines = []
+        for row in fasta_fp:
+            if row.startswith(b'>'):
+                if contig_name is not None:
+                    yield contig_name, iter(lines)
+                contig_name = row[1:].split()[0].decode()
+                lines = []
+            else:
+                lines.append(row.translate(UPPERCASE_TABLE, LINE_BREAKS))
+        if contig_name is not None:
+            yield contig_name, iter(lines)
+
+
+def build_reference_store(fasta_file_path, store_dir):
+    """
+    Convert the FASTA into the store in store_dir, unless the store of the same FASTA is already there. Return the
+    store prefix.
+    """
+    store_prefix = store_prefix_from(store_dir, fasta_file_path)
+    fasta_stamp = fasta_stamp_from(fasta_file_path)
+    if os.path.exists(store_prefix + IDX_SUFFIX) and os.path.exists(store_prefix + SEQ_SUFFIX):
+        with open(store_prefix + IDX_SUFFIX) as idx_fp:
+            if idx_fp.readline().rstrip('\n') == fasta_stamp:
+                return store_prefix
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    fai_fn = fasta_file_path + '.fai'
+    if not fasta_file_path.endswith('.gz') and os.path.exists(fai_fn):
+        contig_sequences = contig_sequences_from_fai(fasta_file_path, fai_fn)
+    else:
+        contig_sequences = contig_sequences_from_text(fasta_file_path)
+
+    idx_rows = []
+    offset = 0
+    with open(store_prefix + SEQ_SUFFIX + '.tmp', 'wb') as seq_fp:
+        for contig_name, blocks in contig_sequences:
+            contig_length = 0
+            for block in blocks:
+                seq_fp.write(block)
+                contig_length += len(block)
+            idx_rows.append('{}\t{}\t{}'.format(contig_name, offset, contig_length))
+            offset += contig_length
+    os.rename(store_prefix + SEQ_SUFFIX + '.tmp', store_prefix + SEQ_SUFFIX)
+    # the index is written last, a store is only complete once its index is there
+    with open(store_prefix + IDX_SUFFIX + '.tmp', 'w') as idx_fp:
+        idx_fp.write('\n'.join([fasta_stamp] + idx_rows) + '\n')
+    os.rename(store_prefix + IDX_SUFFIX + '.tmp', store_prefix + IDX_SUFFIX)
+    return store_prefix
+
+
+class ReferenceStore(object):
+    def __init__(self, store_prefix):
+        self.contig_dict = {}
+        with open(store_prefix + IDX_SUFFIX) as idx_fp:
+            self.fasta_stamp = idx_fp.readline().rstrip('\n')
+            for row in idx_fp:
+                contig_name, offset, contig_length = row.rstrip('\n').split('\t')
+                self.contig_dict[contig_name] = (int(offset), int(contig_length))
+        self.seq_fp = open(store_prefix + SEQ_SUFFIX, 'rb')
+        self.seq_map = mmap.mmap(self.seq_fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(
+            store_prefix + SEQ_SUFFIX) else b''
+
+    def sequence_of(self, region):
+        """
+        Return the uppercase sequence of a samtools style region ("ctg", "ctg:start" or "ctg:start-end", 1-based
+        inclusive) clipped to the contig as `samtools faidx` does, or None if the contig is not in the store.
+        """
+        contig_name, start, end = region, 1, None
+        if region not in self.contig_dict:
+            match = REGION_PATTERN.match(region)
+            if match is None:
+                return None
+            contig_name, start, end = match.group(1), int(match.group(2)), match.group(3)
+            end = int(end) if end is not None else None
+        if contig_name not in self.contig_dict:
+            return None
+        offset, contig_length = self.contig_dict[contig_name]
+        start = max(start, 1)
+        end = contig_length if end is None else min(end, contig_length)
+        if start > end:
+            return ""
+        return self.seq_map[offset + start - 1: offset + end].decode()
+
+
+def reference_store_from(fasta_file_path):
+    """
+    Return the store of the FASTA exported by run_clairs, or None if there is no store of the same FASTA.
+    """
+    if fasta_file_path in reference_store_dict:
+        return reference_store_dict[fasta_file_path]
+    reference_store = None
+    store_dir = os.environ.get(REFERENCE_STORE_ENV)
+    if store_dir is not None:
+        store_prefix = store_prefix_from(store_dir, fasta_file_path)
+        if os.path.exists(store_prefix + IDX_SUFFIX) and os.path.exists(fasta_file_path):
+            reference_store = ReferenceStore(store_prefix)
+            if reference_store.fasta_stamp != fasta_stamp_from(fasta_file_path):
+                reference_store = None
+    reference_store_dict[fasta_file_path] = reference_store
+    return reference_store
+
+
+def stored_reference_sequence_from(fasta_file_path, regions):
+    """
+    Return the concatenated uppercase sequence of the regions from the store, or None if it is not available.
+    """
+    reference_store = reference_store_from(fasta_file_path)
+    if reference_store is None:
+        return None
+    sequences = [reference_store.sequence_of(region) for region in regions]
+    if any(sequence is None for sequence in sequences):
+        return None
+    return "".join(sequences)
@@ -0,0 +1,101 @@
+"""
+Dynamic splitting of the running chunks, shared by the chunk scheduler (src/schedule_chunks.py) and the chunked steps.
+
+A running chunk reports the position it has reached to its control prefix, and the scheduler asks a straggler chunk to
+end earlier by writing a split position once a worker is idle and no chunk is left to start. The chunk accepts the
+split if it has not reached the split position yet, then it ends at the split position and the scheduler runs the rest
+of its range as a new chunk. The files are replaced atomically, so that neither side reads a partial position.
+
+    <control_prefix>.progress    "pos end", written by the chunk
+    <control_prefix>.split       "split_pos", written by the scheduler
+    <control_prefix>.ack         "end", written by the chunk once it has read the split, the split is accepted if
+                                 the end equals the split position
+
+Only the standard library is used, so that the pypy chunks can use it.
+"""
+
+import os
+from time import time
+
+PROGRESS_SUFFIX = '.progress'
+SPLIT_SUFFIX = '.split'
+ACK_SUFFIX = '.ack'
+
+# positions between two checks of the split and the time, and seconds between two reports of a chunk. The tensor
+# creation chunks check at every candidate, a chunk may have only a few hundred candidates
+CHECK_STRIDE = 1000
+CANDIDATE_CHECK_STRIDE = 1
+REPORT_INTERVAL = 2
+
+
+def write_atomically(fn, content):
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        f.write(content)
+    os.rename(tmp_fn, fn)
+
+
+def ints_from(fn):
+    """
+    Return the integers of a control file, or None if the file does not exist.
+    """
+    try:
+        with open(fn) as f:
+            return [int(item) for item in f.read().split()]
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class ChunkRangeControl(object):
+    def __init__(self, control_prefix, ctg_end, check_stride=CHECK_STRIDE, report_interval=REPORT_INTERVAL):
+        self.control_prefix = control_prefix
+        self.ctg_end = ctg_end
+        self.check_stride = check_stride
+        self.report_interval = report_interval
+        self.position_count = 0
+        self.last_report_time = time()
+
+    def end_at(self, pos):
+        """
+        Return the current end (1-based, inclusive) of the chunk once pos is reached, the positions need to be
+        non-decreasing. A pending split is accepted or rejected every check_stride positions, and the progress is
+        reported at most every report_interval seconds.
+        """
+        self.position_count += 1
+        if self.position_count % self.check_stride:
+            return self.ctg_end
+
+        split_fn = self.control_prefix + SPLIT_SUFFIX
+        is_split_read = False
+        if os.path.exists(split_fn):
+            split = ints_from(split_fn)
+            os.remove(split_fn)
+            if split is not None and len(split) and pos < split[0] < self.ctg_end:
+                self.ctg_end = split[0]
+            write_atomically(self.control_prefix + ACK_SUFFIX, '{}\n'.format(self.ctg_end))
+            is_split_read = True
+
+        current_time = time()
+        if is_split_read or current_time - self.last_report_time >= self.report_interval:
+            self.last_report_time = current_time
+            write_atomically(self.control_prefix + PROGRESS_SUFFIX, '{} {}\n'.format(pos, self.ctg_end))
+        return self.ctg_end
+
+
+def chunk_range_control_from(control_prefix, ctg_end, check_stride=CHECK_STRIDE):
+    """
+    Return the control of a chunk ending at ctg_end, or None if the chunk is not run by the scheduler.
+    """
+    if control_prefix is None or ctg_end is None:
+        return None
+    return ChunkRangeControl(control_prefix=control_prefix, ctg_end=ctg_end, check_stride=check_stride)
+
+
+def candidate_center_from(row):
+    """
+    Return (ctg_name, center) of a candidates bed row, the same center as in the tensor creation.
+    """
+    columns = row.rstrip().split('\t')
+    position = int(columns[1]) + 1
+    end = int(columns[2]) + 1
+    return columns[0], position + (end - position) // 2 - 1
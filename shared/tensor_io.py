@@ -0,0 +1,168 @@
+"""
+Binary tensor format shared by the tensor creation submodules and predict.
+
+A tensor file starts with an 8-byte magic and a 1-byte format version, followed by records:
+    record header (RECORD_HEADER)
+    ctg_name, ref_seq, normal_alt_info, tumor_alt_info, variant_type (utf-8, lengths in the header)
+    normal tensor block, normal_rows x normal_cols little-endian cells of the header dtype
+    tumor tensor block, tumor_rows x tumor_cols little-endian cells of the header dtype
+
+Writing only relies on the standard library so that pypy tensor creators can use it, the reader yields the raw
+buffer and block offsets, which predict decodes with np.frombuffer without any per-cell parsing.
+"""
+
+import sys
+import mmap
+import struct
+from array import array
+
+BINARY_TENSOR_MAGIC = b'CLAIRSBT'
+BINARY_TENSOR_VERSION = 1
+
+# pos, dtype, normal_rows, normal_cols, tumor_rows, tumor_cols, and the byte length of ctg_name, ref_seq,
+# normal_alt_info, tumor_alt_info and variant_type
+RECORD_HEADER = struct.Struct('<IBHHHHIIIII')
+
+INT8 = 1
+INT16 = 2
+ARRAY_TYPECODE = {INT8: 'b', INT16: 'h'}
+NUMPY_DTYPE = {INT8: '<i1', INT16: '<i2'}
+DTYPE_RANGE = {INT8: (-128, 127), INT16: (-32768, 32767)}
+DTYPE_SIZE = {INT8: 1, INT16: 2}
+
+
+class BinaryTensorWriter(object):
+    def __init__(self, tensor_fn, dtype=INT16):
+        self.tensor_fn = tensor_fn
+        self.dtype = dtype
+        self.typecode = ARRAY_TYPECODE[dtype]
+        if tensor_fn == "PIPE":
+            self.tensor_writer = sys.stdout.buffer
+        else:
+            self.tensor_writer = open(tensor_fn, 'wb')
+        self.tensor_writer.write(BINARY_TENSOR_MAGIC + struct.pack('<B', BINARY_TENSOR_VERSION))
+
+    def close(self):
+        if self.tensor_fn == "PIPE":
+            self.tensor_writer.flush()
+            return
+        try:
+            self.tensor_writer.close()
+        except:
+            pass
+
+    def tensor_array_from(self, rows):
+        """
+        Flatten a list of equal-length integer rows into a little-endian array of the writer dtype.
+        """
+        tensor_array = array(self.typecode)
+        try:
+            for row in rows:
+                tensor_array.extend(row)
+        except OverflowError:
+            # extremely high depth pileup counts, clip to the dtype range
+            min_value, max_value = DTYPE_RANGE[self.dtype]
+            tensor_array = array(self.typecode)
+            for row in rows:
+                tensor_array.extend([min(max(item, min_value), max_value) for item in row])
+        if sys.byteorder != 'little':
+            tensor_array.byteswap()
+        return tensor_array
+
+    def write_row(self,
+                  ctg_name,
+                  pos,
+                  ref_seq,
+                  normal_tensor,
+                  normal_alt_info,
+                  tumor_tensor,
+                  tumor_alt_info,
+                  variant_type,
+                  normal_cols=None,
+                  tumor_cols=None):
+        """
+        normal_tensor/tumor_tensor: list of integer rows (one row per pileup position or per read), or a flattened
+        array of the writer dtype together with the number of columns in normal_cols/tumor_cols.
+        """
+        if normal_cols is None:
+            normal_cols = len(normal_tensor[0]) if len(normal_tensor) else 0
+            normal_tensor = self.tensor_array_from(normal_tensor)
+        if tumor_cols is None:
+            tumor_cols = len(tumor_tensor[0]) if len(tumor_tensor) else 0
+            tumor_tensor = self.tensor_array_from(tumor_tensor)
+        normal_rows = len(normal_tensor) // normal_cols if normal_cols else 0
+        tumor_rows = len(tumor_tensor) // tumor_cols if tumor_cols else 0
+
+        strings = [item.encode() for item in (ctg_name, ref_seq, normal_alt_info, tumor_alt_info, variant_type)]
+        header = RECORD_HEADER.pack(pos, self.dtype, normal_rows, normal_cols, tumor_rows, tumor_cols,
+                                    *[len(item) for item in strings])
+        self.tensor_writer.write(header)
+        self.tensor_writer.write(b''.join(strings))
+        self.tensor_writer.write(normal_tensor.tobytes())
+        self.tensor_writer.write(tumor_tensor.tobytes())
+
+
+def is_binary_tensor_file(tensor_fn):
+    try:
+        with open(tensor_fn, 'rb') as f:
+            return f.read(len(BINARY_TENSOR_MAGIC)) == BINARY_TENSOR_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def records_from_buffer(buffer, offset):
+    buffer_size = len(buffer)
+    while offset + RECORD_HEADER.size <= buffer_size:
+        header = RECORD_HEADER.unpack_from(buffer, offset)
+        pos, dtype, normal_rows, normal_cols, tumor_rows, tumor_cols = header[:6]
+        offset += RECORD_HEADER.size
+        strings = []
+        for string_length in header[6:]:
+            strings.append(bytes(buffer[offset: offset + string_length]).decode())
+            offset += string_length
+        ctg_name, ref_seq, normal_alt_info, tumor_alt_info, variant_type = strings
+        normal_offset = offset
+        offset += normal_rows * normal_cols * DTYPE_SIZE[dtype]
+        tumor_offset = offset
+        offset += tumor_rows * tumor_cols * DTYPE_SIZE[dtype]
+        yield (ctg_name, pos, ref_seq, normal_alt_info, tumor_alt_info, variant_type, dtype, buffer,
+               normal_offset, (normal_rows, normal_cols), tumor_offset, (tumor_rows, tumor_cols))
+
+
+def records_from_stream(stream):
+    while True:
+        header_bytes = stream.read(RECORD_HEADER.size)
+        if len(header_bytes) < RECORD_HEADER.size:
+            return
+        header = RECORD_HEADER.unpack(header_bytes)
+        dtype, normal_rows, normal_cols, tumor_rows, tumor_cols = header[1:6]
+        record_size = sum(header[6:]) + (normal_rows * normal_cols + tumor_rows * tumor_cols) * DTYPE_SIZE[dtype]
+        record_bytes = header_bytes + stream.read(record_size)
+        for record in records_from_buffer(record_bytes, 0):
+            yield record
+
+
+def binary_tensor_generator_from(tensor_fn, tensor_fp=None):
+    """
+    Yield (ctg_name, pos, ref_seq, normal_alt_info, tumor_alt_info, variant_type, dtype, buffer, normal_offset,
+    normal_shape, tumor_offset, tumor_shape) for each record, tensor blocks stay in the (memory-mapped) buffer.
+    tensor_fp: binary stream to read from instead of tensor_fn, e.g. the stdout of a tensor creation process.
+    """
+    header_size = len(BINARY_TENSOR_MAGIC) + 1
+    if tensor_fn == "PIPE" or tensor_fp is not None:
+        stream = sys.stdin.buffer if tensor_fp is None else tensor_fp
+        if stream.read(header_size)[:len(BINARY_TENSOR_MAGIC)] != BINARY_TENSOR_MAGIC:
+            sys.exit("[ERROR] Invalid binary tensor input from stream")
+        for record in records_from_stream(stream):
+            yield record
+        return
+
+    with open(tensor_fn, 'rb') as f:
+        if f.read(len(BINARY_TENSOR_MAGIC)) != BINARY_TENSOR_MAGIC:
+            sys.exit("[ERROR] Invalid binary tensor file {}".format(tensor_fn))
+        f.seek(0, 2)
+        if f.tell() <= header_size:
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    for record in records_from_buffer(buffer, header_size):
+        yield record
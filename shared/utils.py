@@ -10,6 +10,8 @@ from subprocess import PIPE
 from os.path import isfile, isdir
 from textwrap import dedent
 
+from shared.reference import stored_reference_sequence_from
+
 IUPAC_base_to_ACGT_base_dict = dict(zip(
     "ACGTURYSWKMBDHVN",
     ("A", "C", "G", "T", "T", "A", "C", "C", "A", "G", "A", "C", "A", "A", "A", "A")
@@ -148,6 +150,11 @@ def region_from(ctg_name, ctg_start=None, ctg_end=None):
     return "{}:{}-{}".format(ctg_name, ctg_start, ctg_end)
 
 def reference_sequence_from(samtools_execute_command, fasta_file_path, regions):
+    # the memory-mapped reference store of run_clairs, if there is one for the FASTA
+    reference_sequence = stored_reference_sequence_from(fasta_file_path=fasta_file_path, regions=regions)
+    if reference_sequence is not None:
+        return reference_sequence
+
     refernce_sequences = []
     region_value_for_faidx = " ".join(regions)
 
@@ -0,0 +1,415 @@
+"""
+Task graph runner of the run_clairs steps.
+
+Each step command belongs to a branch (e.g. pileup, full_alignment), a step depends on the previous step of its branch
+and on all steps of the branches its branch depends on. Steps whose dependencies are done are started in the order
+of the step index, up to max_concurrent_steps at a time, so that the steps run in the original order if only one step
+is allowed at a time.
+
+A completion marker with the fingerprint of the step is written once a step succeeds. The fingerprint covers the
+command, the size and modification time of its input files outside of the output directory and the fingerprints of
+its dependencies, so that a step is stale once any of them changes.
+
+The files in the output directory are tracked by the outputs record written whenever a step ends: the size and
+modification time of each file in the output directory referenced by the step command, and by each succeeded job
+(chunk) of its GNU parallel joblogs, a referenced path which does not exist stands for the files named <path>.*. The
+referenced files are both the outputs of the step and the outputs of the upstream steps it reads. With resume:
+
+    - a step with the same fingerprint and all its files and job files unchanged is skipped
+    - a GNU parallel step with the same fingerprint and unchanged step files re-runs only its failed and missing jobs,
+      and the jobs any file of which was removed or changed since (e.g. rewritten by a re-run upstream job): the stale
+      jobs are dropped from the joblogs, so that GNU parallel --resume-failed runs them again and skips the others
+    - any other step is run again, a step without joblogs is also run again once one of its dependencies was run
+    - the jobs of a step interrupted before its outputs record was written are kept if their files are not newer
+      than the end of the job in the joblog
+
+The logs and the workflow directories are not tracked.
+
+With share_threads, the GNU parallel steps running at the same time share the thread budget instead of each running
+threads jobs: the `-j threads` (or `-j command_threads`) of a step is replaced by a procfile holding its share, which GNU parallel re-reads
+whenever a job finishes, and the shares are rebalanced whenever a step starts or finishes.
+
+A step is run with `bash -o pipefail`, so that a failed job of a `( parallel ... ) 2>&1 | tee <log>` step fails the
+step instead of being hidden by tee. The steps of the branches in tolerant_branches keep the plain `bash -c` exit
+status of the previous runs (the exit status of the last command of the step), as their chunk failures are expected
+(e.g. the phasing and haplotagging of a contig without heterozygous or phased variants).
+
+With keep_going, a failed step only blocks the steps depending on it, the independent steps (e.g. the steps of other
+samples in a cohort run) are still started.
+"""
+
+import os
+import re
+import json
+import shlex
+import hashlib
+import subprocess
+from collections import namedtuple, defaultdict
+from time import sleep
+
+WorkflowStep = namedtuple('WorkflowStep', ['index', 'echo', 'command', 'branch', 'dependencies', 'pipefail'])
+
+JOBLOG_PATTERN = re.compile(r' --joblog (\S+)')
+DONE_SUFFIX = '.done'
+STARTED_SUFFIX = '.started'
+JOBS_SUFFIX = '.jobs'
+OUTPUTS_SUFFIX = '.outputs'
+UNTRACKED_DIR_NAMES = {'logs'}
+# seconds a file of an interrupted job may be newer than the end of the job in the joblog
+JOB_END_SLACK = 1
+
+
+def path_items_from(command):
+    """
+    Absolute paths in a command, as a token or as the value of a key=value token.
+    """
+    try:
+        tokens = shlex.split(command.replace('(', ' ').replace(')', ' '))
+    except ValueError:
+        tokens = command.split()
+    for token in tokens:
+        for item in token.split('=') if '=' in token else [token]:
+            if item.startswith('/'):
+                yield item
+
+
+def stamp_of(path):
+    """
+    [size, modification time in ns] of a file, or None if it does not exist.
+    """
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def joblog_rows_from(joblog_fn):
+    """
+    Return the header and {seq: [rows]} of a GNU parallel joblog, the last row of a seq is its latest run.
+    """
+    header, seq_rows = None, defaultdict(list)
+    with open(joblog_fn) as f:
+        for row in f:
+            if header is None:
+                header = row
+                continue
+            columns = row.rstrip('\n').split('\t', 8)
+            if len(columns) < 9:
+                continue
+            seq_rows[columns[0]].append(row)
+    return header, seq_rows
+
+
+def job_of(row):
+    """
+    Return (succeeded, end time, command) of a joblog row.
+    """
+    seq, host, start_time, job_runtime, send, receive, exit_value, signal, command = row.rstrip('\n').split('\t', 8)
+    return exit_value == '0' and signal == '0', float(start_time) + float(job_runtime), command
+
+
+def workflow_steps_from(commands_list, echo_list, branch_list, branch_dependencies, tolerant_branches=()):
+    """
+    Build the steps from the index-aligned commands_list, echo_list and branch_list.
+    branch_dependencies: {branch: [branches all steps of which need to be done before any step of the branch]}
+    tolerant_branches: branches the steps of which are run without pipefail, a failed piped job does not fail the step
+    """
+    branch_step_dict = defaultdict(list)
+    for index, branch in enumerate(branch_list):
+        branch_step_dict[branch].append(index)
+
+    steps = []
+    for index, (command, echo, branch) in enumerate(zip(commands_list, echo_list, branch_list)):
+        dependencies = set()
+        previous_steps = [idx for idx in branch_step_dict[branch] if idx < index]
+        if len(previous_steps):
+            dependencies.add(previous_steps[-1])
+        for dependency_branch in branch_dependencies.get(branch, []):
+            dependencies.update(branch_step_dict[dependency_branch])
+        steps.append(WorkflowStep(index, echo, command, branch, sorted(dependencies),
+                                  pipefail=branch not in tolerant_branches))
+    return steps
+
+
+class WorkflowRunner(object):
+    def __init__(self, workflow_dir, output_dir, logging=print, stdout=None, max_concurrent_steps=1, resume=False,
+                 threads=None, share_threads=False, keep_going=False, command_threads=None):
+        self.workflow_dir = os.path.abspath(workflow_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.logging = logging
+        self.stdout = stdout
+        self.max_concurrent_steps = max(max_concurrent_steps, 1)
+        self.resume = resume
+        self.threads = threads
+        self.share_threads = share_threads and threads is not None
+        self.keep_going = keep_going
+        # the `-j` of the GNU parallel steps in the commands, the threads unless the commands use a share of them
+        self.jobs_pattern = re.compile(r' -j {}(?= )'.format(threads if command_threads is None else command_threads))
+        self.fingerprint_dict = {}
+        # step index: procfile of the running GNU parallel steps sharing the threads
+        self.jobs_fn_dict = {}
+        # indexes of the steps run (fully or partially) by this runner
+        self.ran_steps = set()
+        # indexes of the failed steps and of the steps not run because a dependency failed
+        self.failed_steps = set()
+        self.blocked_steps = set()
+        if not os.path.exists(workflow_dir):
+            os.makedirs(workflow_dir)
+
+    def marker_prefix_of(self, step):
+        return os.path.join(self.workflow_dir, 'step_{}'.format(step.index + 1))
+
+    def input_files_of(self, step):
+        """
+        Existing files in the command outside of the output directory, the files in the output directory are tracked
+        by the outputs records.
+        """
+        input_files = set()
+        for item in path_items_from(step.command):
+            if not os.path.isfile(item):
+                continue
+            if os.path.abspath(item).startswith(self.output_dir + os.sep):
+                continue
+            input_files.add(item)
+        return sorted(input_files)
+
+    def is_tracked(self, path):
+        if not path.startswith(self.output_dir + os.sep) or path.startswith(self.workflow_dir + os.sep):
+            return False
+        return not any(name in UNTRACKED_DIR_NAMES for name in os.path.relpath(path, self.output_dir).split(os.sep))
+
+    def tracked_stamps_of(self, command, listdir_dict):
+        """
+        {path: stamp} of the files in the output directory referenced by a command, directories are not tracked.
+        """
+        stamps = {}
+        for item in path_items_from(command):
+            path = os.path.normpath(os.path.abspath(item))
+            if '{' in path or not self.is_tracked(path) or os.path.isdir(path):
+                continue
+            stamp = stamp_of(path)
+            if stamp is not None:
+                stamps[path] = stamp
+                continue
+            dir_name, prefix = os.path.split(path)
+            if dir_name not in listdir_dict:
+                listdir_dict[dir_name] = os.listdir(dir_name) if os.path.isdir(dir_name) else []
+            prefixed_files = [os.path.join(dir_name, fn) for fn in listdir_dict[dir_name] if fn.startswith(prefix + '.')]
+            for fn in prefixed_files:
+                stamps[fn] = stamp_of(fn)
+            if not len(prefixed_files):
+                stamps[path] = None
+        return stamps
+
+    def joblogs_of(self, step):
+        return [os.path.abspath(joblog_fn) for joblog_fn in JOBLOG_PATTERN.findall(step.command)]
+
+    def write_outputs(self, step, fingerprint):
+        """
+        Record the files of the step and of each succeeded job in its joblogs.
+        """
+        listdir_dict = {}
+        outputs = {'fingerprint': fingerprint,
+                   'files': self.tracked_stamps_of(step.command, listdir_dict),
+                   'jobs': {}}
+        for joblog_fn in self.joblogs_of(step):
+            if not os.path.exists(joblog_fn):
+                continue
+            job_stamps = {}
+            for seq, rows in joblog_rows_from(joblog_fn)[1].items():
+                succeeded, _, command = job_of(rows[-1])
+                if succeeded:
+                    job_stamps[seq] = self.tracked_stamps_of(command, listdir_dict)
+            outputs['jobs'][joblog_fn] = job_stamps
+        with open(self.marker_prefix_of(step) + OUTPUTS_SUFFIX, 'w') as f:
+            json.dump(outputs, f)
+
+    def outputs_of(self, step, fingerprint):
+        outputs_fn = self.marker_prefix_of(step) + OUTPUTS_SUFFIX
+        if not os.path.exists(outputs_fn):
+            return None
+        try:
+            with open(outputs_fn) as f:
+                outputs = json.load(f)
+        except ValueError:
+            return None
+        return outputs if outputs.get('fingerprint') == fingerprint else None
+
+    def is_job_current(self, row, recorded_stamps, listdir_dict):
+        succeeded, end_time, command = job_of(row)
+        if not succeeded:
+            return True
+        if recorded_stamps is not None:
+            return all(stamp_of(path) == stamp for path, stamp in recorded_stamps.items())
+        # a job of an interrupted run, kept if its files are not newer than the end of the job
+        stamps = self.tracked_stamps_of(command, listdir_dict)
+        return all(stamp is None or stamp[1] <= (end_time + JOB_END_SLACK) * 1e9 for stamp in stamps.values())
+
+    def prune_stale_jobs(self, step, outputs):
+        """
+        Drop the jobs with a removed or changed file from the joblogs of the step, return the number of jobs to be
+        run by --resume-failed.
+        """
+        listdir_dict = {}
+        jobs_to_run = 0
+        for joblog_fn in self.joblogs_of(step):
+            header, seq_rows = joblog_rows_from(joblog_fn)
+            job_stamps = outputs['jobs'].get(joblog_fn, {}) if outputs is not None else {}
+            kept_rows = []
+            for seq, rows in seq_rows.items():
+                if self.is_job_current(rows[-1], job_stamps.get(seq), listdir_dict):
+                    kept_rows += rows
+                    jobs_to_run += 0 if job_of(rows[-1])[0] else 1
+                else:
+                    jobs_to_run += 1
+            with open(joblog_fn, 'w') as f:
+                f.write((header or '') + ''.join(kept_rows))
+        return jobs_to_run
+
+    def fingerprint_of(self, step):
+        md5 = hashlib.md5(step.command.encode())
+        for input_file in self.input_files_of(step):
+            file_stat = os.stat(input_file)
+            md5.update('{}:{}:{}'.format(input_file, file_stat.st_size, int(file_stat.st_mtime)).encode())
+        for dependency in step.dependencies:
+            md5.update(self.fingerprint_dict[dependency].encode())
+        return md5.hexdigest()
+
+    def marker_matches(self, marker_fn, fingerprint):
+        if not os.path.exists(marker_fn):
+            return False
+        with open(marker_fn) as f:
+            return f.read().strip() == fingerprint
+
+    def write_marker(self, marker_fn, fingerprint):
+        with open(marker_fn, 'w') as f:
+            f.write(fingerprint + '\n')
+
+    def command_to_run(self, step, fingerprint):
+        """
+        Return None if the step is done, the command resuming the failed and stale GNU parallel jobs of the step, or
+        the command after removing its joblogs so that all jobs are run.
+        """
+        marker_prefix = self.marker_prefix_of(step)
+        joblogs = self.joblogs_of(step)
+        if self.resume:
+            is_done = self.marker_matches(marker_prefix + DONE_SUFFIX, fingerprint)
+            is_started = self.marker_matches(marker_prefix + STARTED_SUFFIX, fingerprint)
+            outputs = self.outputs_of(step, fingerprint)
+            is_step_current = outputs is not None and all(
+                stamp_of(path) == stamp for path, stamp in outputs['files'].items())
+            if not len(joblogs):
+                is_dependency_run = any(idx in self.ran_steps for idx in step.dependencies)
+                if is_done and is_step_current and not is_dependency_run:
+                    return None
+            elif (is_done or is_started) and all(os.path.exists(joblog_fn) for joblog_fn in joblogs) and (
+                    is_step_current or (outputs is None and is_started)):
+                jobs_to_run = self.prune_stale_jobs(step, outputs)
+                if is_done and jobs_to_run == 0:
+                    return None
+                return step.command.replace(' --joblog ', ' --resume-failed --joblog ')
+        for joblog_fn in joblogs:
+            if os.path.exists(joblog_fn):
+                os.remove(joblog_fn)
+        return step.command
+
+    def shared_jobs_command_from(self, step, command):
+        if not self.share_threads or not self.jobs_pattern.search(command):
+            return command
+        jobs_fn = self.marker_prefix_of(step) + JOBS_SUFFIX
+        self.jobs_fn_dict[step.index] = jobs_fn
+        return self.jobs_pattern.sub(' -j ' + jobs_fn, command)
+
+    def rebalance_threads(self):
+        """
+        Split the threads evenly among the running GNU parallel steps, the earlier steps get the remainder.
+        """
+        if not len(self.jobs_fn_dict):
+            return
+        share, remainder = divmod(self.threads, len(self.jobs_fn_dict))
+        for idx, index in enumerate(sorted(self.jobs_fn_dict)):
+            with open(self.jobs_fn_dict[index], 'w') as f:
+                f.write('{}\n'.format(max(share + (1 if idx < remainder else 0), 1)))
+
+    def block_pending_steps(self, pending_steps):
+        """
+        Drop the pending steps depending on a failed or blocked step, the dependencies of a step have lower indexes.
+        """
+        for step in sorted(pending_steps, key=lambda step: step.index):
+            if any(idx in self.failed_steps or idx in self.blocked_steps for idx in step.dependencies):
+                self.blocked_steps.add(step.index)
+                pending_steps.remove(step)
+
+    def run(self, steps, skip_steps=None):
+        """
+        Run the steps, return the 1-based index of the first failed step, or None if all steps succeeded.
+        """
+        skip_steps = set() if skip_steps is None else set(skip_steps)
+        pending_steps = list(steps)
+        running_processes = {}
+        done_steps = set()
+        failed_step = None
+
+        while len(pending_steps) or len(running_processes):
+            for index, process in list(running_processes.items()):
+                if process.poll() is None:
+                    continue
+                del running_processes[index]
+                if index in self.jobs_fn_dict:
+                    del self.jobs_fn_dict[index]
+                    self.rebalance_threads()
+                step = steps[index]
+                self.write_outputs(step, self.fingerprint_dict[index])
+                if process.returncode != 0:
+                    failed_step = index + 1 if failed_step is None else failed_step
+                    self.failed_steps.add(index)
+                    if self.keep_going:
+                        self.block_pending_steps(pending_steps)
+                    continue
+                marker_prefix = self.marker_prefix_of(step)
+                self.write_marker(marker_prefix + DONE_SUFFIX, self.fingerprint_dict[index])
+                done_steps.add(index)
+
+            while (failed_step is None or self.keep_going) and len(pending_steps) and len(running_processes) < self.max_concurrent_steps:
+                ready_steps = [step for step in pending_steps if all(idx in done_steps for idx in step.dependencies)]
+                if not len(ready_steps):
+                    break
+                step = ready_steps[0]
+                pending_steps.remove(step)
+                fingerprint = self.fingerprint_of(step)
+                self.fingerprint_dict[step.index] = fingerprint
+                marker_prefix = self.marker_prefix_of(step)
+
+                self.logging(step.echo)
+                self.logging("[INFO] RUN THE FOLLOWING COMMAND:")
+                self.logging(step.command)
+                self.logging("")
+                if str(step.index + 1) in skip_steps:
+                    self.logging("[INFO] --skip_steps is enabled, skip running step {}.".format(step.index + 1))
+                    self.logging("")
+                    done_steps.add(step.index)
+                    continue
+                command = self.command_to_run(step, fingerprint)
+                if command is None:
+                    self.logging("[INFO] Step {} is done with the same inputs, skip running it.".format(step.index + 1))
+                    self.logging("")
+                    done_steps.add(step.index)
+                    continue
+
+                if os.path.exists(marker_prefix + DONE_SUFFIX):
+                    os.remove(marker_prefix + DONE_SUFFIX)
+                self.ran_steps.add(step.index)
+                command = self.shared_jobs_command_from(step, command)
+                self.rebalance_threads()
+                self.write_marker(marker_prefix + STARTED_SUFFIX, fingerprint)
+                # the commands end with `| tee <log>`, pipefail keeps the exit status of the step instead of tee's
+                bash_options = ['-o', 'pipefail'] if step.pipefail else []
+                running_processes[step.index] = subprocess.Popen(['bash'] + bash_options + ['-c', command],
+                                                                 stdout=self.stdout)
+
+            if failed_step is not None and not self.keep_going and not len(running_processes):
+                break
+            if len(running_processes):
+                sleep(1)
+        return failed_step
@@ -40,36 +40,14 @@ from collections import defaultdict
 from shared.vcf import VcfReader
 import shared.param as param
 from shared.utils import str2bool
+from shared.pileup import base_list_from
 
 def get_base_list(columns, args=None):
     if len(columns) < 5:
         return Counter(), []
     min_bq_cut = args.min_bq_cut if args is not None else 0
-    pileup_bases = columns[4]
-    base_idx = 0
-    base_list = []
+    base_list = base_list_from(columns[4])
     bq_list = [ord(qual) - 33 for qual in columns[5]]
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
     upper_base_counter = Counter([''.join(item).upper() for item, bq in zip(base_list, bq_list) if bq >= min_bq_cut])
     return upper_base_counter, base_list
 
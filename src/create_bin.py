@@ -28,38 +28,169 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import sys
+import shutil
 import logging
+import numpy as np
+from multiprocessing import Pool
 from argparse import ArgumentParser, SUPPRESS
 from shared.utils import str2bool
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
-def Run(args):
+# rows of the output bins assembled at a time when merging the shards
+MERGE_BLOCK_ROWS = 2000
+
 
+def utils_from(args):
     if args.normal_tensor_fn is None:
         import clairs.utils_pair as utils
     elif args.pileup:
         import clairs.utils_pileup as utils
     else:
         import clairs.utils as utils
-    utils.setup_environment()
-    logging.info("Loading the dataset ...")
-    
+    return utils
+
+
+def create_bin_from(args, bin_fn, tensor_file_pairs=None):
+    utils = utils_from(args)
     utils.get_training_array(
         args=args,
         normal_tensor_fn=args.normal_tensor_fn,
         tumor_tensor_fn=args.tumor_tensor_fn,
         var_fn=args.var_fn,
         bed_fn=args.bed_fn,
-        bin_fn=args.bin_fn,
+        bin_fn=bin_fn,
         shuffle=args.shuffle,
         is_allow_duplicate_chr_pos=args.allow_duplicate_chr_pos,
         chunk_id=args.chunk_id-1 if args.chunk_id else None, # 1-base to 0-base
         chunk_num=args.chunk_num,
         pileup=args.pileup,
         platform=args.platform,
-        merge_bins=args.merge_bins)
+        merge_bins=args.merge_bins,
+        bin_format=args.bin_format,
+        tensor_file_pairs=tensor_file_pairs)
+
+
+def shard_tensor_file_pairs(tensor_file_pairs, shard_num):
+    """
+    Split the tensor file pairs into at most shard_num shards of similar total file size, from the largest pair.
+    """
+    shard_list = [[] for _ in range(shard_num)]
+    shard_size_list = [0] * shard_num
+    pair_size = lambda pair: os.path.getsize(pair[0]) + os.path.getsize(pair[1])
+    for tensor_file_pair in sorted(tensor_file_pairs, key=pair_size, reverse=True):
+        shard_idx = shard_size_list.index(min(shard_size_list))
+        shard_list[shard_idx].append(tensor_file_pair)
+        shard_size_list[shard_idx] += pair_size(tensor_file_pair)
+    return [shard for shard in shard_list if len(shard)]
+
+
+def remove_bin(bin_fn):
+    if os.path.isdir(bin_fn):
+        shutil.rmtree(bin_fn)
+    elif os.path.exists(bin_fn):
+        os.remove(bin_fn)
+
+
+def merge_bins(args, shard_bin_fn_list, output_bin_fn_list, seed=0, block_rows=MERGE_BLOCK_ROWS):
+    """
+    Merge the shard bins into output bins of the same number of rows, in the order of a global shuffle index drawn
+    from seed. Each output block is read from the shards in row order, so only block_rows rows are held at a time.
+    """
+    import clairs.utils as utils
+    from clairs.memmap_bin import open_bin
+    shard_list = [open_bin(bin_fn) for bin_fn in shard_bin_fn_list]
+    shard_rows = [len(shard.root.label) for shard in shard_list]
+    tensor_shape = list(shard_list[0].root.input_matrix.shape[1:])
+    label_size = shard_list[0].root.label.shape[1]
+
+    # global shuffle index, the shard and the row of each output row
+    shard_id_array = np.repeat(np.arange(len(shard_list)), shard_rows)
+    row_id_array = np.concatenate([np.arange(rows) for rows in shard_rows])
+    shuffle_index = np.random.RandomState(seed).permutation(len(shard_id_array))
+
+    array_columns = ('input_matrix', 'label', 'proportion')
+    text_columns = ('position', 'normal_alt_info', 'tumor_alt_info')
+    for bin_fn, output_index in zip(output_bin_fn_list, np.array_split(shuffle_index, len(output_bin_fn_list))):
+        table_file = utils.bin_writer_from(bin_fn=bin_fn, tensor_shape=tensor_shape, label_size=label_size,
+                                           bin_format=args.bin_format,
+                                           tensor_dtype='int16' if args.pileup else 'int8')
+        for block_start in range(0, len(output_index), block_rows):
+            block_index = output_index[block_start:block_start + block_rows]
+            block_dict = {}
+            for shard_id, shard in enumerate(shard_list):
+                block_positions = np.where(shard_id_array[block_index] == shard_id)[0]
+                if not len(block_positions):
+                    continue
+                rows = row_id_array[block_index[block_positions]]
+                row_order = np.argsort(rows)
+                rows, block_positions = rows[row_order], block_positions[row_order]
+                for column in array_columns + text_columns:
+                    values = getattr(shard.root, column)[rows]
+                    if column not in block_dict:
+                        block_dict[column] = np.empty((len(block_index),) + values.shape[1:],
+                                                      values.dtype if column in array_columns else object)
+                    block_dict[column][block_positions] = values
+            utils.append_bin_rows(table_file=table_file,
+                                  input_matrix=block_dict['input_matrix'],
+                                  label=block_dict['label'],
+                                  position=block_dict['position'].reshape(-1).tolist(),
+                                  normal_alt_info=block_dict['normal_alt_info'].reshape(-1).tolist(),
+                                  tumor_alt_info=block_dict['tumor_alt_info'].reshape(-1).tolist(),
+                                  proportion=block_dict['proportion'])
+        table_file.close()
+        logging.info("[INFO] Merged {} rows into {}".format(len(output_index), bin_fn))
+
+    for shard in shard_list:
+        shard.close()
+
+
+def create_sharded_bins(args):
+    """
+    Create the bins of the tensor file pairs in args.threads processes, each process writes one shard of pairs into
+    its own bin. With merge_bins, the shards are merged into output_bin_num shuffled bins of the same size.
+    """
+    utils = utils_from(args)
+    tensor_file_pairs = utils.tensor_file_pairs_from(args.normal_tensor_fn, args.tumor_tensor_fn)
+    if not tensor_file_pairs:
+        return
+    shard_list = shard_tensor_file_pairs(tensor_file_pairs, args.threads)
+    bin_suffix = '_shard_{}' if args.merge_bins else '_{}'
+    shard_bin_fn_list = [args.bin_fn + bin_suffix.format(shard_idx) for shard_idx in range(len(shard_list))]
+    logging.info("[INFO] Create {} bins of {} tensor file pairs in {} processes".format(
+        len(shard_list), len(tensor_file_pairs), len(shard_list)))
+    with Pool(processes=len(shard_list)) as pool:
+        pool.starmap(create_bin_from, [(args, bin_fn, shard) for bin_fn, shard in zip(shard_bin_fn_list, shard_list)])
+
+    if not args.merge_bins:
+        return
+    # a shard without any row of its pairs is not written
+    shard_bin_fn_list = [bin_fn for bin_fn in shard_bin_fn_list if os.path.exists(bin_fn)]
+    if not len(shard_bin_fn_list):
+        return
+    output_bin_num = max(args.output_bin_num, 1)
+    output_bin_fn_list = [args.bin_fn] if output_bin_num == 1 else [
+        args.bin_fn + '_{}'.format(bin_idx) for bin_idx in range(output_bin_num)]
+    merge_bins(args=args,
+               shard_bin_fn_list=shard_bin_fn_list,
+               output_bin_fn_list=output_bin_fn_list,
+               seed=args.seed)
+    for bin_fn in shard_bin_fn_list:
+        remove_bin(bin_fn)
+
+
+def Run(args):
+
+    utils = utils_from(args)
+    utils.setup_environment()
+    logging.info("Loading the dataset ...")
+
+    if args.threads > 1 and args.normal_tensor_fn is not None:
+        create_sharded_bins(args)
+    else:
+        create_bin_from(args, args.bin_fn)
     logging.info("Finish!")
 
 
@@ -90,6 +221,12 @@ def main():
     parser.add_argument('--allow_duplicate_chr_pos', action='store_true',
                         help="Allow duplicated chromosome:position in the tensor input")
 
+    parser.add_argument('--bin_format', type=str, default="tables", choices=["tables", "memmap"],
+                        help="Binary format, a compressed PyTables file or a directory of uncompressed memory-mapped arrays, default: %(default)s")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of processes, the tensor file pairs of a prefix are split into one bin per process, default: %(default)s")
+
     # options for internal process control
     ## In pileup mode or not (full alignment mode), default: False
     parser.add_argument('--pileup', action='store_true',
@@ -111,10 +248,18 @@ def main():
     parser.add_argument('--candidate_details_fn_prefix', type=str, default=None,
                         help=SUPPRESS)
 
-    ## Path to the variant candidate details
+    ## Merge the bins of the processes into --output_bin_num bins of the same size in a global shuffled order
     parser.add_argument('--merge_bins', type=str2bool, default=False,
                         help=SUPPRESS)
 
+    ## Number of bins the process bins are merged into
+    parser.add_argument('--output_bin_num', type=int, default=1,
+                        help=SUPPRESS)
+
+    ## Random seed of the global shuffled order of the merged bins
+    parser.add_argument('--seed', type=int, default=0,
+                        help=SUPPRESS)
+
     parser.add_argument('--phase_tumor', type=str2bool, default=False,
                         help=SUPPRESS)
 
@@ -34,6 +34,7 @@ import json
 import logging
 import random
 import heapq
+from array import array
 from subprocess import PIPE
 from itertools import product
 from argparse import ArgumentParser, SUPPRESS
@@ -43,11 +44,25 @@ import shared.param as param
 from shared.utils import subprocess_popen, file_path_from, IUPAC_base_to_num_dict as BASE2NUM, region_from, \
     reference_sequence_from, str2bool, vcf_candidates_from
 from shared.interval_tree import bed_tree_from, is_region_in
+from shared.tensor_io import BinaryTensorWriter, INT8
+from shared.scheduler import chunk_range_control_from, CANDIDATE_CHECK_STRIDE
+from shared.haplotag import ReadHaplotypeAssigner
+from shared.pileup import pileup_engine_from, samtools_pileup_columns_from, pysam_pileup_columns_from, regions_from, \
+    PYSAM_ENGINE
 
 from src.create_tensor import NORMAL_HAP_TYPE, TUMOR_HAP_TYPE, normalize_bq, normalize_mq, ACGT_NUM, \
     STRAND_0, STRAND_1, get_chunk_id
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
+# NumPy is only used under CPython, run_clairs runs this step with python with the pysam engine or --fa_tensor_numpy,
+# pypy runs the pure Python tensor assembly
+try:
+    if '__pypy__' in sys.builtin_module_names:
+        raise ImportError
+    import numpy as np
+except ImportError:
+    np = None
+
 BASES = set(list(BASE2NUM.keys()) + ["-"])
 no_of_positions = param.no_of_positions
 flanking_base_num = param.flankingBaseNum
@@ -57,41 +72,81 @@ HAP_TYPE = dict(zip((1, 0, 2), (30, 60, 90)))  # hap1 UNKNOWN H2
 
 
 
+class ReadTable(object):
+    """
+    Index of the read names of a sample in a chunk, the pileup state refers to the reads by their index so that each
+    read name is kept once instead of once per covered position.
+    """
+    __slots__ = ('read_idx_dict', 'read_name_list')
+
+    def __init__(self):
+        self.read_idx_dict = {}
+        self.read_name_list = []
+
+    def read_ids_from(self, read_name_list):
+        read_idx_dict = self.read_idx_dict
+        read_ids = array('i')
+        for read_name in read_name_list:
+            read_id = read_idx_dict.get(read_name)
+            if read_id is None:
+                read_id = len(self.read_name_list)
+                read_idx_dict[read_name] = read_id
+                self.read_name_list.append(read_name)
+            read_ids.append(read_id)
+        return read_ids
+
+
 class Position(object):
-    def __init__(self, pos, ref_base=None, alt_base=None, read_name_list=None, base_list=None, raw_base_quality=None,
-                 raw_mapping_quality=None, af=None, depth=None, genotype=None, phase_set=None):
+    """
+    Pileup state of a position, the channels of the covering reads are kept in one flattened int8 array with
+    channel_size values per read in the order of read_ids, and the inserted bases only for the reads with an insertion.
+    """
+    __slots__ = ('pos', 'ref_base', 'read_table', 'read_ids', 'base_list', 'raw_base_quality', 'raw_mapping_quality',
+                 'af', 'depth', 'update_info', 'read_channels', 'ins_base_dict')
+
+    def __init__(self, pos, read_table, read_ids, ref_base=None, base_list=None, raw_base_quality=None,
+                 raw_mapping_quality=None, af=None, depth=None):
         self.pos = pos
         self.ref_base = ref_base
-        self.alt_base = alt_base
-        self.read_name_list = read_name_list
+        self.read_table = read_table
+        self.read_ids = read_ids
         self.base_list = base_list
         self.raw_base_quality = raw_base_quality
         self.raw_mapping_quality = raw_mapping_quality
         self.af = af
         self.depth = depth
-        self.read_channel = None
-        self.mapping_quality = None
         self.update_info = False
-        self.read_info = defaultdict()
-        self.ref_seq = None
-        self.alt_seq = None
-        self.phase_set = phase_set
-        self.genotype = genotype
-        self.read_name_seq = defaultdict(str)
+        self.read_channels = None
+        self.ins_base_dict = None
+
+    @property
+    def read_name_list(self):
+        return [self.read_table.read_name_list[read_id] for read_id in self.read_ids]
+
+    @property
+    def read_name_dict(self):
+        return dict(zip(self.read_name_list, self.base_list))
 
     def update_infos(self, is_tumor=False, hap_dict=None, mask_low_bq=False, platform='ont'):
         # only proceed when variant exists in candidate windows which greatly improves efficiency
-        self.read_name_dict = dict(zip(self.read_name_list, self.base_list))
         self.update_info = True
-        self.mapping_quality = [normalize_mq(phredscore2raw_score(item)) for item in self.raw_mapping_quality]
-        self.base_quality = [normalize_bq(phredscore2raw_score(item), platform) for item in self.raw_base_quality]
-
-        for read_name, base_info, bq, mq in zip(self.read_name_list, self.base_list, self.base_quality,
-                                                self.mapping_quality):
+        mapping_quality = [normalize_mq(phredscore2raw_score(item)) for item in self.raw_mapping_quality]
+        base_quality = [normalize_bq(phredscore2raw_score(item), platform) for item in self.raw_base_quality]
+        # the raw qualities are no longer needed once the channels are there
+        self.raw_base_quality, self.raw_mapping_quality = None, None
+
+        read_name_list = self.read_table.read_name_list
+        self.read_channels = array('b')
+        self.ins_base_dict = {}
+        for read_idx, (read_id, base_info, bq, mq) in enumerate(zip(self.read_ids, self.base_list, base_quality,
+                                                                    mapping_quality)):
+            read_name = read_name_list[read_id]
             hp = hap_dict[read_name] if hap_dict is not None and read_name in hap_dict else 0
             read_channel, ins_base, query_base = get_tensor_info(base_info, bq, self.ref_base, mask_low_bq, mq,
                                                                  is_tumor, hp=hp)
-            self.read_info[read_name] = (read_channel, ins_base)
+            self.read_channels.extend(read_channel)
+            if ins_base != '':
+                self.ins_base_dict[read_idx] = ins_base
 
 
 def phredscore2raw_score(qual):
@@ -111,7 +166,8 @@ def evc_base_from(base):
         return 'a'
 
 
-def sorted_by_hap_read_name(center_pos, haplotag_dict, pileup_dict, hap_dict, max_depth, use_tensor_sample_mode=False):
+def sorted_by_hap_read_name(center_pos, haplotag_dict, pileup_dict, hap_dict, max_depth, read_table,
+                            use_tensor_sample_mode=False):
     """
     Sort by reads haplotype after haplotag reads otherwise sort by read start position.
     center_pos: define the center candidate position for processing.
@@ -119,27 +175,30 @@ def sorted_by_hap_read_name(center_pos, haplotag_dict, pileup_dict, hap_dict, ma
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position .
     hap_dict: similar to haplotag_dict, dictionary (pos: pos info) which keep the read name and haplotype mapping,
     while haplotype information directly acquire from BAM HP tag.
+    read_table: read index table of the sample, the reads are returned as (hap, order, read_id).
     platform: select maximum depth for each platform.
     """
-    all_nearby_read_name = []
+    all_nearby_read_id = []
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
     for p in range(start_pos, end_pos):
-        if p in pileup_dict.keys():
-            all_nearby_read_name += pileup_dict[p].read_name_list
-    all_nearby_read_name = list(OrderedDict.fromkeys(all_nearby_read_name))  # have sorted by order
+        if p in pileup_dict:
+            all_nearby_read_id.extend(pileup_dict[p].read_ids)
+    all_nearby_read_id = list(OrderedDict.fromkeys(all_nearby_read_id))  # have sorted by order
     matrix_depth = max_depth
-    if len(all_nearby_read_name) > matrix_depth and not use_tensor_sample_mode:
+    if len(all_nearby_read_id) > matrix_depth and not use_tensor_sample_mode:
         # set same seed for reproducibility
         random.seed(0)
-        indices = random.sample(range(len(all_nearby_read_name)), matrix_depth)
-        all_nearby_read_name = [all_nearby_read_name[i] for i in sorted(indices)]
-    sorted_read_name_list = []
-    for order, read_name in enumerate(all_nearby_read_name):
+        indices = random.sample(range(len(all_nearby_read_id)), matrix_depth)
+        all_nearby_read_id = [all_nearby_read_id[i] for i in sorted(indices)]
+    sorted_read_id_list = []
+    read_name_list = read_table.read_name_list
+    for order, read_id in enumerate(all_nearby_read_id):
+        read_name = read_name_list[read_id]
         hap = max(haplotag_dict[read_name], hap_dict[read_name])  # no phasing is 0
-        sorted_read_name_list.append((hap, order, read_name))
+        sorted_read_id_list.append((hap, order, read_id))
 
-    sorted_read_name_list = sorted(sorted_read_name_list, key=lambda x: (x[0], x[1]))
-    return sorted_read_name_list
+    sorted_read_id_list = sorted(sorted_read_id_list, key=lambda x: (x[0], x[1]))
+    return sorted_read_id_list
 
 
 def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is_tumor=False, hp=0):
@@ -185,7 +244,7 @@ def get_tensor_info(base_info, bq, ref_base, mask_low_bq=False, read_mq=None, is
 
 
 def decode_pileup_bases(pos,
-                        pileup_bases,
+                        base_list,
                         reference_base,
                         minimum_snv_af_for_candidate,
                         minimum_indel_af_for_candidate,
@@ -194,8 +253,8 @@ def decode_pileup_bases(pos,
                         is_tumor,
                         platform="ont"):
     """
-    Decode mpileup input string.
-    pileup_bases: pileup base string for each position, include all mapping information.
+    Decode the pileup bases of a position.
+    base_list: [base, indel] pairs of each read covering the position, see shared/pileup.py.
     reference_base: upper reference base for cigar calculation.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position.
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
@@ -204,29 +263,6 @@ def decode_pileup_bases(pos,
     has_pileup_candidates: if the candidate is directly obtained from pileup output, then no need to check the af filtering.
     """
 
-    base_idx = 0
-    base_list = []
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
     if has_pileup_candidates:
         if pos not in candidates_type_dict or not is_tumor:
             return base_list, None, True, 1.0
@@ -342,10 +378,115 @@ def find_tumor_alt_match(center_pos, sorted_read_name_list, pileup_dict, truths_
     return matched_read_name_set, normal_read_name_set
 
 
+def tensor_from(sorted_read_id_list, pileup_dict, start_pos):
+    """
+    Fill the flattened (depth, no_of_positions, channel_size) int8 full alignment tensor from the read channels of the
+    window positions, then overwrite the inserted base channel after each insertion.
+    """
+    end_pos = start_pos + no_of_positions
+    tensor = array('b', bytes(len(sorted_read_id_list) * no_of_positions * channel_size))
+    # the position index of the read channels copied into each tensor cell, -1 if the read does not cover it
+    cell_read_idx = array('i', [-1]) * (len(sorted_read_id_list) * no_of_positions)
+    insert_tuple = []
+
+    tensor_read_idx_dict = dict((read_id, row_idx) for row_idx, (_, _, read_id) in enumerate(sorted_read_id_list))
+    for p in range(start_pos, end_pos):
+        if p not in pileup_dict:
+            continue
+        position = pileup_dict[p]
+        offset = p - start_pos
+        # a read name kept twice in a position keeps the channels of its last occurrence
+        position_read_idx_dict = dict((read_id, read_idx) for read_idx, read_id in enumerate(position.read_ids)
+                                      if read_id in tensor_read_idx_dict)
+        read_channels = position.read_channels
+        for read_id, read_idx in position_read_idx_dict.items():
+            row_idx = tensor_read_idx_dict[read_id]
+            cell = row_idx * no_of_positions + offset
+            tensor[cell * channel_size: (cell + 1) * channel_size] = \
+                read_channels[read_idx * channel_size: (read_idx + 1) * channel_size]
+            cell_read_idx[cell] = read_idx
+            if read_idx in position.ins_base_dict and p < end_pos - 1:
+                insert_tuple.append((row_idx, offset, position.ins_base_dict[read_idx]))
+
+    for row_idx, p, ins_base in insert_tuple:
+
+        for ins_idx in range(min(len(ins_base), no_of_positions - p)):
+            cell = row_idx * no_of_positions + ins_idx + p
+            tensor[cell * channel_size + 6] = ACGT_NUM[ins_base[ins_idx]]
+            # the inserted bases also stay in the covering read channels for the following candidates
+            if cell_read_idx[cell] >= 0:
+                pileup_dict[start_pos + ins_idx + p].read_channels[
+                    cell_read_idx[cell] * channel_size + 6] = ACGT_NUM[ins_base[ins_idx]]
+    return tensor
+
+
+def np_tensor_from(sorted_read_id_list, pileup_dict, start_pos):
+    """
+    NumPy version of tensor_from: the read channels of all window positions are matched to the tensor rows and
+    scattered into the preallocated tensor in one step, only the sparse insertions are patched per read.
+    """
+    tensor_depth = len(sorted_read_id_list)
+    tensor = np.zeros((tensor_depth * no_of_positions, channel_size), dtype=np.int8)
+    positions = [(pileup_dict[p], p - start_pos) for p in range(start_pos, start_pos + no_of_positions)
+                 if p in pileup_dict and len(pileup_dict[p].read_ids)]
+    if not len(positions):
+        return tensor.ravel()
+
+    read_channels_list = [np.frombuffer(position.read_channels, dtype=np.int8) for position, _ in positions]
+    read_ids = np.concatenate([np.frombuffer(position.read_ids, dtype=np.intc) for position, _ in positions])
+    read_nums = np.array([len(position.read_ids) for position, _ in positions])
+    read_starts = np.concatenate(([0], np.cumsum(read_nums)[:-1]))
+    offsets = np.repeat(np.array([offset for _, offset in positions]), read_nums)
+
+    tensor_read_ids = np.array([read_id for _, _, read_id in sorted_read_id_list], dtype=np.intc)
+    read_id_order = np.argsort(tensor_read_ids)
+    sorted_tensor_read_ids = tensor_read_ids[read_id_order]
+    matched_idx = np.minimum(np.searchsorted(sorted_tensor_read_ids, read_ids), tensor_depth - 1)
+    is_in_tensor = sorted_tensor_read_ids[matched_idx] == read_ids
+    src = np.flatnonzero(is_in_tensor)
+    cells = read_id_order[matched_idx[src]] * no_of_positions + offsets[src]
+    # a read name kept twice in a position keeps the channels of its last occurrence
+    _, last_idx = np.unique(cells[::-1], return_index=True)
+    src, cells = src[len(src) - 1 - last_idx], cells[len(cells) - 1 - last_idx]
+    tensor[cells] = np.concatenate(read_channels_list).reshape(-1, channel_size)[src]
+
+    if not any(len(position.ins_base_dict) for position, _ in positions):
+        return tensor.ravel()
+    cell_src = np.full(tensor_depth * no_of_positions, -1, dtype=np.intp)
+    cell_src[cells] = src
+    cell_src = cell_src.tolist()
+    src_cells = (read_id_order[matched_idx] * no_of_positions + offsets).tolist()
+    # cell: inserted base channel, in the order of the insertions so that a later insertion overwrites an earlier one
+    ins_channel_dict = {}
+    for (position, offset), read_start in zip(positions, read_starts.tolist()):
+        if offset >= no_of_positions - 1:
+            continue
+        for read_idx, ins_base in position.ins_base_dict.items():
+            cell = src_cells[read_start + read_idx]
+            if cell_src[cell] != read_start + read_idx:
+                continue
+            for ins_idx in range(min(len(ins_base), no_of_positions - offset)):
+                ins_channel_dict[cell + ins_idx] = ACGT_NUM[ins_base[ins_idx]]
+    if not len(ins_channel_dict):
+        return tensor.ravel()
+    tensor[list(ins_channel_dict.keys()), 6] = list(ins_channel_dict.values())
+
+    # the inserted bases also stay in the covering read channels for the following candidates
+    read_starts = read_starts.tolist()
+    position_idx_dict = dict((offset, position_idx) for position_idx, (_, offset) in enumerate(positions))
+    for cell, ins_channel in ins_channel_dict.items():
+        src_idx = cell_src[cell]
+        if src_idx >= 0:
+            position_idx = position_idx_dict[cell % no_of_positions]
+            read_idx = src_idx - read_starts[position_idx]
+            positions[position_idx][0].read_channels[read_idx * channel_size + 6] = ins_channel
+    return tensor.ravel()
+
+
 def generate_tensor(args,
                     ctg_name,
                     center_pos,
-                    sorted_read_name_list,
+                    sorted_read_id_list,
                     pileup_dict,
                     ref_seq,
                     reference_sequence,
@@ -356,13 +497,14 @@ def generate_tensor(args,
                     candidates_type_dict,
                     use_tensor_sample_mode=False,
                     truths_variant_dict=None,
-                    hap_dict=None):
+                    hap_dict=None,
+                    binary_tensor=False):
     """
     Generate full alignment input tensor
     ctg_name: provided contig name.
     center_pos: center position for full alignment generation, default window size = no_of_positions =
     flankingBaseNum + 1 + flankingBaseNum
-    sorted_read_name_list: read name list which have been sorted by read start position and haplotype.
+    sorted_read_id_list: read id list which have been sorted by read start position and haplotype.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position .
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
     reference_sequence: reference sequence index by contig:start-end. 0-based.
@@ -372,16 +514,14 @@ def generate_tensor(args,
     confident_bed_tree: dictionary (contig name : intervaltree) for fast region query.
     add_no_phasing_data_training: boolean option to decide whether add no phasing data in training, we will
     resort the read and remove haplotype info when using this option.
+    binary_tensor: return the flattened int8 tensor for the binary tensor writer instead of a string.
     """
 
-    tensor_shape = param.ont_input_shape if platform == 'ont' else param.input_shape
     reference_base = ref_seq[flanking_base_num]
-    tensor_depth = len(sorted_read_name_list)
+    tensor_depth = len(sorted_read_id_list)
     if tensor_depth == 0:
         return None, None
-    tensor = [[[0] * tensor_shape[2] for _ in range(tensor_shape[1])] for _ in range(tensor_depth)]
     start_pos, end_pos = center_pos - flanking_base_num, center_pos + flanking_base_num + 1
-    insert_tuple = []
 
     # match deletion cases and bed format
     pass_confident_bed = not len(confident_bed_tree) or is_region_in(confident_bed_tree, ctg_name,
@@ -394,19 +534,10 @@ def generate_tensor(args,
         if p in pileup_dict and not pileup_dict[p].update_info:
             pileup_dict[p].update_infos(is_tumor=is_tumor, hap_dict=hap_dict, mask_low_bq=args.mask_low_bq,
                                         platform=platform)
-        for read_idx, read_name_info in enumerate(sorted_read_name_list):
-            hap, read_order, read_name = read_name_info
-            offset = p - start_pos
-            if p in pileup_dict and read_name in pileup_dict[p].read_info:
-                read_channel, ins_base = pileup_dict[p].read_info[read_name]
-                tensor[read_idx][offset] = read_channel
-                if ins_base != '' and p < end_pos - 1:
-                    insert_tuple.append((read_idx, offset, ins_base, p))
-
-    for read_idx, p, ins_base, center_p in insert_tuple:
-
-        for ins_idx in range(min(len(ins_base), no_of_positions - p)):
-            tensor[read_idx][ins_idx + p][6] = ACGT_NUM[ins_base[ins_idx]]
+    if np is not None:
+        tensor = np_tensor_from(sorted_read_id_list=sorted_read_id_list, pileup_dict=pileup_dict, start_pos=start_pos)
+    else:
+        tensor = tensor_from(sorted_read_id_list=sorted_read_id_list, pileup_dict=pileup_dict, start_pos=start_pos)
 
     alt_dict = defaultdict(int)
     depth, max_del_length = 0, 0
@@ -447,8 +578,10 @@ def generate_tensor(args,
         alt_info.append(['R' + reference_base, str(ref_count)])
     
     alt_info = str(depth) + '-' + ' '.join([' '.join([item[0], str(item[1])]) for item in alt_info]) + '-' + af_infos
-    tensor_string_list = [
-        " ".join((" ".join(" ".join(str(x) for x in innerlist) for innerlist in outerlist)) for outerlist in tensor)]
+    if binary_tensor:
+        return tensor, [alt_info]
+
+    tensor_string_list = [" ".join(str(x) for x in (tensor.tolist() if np is not None else tensor))]
 
     return tensor_string_list, [alt_info]
 
@@ -535,6 +668,11 @@ def create_pair_tensor(args):
     vcf_fn = args.vcf_fn
     phase_normal = args.phase_normal if args.phase_tumor is not None else param.phase_tumor[platform]
     phase_tumor = args.phase_tumor if args.phase_tumor is not None else param.phase_tumor[platform]
+    normal_phased_vcf_fn = args.normal_phased_vcf_fn if phase_normal else None
+    tumor_phased_vcf_fn = args.tumor_phased_vcf_fn if phase_tumor else None
+    # the HP tags are only read from the BAM if the read haplotypes are not assigned from the phased VCF
+    normal_phasing_info_in_bam = phase_normal and normal_phased_vcf_fn is None
+    tumor_phasing_info_in_bam = phase_tumor and tumor_phased_vcf_fn is None
     is_known_vcf_file_provided = vcf_fn is not None
     tensor_sample_mode = args.tensor_sample_mode
     candidates_pos_set = set()
@@ -598,6 +736,11 @@ def create_pair_tensor(args):
 
     # preparation for candidates near variants
     candidates_pos_set = set([item for item in candidates_pos_set if item >= ctg_start and item <= ctg_end])
+    # the chunk scheduler may end the chunk earlier and run the candidates after the new end in another chunk
+    # end_at is called once per candidate
+    chunk_range_control = chunk_range_control_from(args.chunk_control_prefix,
+                                                   max(candidates_pos_set) if len(candidates_pos_set) else ctg_end,
+                                                   check_stride=CANDIDATE_CHECK_STRIDE)
     # 1-based regions [start, end] (start and end inclusive)
     ref_regions = []
     reads_regions = []
@@ -625,8 +768,23 @@ def create_pair_tensor(args):
     if reference_sequence is None or len(reference_sequence) == 0:
         sys.exit("[ERROR] Failed to load reference sequence from file ({}).".format(fasta_file_path))
 
-    nomral_phasing_option = " --output-extra HP" if phase_normal else " "
-    tumor_phasing_option = " --output-extra HP" if phase_tumor else " "
+    normal_hap_dict = defaultdict(int)
+    tumor_hap_dict = defaultdict(int)
+    for hap_dict, phased_vcf_fn, bam_fn in ((normal_hap_dict, normal_phased_vcf_fn, normal_bam_file_path),
+                                            (tumor_hap_dict, tumor_phased_vcf_fn, tumor_bam_file_path)):
+        if phased_vcf_fn is None:
+            continue
+        read_haplotype_assigner = ReadHaplotypeAssigner(phased_vcf_fn=phased_vcf_fn,
+                                                        ctg_name=ctg_name,
+                                                        samtools=samtools_execute_command,
+                                                        tabix=args.tabix,
+                                                        min_mq=min_mapping_quality)
+        hap_dict.update(read_haplotype_assigner.read_haplotypes_of_bam(bam_fn=bam_fn,
+                                                                       regions=reads_regions,
+                                                                       strand_suffix=platform == 'ilmn'))
+
+    nomral_phasing_option = " --output-extra HP" if normal_phasing_info_in_bam else " "
+    tumor_phasing_option = " --output-extra HP" if tumor_phasing_info_in_bam else " "
     mq_option = ' --min-MQ {}'.format(min_mapping_quality)
     output_mq, output_read_name = True, True
     output_mq_option = ' --output-MQ ' if output_mq else ""
@@ -642,23 +800,60 @@ def create_pair_tensor(args):
 
     samtools_command = "{} mpileup --reverse-del".format(samtools_execute_command) + \
                        output_read_name_option + output_mq_option + reads_regions_option + mq_option + bq_option + bed_option + flags_option + max_depth_option
-    samtools_mpileup_normal_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + nomral_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE)
-
-    samtools_mpileup_tumor_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE)
-
-    if tensor_can_output_path != "PIPE":
+    pileup_engine = pileup_engine_from(args.pileup_engine)
+    samtools_mpileup_processes = []
+    if pileup_engine == PYSAM_ENGINE:
+        pileup_regions = regions_from(reads_regions,
+                                      bed_fn=candidates_bed_regions if is_candidates_bed_regions_given else extend_bed,
+                                      ctg_name=ctg_name)
+        normal_pileup_columns = pysam_pileup_columns_from(bam_fn=normal_bam_file_path,
+                                                          regions=pileup_regions,
+                                                          min_mq=min_mapping_quality,
+                                                          min_bq=min_base_quality,
+                                                          excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+                                                          max_depth=args.max_depth,
+                                                          output_mq=output_mq,
+                                                          output_read_name=output_read_name,
+                                                          output_phasing_info=normal_phasing_info_in_bam)
+        tumor_pileup_columns = pysam_pileup_columns_from(bam_fn=tumor_bam_file_path,
+                                                         regions=pileup_regions,
+                                                         min_mq=min_mapping_quality,
+                                                         min_bq=min_base_quality,
+                                                         excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+                                                         max_depth=args.max_depth,
+                                                         output_mq=output_mq,
+                                                         output_read_name=output_read_name,
+                                                         output_phasing_info=tumor_phasing_info_in_bam)
+    else:
+        samtools_mpileup_normal_process = subprocess_popen(
+            shlex.split(samtools_command + ' ' + nomral_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE)
+
+        samtools_mpileup_tumor_process = subprocess_popen(
+            shlex.split(samtools_command + ' ' + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE)
+        samtools_mpileup_processes = [samtools_mpileup_normal_process, samtools_mpileup_tumor_process]
+        normal_pileup_columns = samtools_pileup_columns_from(samtools_mpileup_normal_process,
+                                                             output_mq=output_mq,
+                                                             output_read_name=output_read_name,
+                                                             output_phasing_info=normal_phasing_info_in_bam)
+        tumor_pileup_columns = samtools_pileup_columns_from(samtools_mpileup_tumor_process,
+                                                            output_mq=output_mq,
+                                                            output_read_name=output_read_name,
+                                                            output_phasing_info=tumor_phasing_info_in_bam)
+
+    binary_tensor = args.binary_tensor
+    if binary_tensor:
+        tensor_can_fp = BinaryTensorWriter(tensor_fn=tensor_can_output_path, dtype=INT8)
+    elif tensor_can_output_path != "PIPE":
         tensor_can_fpo = open(tensor_can_output_path, "wb")
         tensor_can_fp = subprocess_popen(shlex.split("{} -c".format(args.zstd)), stdin=PIPE, stdout=tensor_can_fpo)
     else:
         tensor_can_fp = TensorStdout(sys.stdout)
 
-    normal_hap_dict = defaultdict(int)
-    tumor_hap_dict = defaultdict(int)
     haplotag_dict = defaultdict(int)
     normal_pileup_dict = defaultdict(str)
     tumor_pileup_dict = defaultdict(str)
+    normal_read_table = ReadTable()
+    tumor_read_table = ReadTable()
 
     extend_bp_distance = no_of_positions + param.extend_bp
     confident_bed_tree = bed_tree_from(bed_file_path=confident_bed_fn,
@@ -671,16 +866,15 @@ def create_pair_tensor(args):
                                     bed_ctg_start=extend_start,
                                     bed_ctg_end=extend_end)
 
-    def samtools_pileup_generator_from(samtools_mpileup_process, is_tumor=True, phasing_info_in_bam=False):
+    def samtools_pileup_generator_from(pileup_columns, is_tumor=True, phasing_info_in_bam=False):
         candidate_pos_list = sorted(list(candidates_pos_set))
         current_pos_index = 0
         has_pileup_candidates = len(candidates_pos_set)
         pileup_dict = tumor_pileup_dict if is_tumor else normal_pileup_dict
         hap_dict = tumor_hap_dict if is_tumor else normal_hap_dict
+        read_table = tumor_read_table if is_tumor else normal_read_table
 
-        for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-            columns = row.strip().split('\t')
-            pos = int(columns[1])
+        for pos, base_list, raw_base_quality, raw_mapping_quality, read_name_list, phasing_info in pileup_columns:
             # pos that near bed region should include some indel cover in bed
             pass_extend_bed = not is_extend_bed_file_given or is_region_in(extend_bed_tree,
                                                                            ctg_name, pos - 1,
@@ -688,15 +882,11 @@ def create_pair_tensor(args):
             pass_ctg_range = not ctg_start or (pos >= ctg_start and pos <= ctg_end)
             if not has_pileup_candidates and not pass_extend_bed and pass_ctg_range:
                 continue
-            pileup_bases = columns[4]
-            raw_base_quality = columns[5]
-            raw_mapping_quality = columns[6]
-            read_name_list = columns[7].split(',')
             reference_base = reference_sequence[pos - reference_start].upper()
             if reference_base not in 'ACGT':
                 continue
             base_list, depth, pass_af, af = decode_pileup_bases(pos=pos,
-                                                                pileup_bases=pileup_bases,
+                                                                base_list=base_list,
                                                                 reference_base=reference_base,
                                                                 minimum_snv_af_for_candidate=minimum_snv_af_for_candidate,
                                                                 minimum_indel_af_for_candidate=minimum_indel_af_for_candidate,
@@ -712,7 +902,6 @@ def create_pair_tensor(args):
                         read_name_list[b_idx] += '_0'  # forward
 
             if phasing_info_in_bam:
-                phasing_info = columns[8].split(',')
                 if len(read_name_list) != len(phasing_info):
                     continue
                 else:
@@ -731,8 +920,9 @@ def create_pair_tensor(args):
                 candidate_pos_list.append(pos)
 
             pileup_dict[pos] = Position(pos=pos,
+                                        read_table=read_table,
+                                        read_ids=read_table.read_ids_from(read_name_list),
                                         ref_base=reference_base,
-                                        read_name_list=read_name_list,
                                         base_list=base_list,
                                         raw_base_quality=raw_base_quality,
                                         raw_mapping_quality=raw_mapping_quality,
@@ -758,13 +948,15 @@ def create_pair_tensor(args):
             current_pos_index += 1
 
     normal_bam_pileup_generator = samtools_pileup_generator_from(
-        samtools_mpileup_process=samtools_mpileup_normal_process, is_tumor=False, phasing_info_in_bam=phase_normal)
-    tumor_bam_pileup_generator = samtools_pileup_generator_from(samtools_mpileup_process=samtools_mpileup_tumor_process,
-                                                                phasing_info_in_bam=phase_tumor)
+        pileup_columns=normal_pileup_columns, is_tumor=False, phasing_info_in_bam=normal_phasing_info_in_bam)
+    tumor_bam_pileup_generator = samtools_pileup_generator_from(pileup_columns=tumor_pileup_columns,
+                                                                phasing_info_in_bam=tumor_phasing_info_in_bam)
 
     tensor_count = 0
     for pos in heapq_merge_generator_from(normal_bam_pileup_generator=normal_bam_pileup_generator,
                                           tumor_bam_pileup_generator=tumor_bam_pileup_generator):
+        if chunk_range_control is not None and pos > chunk_range_control.end_at(pos):
+            break
         if pos not in normal_pileup_dict or pos not in tumor_pileup_dict:
             continue
         ref_seq = reference_sequence[
@@ -780,13 +972,14 @@ def create_pair_tensor(args):
             max_depth = param.tumor_matrix_depth_dict[platform] if is_tumor else param.normal_matrix_depth_dict[
                 platform]
             hap_dict = tumor_hap_dict if is_tumor else normal_hap_dict
-            sorted_read_name_list = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
-                                                            use_tensor_sample_mode)
+            read_table = tumor_read_table if is_tumor else normal_read_table
+            sorted_read_id_list = sorted_by_hap_read_name(pos, haplotag_dict, pileup_dict, hap_dict, max_depth,
+                                                          read_table, use_tensor_sample_mode)
 
             tensor_string_list, alt_info_list = generate_tensor(args=args,
                                                                 ctg_name=ctg_name,
                                                                 center_pos=pos,
-                                                                sorted_read_name_list=sorted_read_name_list,
+                                                                sorted_read_id_list=sorted_read_id_list,
                                                                 pileup_dict=pileup_dict,
                                                                 ref_seq=ref_seq,
                                                                 reference_sequence=reference_sequence,
@@ -797,12 +990,29 @@ def create_pair_tensor(args):
                                                                 candidates_type_dict=candidates_type_dict,
                                                                 use_tensor_sample_mode=use_tensor_sample_mode,
                                                                 truths_variant_dict=truths_variant_dict,
-                                                                hap_dict=hap_dict)
+                                                                hap_dict=hap_dict,
+                                                                binary_tensor=binary_tensor)
             if tensor_string_list is None:
                 continue
 
             tensor_infos_dict[tumor_flag] = (tensor_string_list, alt_info_list)
 
+        if binary_tensor:
+            if 'normal' not in tensor_infos_dict or 'tumor' not in tensor_infos_dict:
+                continue
+            tensor_can_fp.write_row(ctg_name=ctg_name,
+                                    pos=pos,
+                                    ref_seq=ref_seq,
+                                    normal_tensor=tensor_infos_dict['normal'][0],
+                                    normal_alt_info=tensor_infos_dict['normal'][1][0],
+                                    tumor_tensor=tensor_infos_dict['tumor'][0],
+                                    tumor_alt_info=tensor_infos_dict['tumor'][1][0],
+                                    variant_type=variant_type,
+                                    normal_cols=no_of_positions * channel_size,
+                                    tumor_cols=no_of_positions * channel_size)
+            tensor_count += 1
+            continue
+
         for tensor_infos in get_key_list(tensor_infos_dict, tensor_infos_dict['normal'], tensor_infos_dict['tumor']):
             normal_tensor_string, normal_alt_info, tumor_tensor_string, tumor_alt_info = tensor_infos
 
@@ -818,17 +1028,20 @@ def create_pair_tensor(args):
             tensor_can_fp.stdin.write(tensor)
             tensor_count += 1
 
-    samtools_mpileup_normal_process.stdout.close()
-    samtools_mpileup_normal_process.wait()
-    samtools_mpileup_tumor_process.stdout.close()
-    samtools_mpileup_tumor_process.wait()
-    if tensor_can_output_path != "PIPE":
+    for samtools_mpileup_process in samtools_mpileup_processes:
+        samtools_mpileup_process.stdout.close()
+        samtools_mpileup_process.wait()
+    if binary_tensor:
+        tensor_can_fp.close()
+    elif tensor_can_output_path != "PIPE":
         tensor_can_fp.stdin.close()
         tensor_can_fp.wait()
         tensor_can_fpo.close()
 
     chunk_info = get_chunk_id(candidates_bed_regions)
-    print("[INFO] {} {} Tensors generated: {}".format(ctg_name, chunk_info, tensor_count))
+    # keep stdout clean for the tensors when streaming them to predict
+    print("[INFO] {} {} Tensors generated: {}".format(ctg_name, chunk_info, tensor_count),
+          file=sys.stderr if tensor_can_output_path == "PIPE" else sys.stdout)
 
 
 def main():
@@ -899,6 +1112,18 @@ def main():
     parser.add_argument('--phase_tumor', type=str2bool, default=None,
                         help=SUPPRESS)
 
+    ## Assign the normal read haplotypes from the phased VCF instead of the HP tags of a haplotagged BAM
+    parser.add_argument('--normal_phased_vcf_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Assign the tumor read haplotypes from the phased VCF instead of the HP tags of a haplotagged BAM
+    parser.add_argument('--tumor_phased_vcf_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Path to the 'tabix' for reading the phased VCF
+    parser.add_argument('--tabix', type=str, default="tabix",
+                        help=SUPPRESS)
+
     ## Path to the 'zstd' compression
     parser.add_argument('--zstd', type=str, default=param.zstd,
                         help=SUPPRESS)
@@ -919,6 +1144,10 @@ def main():
     parser.add_argument('--chunk_id', type=int, default=None,
                         help=SUPPRESS)
 
+    ## Prefix of the progress and split files of the chunk scheduler
+    parser.add_argument('--chunk_control_prefix', type=str, default=None,
+                        help=SUPPRESS)
+
     ## Provide the regions to be included in full-alignment based calling
     parser.add_argument('--candidates_bed_regions', type=str, default=None,
                         help=SUPPRESS)
@@ -933,6 +1162,13 @@ def main():
     parser.add_argument('--truth_vcf_fn', type=str, default=None,
                         help=SUPPRESS)
 
+    ## Output tensors in the binary tensor format instead of the zstd compressed text format
+    parser.add_argument('--binary_tensor', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Pileup engine, samtools or pysam (in-process htslib pileup, falls back to samtools if pysam is not installed)
+    parser.add_argument('--pileup_engine', type=str, default="samtools",
+                        help=SUPPRESS)
 
     args = parser.parse_args()
 
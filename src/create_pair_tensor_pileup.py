@@ -32,15 +32,20 @@ import sys
 import shlex
 import logging
 import heapq
+from array import array
 from subprocess import PIPE
 from itertools import product
 from argparse import ArgumentParser, SUPPRESS
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
 import shared.param as param
 from shared.utils import subprocess_popen, file_path_from, IUPAC_base_to_num_dict as BASE2NUM, region_from, \
     reference_sequence_from, str2bool, vcf_candidates_from
 from shared.interval_tree import bed_tree_from, is_region_in
+from shared.tensor_io import BinaryTensorWriter, INT16
+from shared.scheduler import chunk_range_control_from, CANDIDATE_CHECK_STRIDE
+from shared.pileup import pileup_engine_from, samtools_pileup_columns_from, pysam_pileup_columns_from, regions_from, \
+    PYSAM_ENGINE
 from src.create_tensor import get_chunk_id
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
@@ -81,7 +86,7 @@ def evc_base_from(base):
 
 def decode_pileup_bases(args,
                         pos,
-                        pileup_bases,
+                        base_list,
                         reference_base,
                         minimum_snp_af_for_candidate,
                         minimum_indel_af_for_candidate,
@@ -94,8 +99,8 @@ def decode_pileup_bases(args,
                         chunk_ref_seq=None,
                         platform="ont"):
     """
-    Decode mpileup input string.
-    pileup_bases: pileup base string for each position, include all mapping information.
+    Decode the pileup bases of a position.
+    base_list: [base, indel] pairs of each read covering the position, see shared/pileup.py.
     reference_base: upper reference base for cigar calculation.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position.
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
@@ -104,31 +109,8 @@ def decode_pileup_bases(args,
     has_pileup_candidates: if the candidate is directly obtained from pileup output, then no need to check the af filtering.
     """
 
-    base_idx = 0
-    base_list = []
     pileup_tensor = [0] * (channel_size if phasing_info is None else (channel_size + len(phase_channel)))
     is_candidate = pos in candidates_type_dict
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
 
     pileup_dict = defaultdict(int)
     base_counter = Counter([''.join(item) for item, mq in zip(base_list, mapping_quality) if mq >= 20])
@@ -260,6 +242,57 @@ def decode_pileup_bases(args,
 
 
 
+class PileupWindow(object):
+    """
+    Pileup rows of the last window of streamed positions of a sample in a ring buffer indexed by position. Once the
+    stream has passed the window of a candidate, the window is taken from the buffer with each row serialized once
+    for the tensor output, so that the overlapping windows of nearby candidates share the serialized rows.
+    """
+
+    def __init__(self, row_size, flanking_base_num, serialize_row):
+        self.flanking_base_num = flanking_base_num
+        self.capacity = 2 * flanking_base_num + 1
+        self.serialize_row = serialize_row
+        self.pos_list = [None] * self.capacity
+        self.row_list = [None] * self.capacity
+        self.serialized_row_list = [None] * self.capacity
+        self.serialized_zero_row = serialize_row([0] * row_size)
+        # (candidate position, serialized window rows) in position order, waiting for the tensor output
+        self.window_queue = deque()
+
+    def add(self, pos, row):
+        slot = pos % self.capacity
+        self.pos_list[slot] = pos
+        self.row_list[slot] = row
+        self.serialized_row_list[slot] = None
+
+    def serialized_row_of(self, pos):
+        slot = pos % self.capacity
+        if self.pos_list[slot] != pos:
+            # positions without coverage
+            return self.serialized_zero_row
+        if self.serialized_row_list[slot] is None:
+            self.serialized_row_list[slot] = self.serialize_row(self.row_list[slot])
+        return self.serialized_row_list[slot]
+
+    def keep_window_of(self, pos):
+        """
+        Keep the window centered at pos, no position after the window may have been added yet.
+        """
+        self.window_queue.append((pos, [self.serialized_row_of(p) for p in
+                                        range(pos - self.flanking_base_num, pos + self.flanking_base_num + 1)]))
+
+    def window_of(self, pos):
+        """
+        Return the kept window centered at pos, or None if it was not kept. The windows before pos are dropped.
+        """
+        while len(self.window_queue) and self.window_queue[0][0] < pos:
+            self.window_queue.popleft()
+        if len(self.window_queue) and self.window_queue[0][0] == pos:
+            return self.window_queue.popleft()[1]
+        return None
+
+
 class TensorStdout(object):
     def __init__(self, handle):
         self.stdin = handle
@@ -405,6 +438,11 @@ def create_tensor(args):
 
     # preparation for candidates near variants
     candidates_pos_set = set([item for item in candidates_pos_set if item >= ctg_start and item <= ctg_end])
+    # the chunk scheduler may end the chunk earlier and run the candidates after the new end in another chunk
+    # end_at is called once per candidate
+    chunk_range_control = chunk_range_control_from(args.chunk_control_prefix,
+                                                   max(candidates_pos_set) if len(candidates_pos_set) else ctg_end,
+                                                   check_stride=CANDIDATE_CHECK_STRIDE)
     # 1-based regions [start, end] (start and end inclusive)
     ref_regions = []
     reads_regions = []
@@ -453,14 +491,49 @@ def create_tensor(args):
 
     samtools_command = "{} mpileup --reverse-del".format(samtools_execute_command) + \
                        output_read_name_option + output_mq_option + reads_regions_option + mq_option + bq_option + bed_option + flags_option + max_depth_option
-    samtools_mpileup_normal_process = subprocess_popen(
-        shlex.split(samtools_command + normal_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE)
-
-    samtools_mpileup_tumor_process = subprocess_popen(
-        shlex.split(samtools_command + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE)
-
-
-    if tensor_can_output_path != "PIPE":
+    pileup_engine = pileup_engine_from(args.pileup_engine)
+    samtools_mpileup_processes = []
+    if pileup_engine == PYSAM_ENGINE:
+        pileup_regions = regions_from(reads_regions,
+                                      bed_fn=candidates_bed_regions if is_candidates_bed_regions_given else extend_bed,
+                                      ctg_name=ctg_name)
+        normal_pileup_columns = pysam_pileup_columns_from(bam_fn=normal_bam_file_path,
+                                                          regions=pileup_regions,
+                                                          min_mq=samtools_view_min_mq,
+                                                          min_bq=min_base_quality,
+                                                          excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+                                                          max_depth=args.max_depth,
+                                                          output_mq=output_mq,
+                                                          output_read_name=output_read_name)
+        tumor_pileup_columns = pysam_pileup_columns_from(bam_fn=tumor_bam_file_path,
+                                                         regions=pileup_regions,
+                                                         min_mq=samtools_view_min_mq,
+                                                         min_bq=min_base_quality,
+                                                         excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+                                                         max_depth=args.max_depth,
+                                                         output_mq=output_mq,
+                                                         output_read_name=output_read_name,
+                                                         output_phasing_info=phasing_info_in_bam)
+    else:
+        samtools_mpileup_normal_process = subprocess_popen(
+            shlex.split(samtools_command + normal_phasing_option + ' ' + normal_bam_file_path), stderr=PIPE)
+
+        samtools_mpileup_tumor_process = subprocess_popen(
+            shlex.split(samtools_command + tumor_phasing_option + ' ' + tumor_bam_file_path), stderr=PIPE)
+        samtools_mpileup_processes = [samtools_mpileup_normal_process, samtools_mpileup_tumor_process]
+        normal_pileup_columns = samtools_pileup_columns_from(samtools_mpileup_normal_process,
+                                                             output_mq=output_mq,
+                                                             output_read_name=output_read_name)
+        tumor_pileup_columns = samtools_pileup_columns_from(samtools_mpileup_tumor_process,
+                                                            output_mq=output_mq,
+                                                            output_read_name=output_read_name,
+                                                            output_phasing_info=phasing_info_in_bam)
+
+
+    binary_tensor = args.binary_tensor
+    if binary_tensor:
+        tensor_can_fp = BinaryTensorWriter(tensor_fn=tensor_can_output_path, dtype=INT16)
+    elif tensor_can_output_path != "PIPE":
         tensor_can_fpo = open(tensor_can_output_path, "wb")
         tensor_can_fp = subprocess_popen(shlex.split("{} -c".format(args.zstd)), stdin=PIPE, stdout=tensor_can_fpo)
     else:
@@ -473,22 +546,31 @@ def create_tensor(args):
                                     bed_ctg_start=extend_start,
                                     bed_ctg_end=extend_end)
 
-    normal_pileup_tensors = [[0] * channel_size] * (extend_end - extend_start + flanking_base_num)
-    tumor_pileup_tensors = [[0] * channel_size] * (extend_end - extend_start + flanking_base_num)
+    if binary_tensor:
+        def serialize_row(row):
+            return tensor_can_fp.tensor_array_from([row]).tobytes()
+    else:
+        def serialize_row(row):
+            return " ".join("%d" % x for x in row)
+    normal_pileup_window = PileupWindow(row_size=channel_size,
+                                        flanking_base_num=flanking_base_num,
+                                        serialize_row=serialize_row)
+    tumor_pileup_window = PileupWindow(row_size=channel_size + (len(phase_channel) if phasing_info_in_bam else 0),
+                                       flanking_base_num=flanking_base_num,
+                                       serialize_row=serialize_row)
 
     normal_alt_info_dict = defaultdict()
     tumor_alt_info_dict = defaultdict()
 
-    def samtools_pileup_generator_from(samtools_mpileup_process, is_tumor=True):
+    def samtools_pileup_generator_from(pileup_columns, is_tumor=True):
         candidate_pos_list = sorted(list(candidates_pos_set))
         current_pos_index = 0
+        window_pos_index = 0
         has_pileup_candidates = len(candidates_pos_set)
         alt_info_dict = tumor_alt_info_dict if is_tumor else normal_alt_info_dict
-        pileup_tensors = tumor_pileup_tensors if is_tumor else normal_pileup_tensors
+        pileup_window = tumor_pileup_window if is_tumor else normal_pileup_window
 
-        for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-            columns = row.strip().split('\t')
-            pos = int(columns[1])
+        for pos, base_list, raw_base_quality, raw_mapping_quality, _, phasing_info in pileup_columns:
             # pos that near bed region should include some indel cover in bed
             pass_extend_bed = not is_extend_bed_file_given or is_region_in(extend_bed_tree,
                                                                                      ctg_name, pos - 1,
@@ -496,9 +578,6 @@ def create_tensor(args):
             pass_ctg_range = not ctg_start or (pos >= ctg_start and pos <= ctg_end)
             if not has_pileup_candidates and not pass_extend_bed and pass_ctg_range:
                 continue
-            pileup_bases = columns[4]
-            raw_base_quality = columns[5]
-            raw_mapping_quality = columns[6]
             reference_base = evc_base_from(reference_sequence[pos - reference_start]).upper()
             if reference_base not in 'ACGT':
                 continue
@@ -506,16 +585,14 @@ def create_tensor(args):
             mapping_quality = [ord(mq) - 33 for mq in raw_mapping_quality]
             base_quality = [ord(mq) - 33 for mq in raw_base_quality]
 
-            if phasing_info_in_bam and is_tumor:
-                phasing_info = columns[7].split(',')
-            else:
+            if not (phasing_info_in_bam and is_tumor):
                 phasing_info = None
 
             chunk_ref_seq = reference_sequence[pos - reference_start: pos - reference_start + args.max_indel_length].upper()
 
             pileup_tensor, base_list, depth, pass_af, af, alt_info = decode_pileup_bases(args=args,
                                                                                          pos=pos,
-                                                                                         pileup_bases=pileup_bases,
+                                                                                         base_list=base_list,
                                                                                          reference_base=reference_base,
                                                                                          minimum_snp_af_for_candidate=minimum_snp_af_for_candidate,
                                                                                          minimum_indel_af_for_candidate=minimum_indel_af_for_candidate,
@@ -527,8 +604,12 @@ def create_tensor(args):
                                                                                          chunk_ref_seq=chunk_ref_seq,
                                                                                          is_tumor=is_tumor)
 
-            offset = pos - extend_start
-            pileup_tensors[offset] = pileup_tensor
+            # the windows of the candidates end before pos, keep them before pos is added to the buffer
+            while window_pos_index < len(candidate_pos_list) and candidate_pos_list[
+                window_pos_index] + flanking_base_num < pos:
+                pileup_window.keep_window_of(candidate_pos_list[window_pos_index])
+                window_pos_index += 1
+            pileup_window.add(pos, pileup_tensor)
             if pos in candidates_type_dict:
                 alt_info_dict[pos] = alt_info
 
@@ -544,34 +625,55 @@ def create_tensor(args):
                 yield (candidate_pos_list[current_pos_index], is_tumor)
 
                 current_pos_index += 1
+        while window_pos_index < len(candidate_pos_list):
+            pileup_window.keep_window_of(candidate_pos_list[window_pos_index])
+            window_pos_index += 1
         while current_pos_index != len(candidate_pos_list):
             yield (candidate_pos_list[current_pos_index], is_tumor)
             current_pos_index += 1
 
-    normal_bam_pileup_generator = samtools_pileup_generator_from(samtools_mpileup_process=samtools_mpileup_normal_process,is_tumor=False)
-    tumor_bam_pileup_generator = samtools_pileup_generator_from(samtools_mpileup_process=samtools_mpileup_tumor_process)
+    normal_bam_pileup_generator = samtools_pileup_generator_from(pileup_columns=normal_pileup_columns, is_tumor=False)
+    tumor_bam_pileup_generator = samtools_pileup_generator_from(pileup_columns=tumor_pileup_columns)
 
     tensor_count = 0
     for pos in heapq_merge_generator_from(normal_bam_pileup_generator=normal_bam_pileup_generator, tumor_bam_pileup_generator=tumor_bam_pileup_generator):
+        if chunk_range_control is not None and pos > chunk_range_control.end_at(pos):
+            break
         ref_seq = reference_sequence[
                   pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1].upper()
         start_index = pos - flanking_base_num - extend_start
         end_index = start_index + no_of_positions
         if start_index < 0 or end_index >= extend_end - extend_start:
             continue
-        if sum([1 for tensor in normal_pileup_tensors[start_index:end_index] if len(tensor) == 0]) > 0:
-            continue
-
-        if sum([1 for tensor in tumor_pileup_tensors[start_index:end_index] if len(tensor) == 0]) > 0:
-            continue
 
         variant_type = candidates_type_dict[pos] if pos in candidates_type_dict else 'unknown'
 
-        tensor_infos_dict = defaultdict()
-        normal_tensor_string_list = [" ".join(" ".join("%d" % x for x in innerlist) for innerlist in normal_pileup_tensors[start_index:end_index])]
-        tumor_tensor_string_list = [" ".join(" ".join("%d" % x for x in innerlist) for innerlist in tumor_pileup_tensors[start_index:end_index])]
         if pos not in normal_alt_info_dict or pos not in tumor_alt_info_dict:
             continue
+
+        normal_window, tumor_window = normal_pileup_window.window_of(pos), tumor_pileup_window.window_of(pos)
+        if normal_window is None or tumor_window is None:
+            continue
+        if binary_tensor:
+            normal_tensor, tumor_tensor = array(tensor_can_fp.typecode), array(tensor_can_fp.typecode)
+            normal_tensor.frombytes(b''.join(normal_window))
+            tumor_tensor.frombytes(b''.join(tumor_window))
+            tensor_can_fp.write_row(ctg_name=ctg_name,
+                                    pos=pos,
+                                    ref_seq=ref_seq,
+                                    normal_tensor=normal_tensor,
+                                    normal_alt_info=normal_alt_info_dict[pos],
+                                    tumor_tensor=tumor_tensor,
+                                    tumor_alt_info=tumor_alt_info_dict[pos],
+                                    variant_type=variant_type,
+                                    normal_cols=len(normal_tensor) // no_of_positions,
+                                    tumor_cols=len(tumor_tensor) // no_of_positions)
+            tensor_count += 1
+            continue
+
+        tensor_infos_dict = defaultdict()
+        normal_tensor_string_list = [" ".join(normal_window)]
+        tumor_tensor_string_list = [" ".join(tumor_window)]
         tensor_infos_dict['normal'] = (normal_tensor_string_list, [normal_alt_info_dict[pos]])
         tensor_infos_dict['tumor'] = (tumor_tensor_string_list, [tumor_alt_info_dict[pos]])
 
@@ -589,17 +691,20 @@ def create_tensor(args):
                 variant_type)
             tensor_can_fp.stdin.write(tensor)
             tensor_count += 1
-    samtools_mpileup_normal_process.stdout.close()
-    samtools_mpileup_normal_process.wait()
-    samtools_mpileup_tumor_process.stdout.close()
-    samtools_mpileup_tumor_process.wait()
-    if tensor_can_output_path != "PIPE":
+    for samtools_mpileup_process in samtools_mpileup_processes:
+        samtools_mpileup_process.stdout.close()
+        samtools_mpileup_process.wait()
+    if binary_tensor:
+        tensor_can_fp.close()
+    elif tensor_can_output_path != "PIPE":
         tensor_can_fp.stdin.close()
         tensor_can_fp.wait()
         tensor_can_fpo.close()
 
     chunk_info = get_chunk_id(candidates_bed_regions)
-    print("[INFO] {} {} Tensors generated: {}".format(ctg_name, chunk_info, tensor_count))
+    # keep stdout clean for the tensors when streaming them to predict
+    print("[INFO] {} {} Tensors generated: {}".format(ctg_name, chunk_info, tensor_count),
+          file=sys.stderr if tensor_can_output_path == "PIPE" else sys.stdout)
 
 
 def main():
@@ -682,6 +787,10 @@ def main():
     parser.add_argument('--chunk_id', type=int, default=None,
                         help=SUPPRESS)
 
+    ## Prefix of the progress and split files of the chunk scheduler
+    parser.add_argument('--chunk_control_prefix', type=str, default=None,
+                        help=SUPPRESS)
+
     ## Provide the regions to be included in full-alignment based calling
     parser.add_argument('--candidates_bed_regions', type=str, default=None,
                         help=SUPPRESS)
@@ -698,6 +807,14 @@ def main():
     parser.add_argument('--truth_vcf_fn', type=str, default=None,
                         help=SUPPRESS)
 
+    ## Output tensors in the binary tensor format instead of the zstd compressed text format
+    parser.add_argument('--binary_tensor', type=str2bool, default=False,
+                        help=SUPPRESS)
+
+    ## Pileup engine, samtools or pysam (in-process htslib pileup, falls back to samtools if pysam is not installed)
+    parser.add_argument('--pileup_engine', type=str, default="samtools",
+                        help=SUPPRESS)
+
     args = parser.parse_args()
 
     create_tensor(args)
@@ -35,13 +35,19 @@ import logging
 import subprocess
 
 from argparse import ArgumentParser, SUPPRESS
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
 import shared.param as param
 from shared.vcf import VcfReader, VcfWriter
 from shared.utils import subprocess_popen, file_path_from, region_from, \
     reference_sequence_from, str2bool, str_none
 from shared.interval_tree import bed_tree_from, is_region_in
+from shared.pileup import pileup_engine_from, samtools_pileup_columns_from, pysam_pileup_columns_from, regions_from, \
+    paired_pileup_columns_from, padded_regions_from, PYSAM_ENGINE, DEFAULT_MAX_DEPTH
+from shared.tensor_io import BinaryTensorWriter, INT16
+from shared.scheduler import chunk_range_control_from
+from src.create_pair_tensor_pileup import decode_pileup_bases as decode_pileup_tensor_bases, evc_base_from, \
+    channel_size
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 
@@ -52,7 +58,7 @@ class AltInfo(object):
         self.normal_alt_info = normal_alt_info
         self.tumor_alt_info = tumor_alt_info
 
-def decode_pileup_bases(pileup_bases,
+def decode_pileup_bases(base_list,
                         reference_base,
                         min_coverage,
                         minimum_snv_af_for_candidate,
@@ -64,8 +70,8 @@ def decode_pileup_bases(pileup_bases,
                         select_indel_candidates=False,
                         platform="ont"):
     """
-    Decode mpileup input string.
-    pileup_bases: pileup base string for each position, include all mapping information.
+    Decode the pileup bases of a position.
+    base_list: [base, indel] pairs of each read covering the position, see shared/pileup.py.
     reference_base: upper reference base for cigar calculation.
     pileup_dict: dictionary (pos: pos info) which keep read information that cover specific position.
     ref_seq: chunked reference sequence in window, start: center pos - flankingBaseNum, end: center + flankingBaseNum + 1.
@@ -74,30 +80,6 @@ def decode_pileup_bases(pileup_bases,
     has_pileup_candidates: if the candidate is directly obtained from pileup output, then no need to check the af filtering.
     """
 
-    base_idx = 0
-    base_list = []
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx]
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance]  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-        # skip $, the end of read
-        base_idx += 1
-
     pileup_dict = defaultdict(int)
     base_counter = Counter([''.join(item) for item in base_list])
     alt_dict = dict(Counter([''.join(item).upper() for item in base_list]))
@@ -169,6 +151,59 @@ def decode_pileup_bases(pileup_bases,
     return base_list, depth, pass_af, af, af_infos, pileup_infos, tumor_pileup_infos, alt_list, pass_snv_af, pass_indel_af, pileup_list
 
 
+def mq_filtered_from(base_list, read_name_list, raw_mapping_quality, min_mapping_quality):
+    """
+    Drop the reads with mapping quality below min_mapping_quality, in the same way as `samtools mpileup --min-MQ`.
+    """
+    read_idx_list = [idx for idx, mq in enumerate(raw_mapping_quality) if ord(mq) - 33 >= min_mapping_quality]
+    base_list = [base_list[idx] for idx in read_idx_list]
+    read_name_list = [read_name_list[idx] for idx in read_idx_list] if read_name_list is not None else None
+    return base_list, read_name_list
+
+
+def is_mq_sampling_changed(raw_mapping_quality, min_mapping_quality, max_depth):
+    """
+    Whether the reads of a column piled up without --min-MQ and then MQ filtered may differ from the reads that
+    `samtools mpileup --min-MQ` samples. Below the max depth every read is piled up and the filtered reads are the same,
+    once the max depth is reached the low mapping quality reads also count towards it and take the place of reads that
+    --min-MQ would keep, here and at the following positions of the reads left out.
+    """
+    return len(raw_mapping_quality) >= max_depth and any(
+        ord(mq) - 33 < min_mapping_quality for mq in raw_mapping_quality)
+
+
+def write_pileup_tensors(tensor_fn, ctg_name, pos_list, pileup_tensor_dict, reference_sequence, reference_start,
+                         flanking_base_num):
+    """
+    Write the pileup tensors of the candidates in the binary tensor format, the same output as create_pair_tensor_pileup
+    with the candidate bed regions. pileup_tensor_dict: pos: (normal_tensor, normal_alt_info, tumor_tensor,
+    tumor_alt_info), a position without coverage is an all-zero row.
+    """
+    tensor_writer = BinaryTensorWriter(tensor_fn=tensor_fn, dtype=INT16)
+    empty_tensor = [0] * channel_size
+    empty_tensor_infos = (None, None, None, None)
+    for pos in pos_list:
+        _, normal_alt_info, _, tumor_alt_info = pileup_tensor_dict.get(pos, empty_tensor_infos)
+        if normal_alt_info is None or tumor_alt_info is None:
+            continue
+        normal_tensor, tumor_tensor = [], []
+        for window_pos in range(pos - flanking_base_num, pos + flanking_base_num + 1):
+            window_normal_tensor, _, window_tumor_tensor, _ = pileup_tensor_dict.get(window_pos, empty_tensor_infos)
+            normal_tensor.append(window_normal_tensor if window_normal_tensor is not None else empty_tensor)
+            tumor_tensor.append(window_tumor_tensor if window_tumor_tensor is not None else empty_tensor)
+        ref_seq = reference_sequence[
+                  pos - reference_start - flanking_base_num: pos - reference_start + flanking_base_num + 1].upper()
+        tensor_writer.write_row(ctg_name=ctg_name,
+                                pos=pos,
+                                ref_seq=ref_seq,
+                                normal_tensor=normal_tensor,
+                                normal_alt_info=normal_alt_info,
+                                tumor_tensor=tumor_tensor,
+                                tumor_alt_info=tumor_alt_info,
+                                variant_type='unknown')
+    tensor_writer.close()
+
+
 def extract_pair_candidates(args):
     ctg_start = args.ctg_start
     ctg_end = args.ctg_end
@@ -202,6 +237,9 @@ def extract_pair_candidates(args):
     truth_vcf_fn = args.truth_vcf_fn
     is_truth_vcf_provided = truth_vcf_fn is not None
     select_indel_candidates = args.select_indel_candidates
+    pileup_tensor_folder = args.pileup_tensor_folder
+    output_pileup_tensor = pileup_tensor_folder is not None
+    args.max_indel_length = param.max_indel_length if args.max_indel_length is None else args.max_indel_length
 
     hybrid_mode_vcf_fn = args.hybrid_mode_vcf_fn
 
@@ -238,7 +276,9 @@ def extract_pair_candidates(args):
 
     fai_fn = file_path_from(fasta_file_path, suffix=".fai", exit_on_not_found=True, sep='.')
 
-    if chunk_id is not None:
+    # a chunk with a given range (work-aware chunking) only uses the chunk id for naming the outputs
+    is_chunk_range_given = ctg_start is not None and ctg_end is not None
+    if chunk_id is not None and not is_chunk_range_given:
 
         """
         Whole genome calling option, acquire contig start end position from reference fasta index(.fai), then split the
@@ -269,6 +309,8 @@ def extract_pair_candidates(args):
             ctg_end = ctg_start + chunk_size
 
     candidates_pos_set = set([item for item in candidates_pos_set if item >= ctg_start and item <= ctg_end])
+    # the chunk scheduler may end the chunk earlier and run the rest of its range in another chunk
+    chunk_range_control = chunk_range_control_from(args.chunk_control_prefix, ctg_end)
     # 1-based regions [start, end] (start and end inclusive)
     ref_regions = []
     reads_regions = []
@@ -295,22 +337,77 @@ def extract_pair_candidates(args):
     if reference_sequence is None or len(reference_sequence) == 0:
         sys.exit("[ERROR] Failed to load reference sequence from file ({}).".format(fasta_file_path))
 
-    mq_option = ' --min-MQ {}'.format(min_mapping_quality)
+    # the pileup tensors keep the low mapping quality reads in the LMQ channels, the candidate extraction drops them
+    # with mq_filtered_from, which keeps the same reads as --min-MQ unless the max depth is reached
+    pileup_min_mq = 0 if output_pileup_tensor else min_mapping_quality
+    max_depth = args.max_depth if args.max_depth is not None else DEFAULT_MAX_DEPTH
+    mq_option = ' --min-MQ {}'.format(pileup_min_mq)
+    output_mq_option = ' --output-MQ' if output_pileup_tensor else ""
     bq_option = ' --min-BQ {}'.format(min_base_quality)
     read_name_option = ' --output-QNAME' if store_tumor_infos else ' '
+
+    # the tensor windows of the candidates near the bed boundaries extend beyond the bed regions, pileup the padded
+    # regions and only extract candidates in the bed regions
+    pileup_regions = regions_from(reads_regions, bed_fn=confident_bed_fn, ctg_name=ctg_name)
+    pileup_bed_fn = confident_bed_fn
+    pileup_bed_tree = None
+    if output_pileup_tensor and is_confident_bed_file_given:
+        pileup_regions = padded_regions_from(pileup_regions, padding=flankingBaseNum)
+        pileup_bed_tree = bed_tree_from(bed_file_path=confident_bed_fn, contig_name=ctg_name)
+        pileup_bed_fn = os.path.join(candidates_folder, 'bed', '{}_{}.bed'.format(ctg_name, chunk_id))
+        if not os.path.exists(os.path.dirname(pileup_bed_fn)):
+            os.makedirs(os.path.dirname(pileup_bed_fn))
+        with open(pileup_bed_fn, 'w') as output_bed:
+            for region_ctg_name, region_start, region_end in pileup_regions:
+                output_bed.write('\t'.join([region_ctg_name, str(region_start), str(region_end)]) + '\n')
+
     bed_option = ' -l {}'.format(
-        confident_bed_fn) if is_confident_bed_file_given else ""
+        pileup_bed_fn) if is_confident_bed_file_given else ""
     flags_option = ' --excl-flags {} '.format(param.SAMTOOLS_VIEW_FILTER_FLAG)
     max_depth_option = ' --max-depth {} '.format(args.max_depth) if args.max_depth is not None else " "
     reads_regions_option = ' -r {}'.format(" ".join(reads_regions)) if add_read_regions else ""
     # print (add_read_regions, ctg_start, ctg_end, reference_start)
     stdin = None if tumor_bam_file_path != "PIPE" else sys.stdin
     tumor_bam_file_path = tumor_bam_file_path if tumor_bam_file_path != "PIPE" else "-"
-    samtools_command = samtools_execute_command + " mpileup --reverse-del" + read_name_option + reads_regions_option + \
+    samtools_command = samtools_execute_command + " mpileup --reverse-del" + output_mq_option + read_name_option + reads_regions_option + \
                        mq_option + bq_option + bed_option + flags_option + max_depth_option
 
-    samtools_mpileup_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + tumor_bam_file_path), stdin=stdin, stderr=subprocess.PIPE)
+    # the pysam engine reads the BAM files directly, input from stdin is only supported by samtools
+    pileup_engine = pileup_engine_from(args.pileup_engine) if stdin is None else "samtools"
+    samtools_mpileup_process = None
+    normal_samtools_mpileup_process = None
+    if pileup_engine == PYSAM_ENGINE:
+        tumor_pileup_columns = pysam_pileup_columns_from(
+            bam_fn=tumor_bam_file_path,
+            regions=pileup_regions,
+            min_mq=pileup_min_mq,
+            min_bq=min_base_quality,
+            excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+            max_depth=args.max_depth,
+            output_mq=output_pileup_tensor,
+            output_read_name=store_tumor_infos)
+        normal_pileup_columns = pysam_pileup_columns_from(
+            bam_fn=args.normal_bam_fn,
+            regions=pileup_regions,
+            min_mq=pileup_min_mq,
+            min_bq=min_base_quality,
+            excl_flags=param.SAMTOOLS_VIEW_FILTER_FLAG,
+            max_depth=args.max_depth,
+            output_mq=output_pileup_tensor,
+            output_read_name=store_tumor_infos,
+            lazy_base_list=True)
+    else:
+        samtools_mpileup_process = subprocess_popen(
+            shlex.split(samtools_command + ' ' + tumor_bam_file_path), stdin=stdin, stderr=subprocess.PIPE)
+        tumor_pileup_columns = samtools_pileup_columns_from(samtools_mpileup_process,
+                                                            output_mq=output_pileup_tensor,
+                                                            output_read_name=store_tumor_infos)
+        normal_samtools_mpileup_process = subprocess_popen(
+            shlex.split(samtools_command + ' ' + args.normal_bam_fn), stderr=subprocess.PIPE)
+        normal_pileup_columns = samtools_pileup_columns_from(normal_samtools_mpileup_process,
+                                                             output_mq=output_pileup_tensor,
+                                                             output_read_name=store_tumor_infos,
+                                                             lazy_base_list=True)
 
     if alt_fn:
         output_alt_fn = alt_fn
@@ -319,86 +416,136 @@ def extract_pair_candidates(args):
     is_tumor = alt_fn.split('/')[-2].startswith('tumor') if alt_fn else False
     has_pileup_candidates = len(candidates_pos_set)
 
+    def pileup_tensors_from(pos, tumor_column, normal_column):
+        # same as the pileup tensor decoding in create_pair_tensor_pileup
+        reference_base = evc_base_from(reference_sequence[pos - reference_start]).upper()
+        # the positions with an IUPAC reference base are all-zero rows
+        if reference_base not in 'ACGT':
+            return [None, None, None, None]
+        chunk_ref_seq = reference_sequence[pos - reference_start: pos - reference_start + args.max_indel_length].upper()
+        pileup_tensors = []
+        for column, is_tumor in ((normal_column, False), (tumor_column, True)):
+            if column is None:
+                pileup_tensors += [None, None]
+                continue
+            _, base_list, raw_base_quality, raw_mapping_quality, _, _ = column
+            pileup_tensor, _, _, _, _, alt_info = decode_pileup_tensor_bases(args=args,
+                                                                            pos=pos,
+                                                                            base_list=base_list() if callable(
+                                                                                base_list) else base_list,
+                                                                            reference_base=reference_base,
+                                                                            minimum_snp_af_for_candidate=minimum_snv_af_for_candidate,
+                                                                            minimum_indel_af_for_candidate=minimum_indel_af_for_candidate,
+                                                                            has_pileup_candidates=True,
+                                                                            candidates_type_dict={pos: 'unknown'},
+                                                                            mapping_quality=[ord(mq) - 33 for mq in raw_mapping_quality],
+                                                                            base_quality=[ord(bq) - 33 for bq in raw_base_quality],
+                                                                            chunk_ref_seq=chunk_ref_seq,
+                                                                            is_tumor=is_tumor)
+            pileup_tensors += [pileup_tensor, alt_info]
+        return pileup_tensors
+
+    # the columns of the last flankingBaseNum positions are kept, so that the tensor window of a candidate can be decoded
+    # once the candidate is accepted, the following positions of the window are decoded as they come
+    pileup_window = deque(maxlen=flankingBaseNum + 1)
+    pileup_tensor_dict = {}
+
+    def decode_pileup_window():
+        center_pos = pileup_window[-1][0]
+        for window_column in pileup_window:
+            if window_column[0] >= center_pos - flankingBaseNum and window_column[0] not in pileup_tensor_dict:
+                pileup_tensor_dict[window_column[0]] = pileup_tensors_from(*window_column)
+        return center_pos + flankingBaseNum
+
+    high_normal_af_set = set()
+    high_af_gap_set = set()
+    mq_sampling_changed_count = 0
     candidates_dict = defaultdict(str)
-    for row in samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-        columns = row.strip().split('\t')
-        pos = int(columns[1])
+    tensor_window_end = 0
+    # tumor and normal are scanned in one pass, the tumor column of a position is processed first and the normal
+    # column is only decoded when the position is a candidate
+    for pos, tumor_column, normal_column in paired_pileup_columns_from(tumor_pileup_columns, normal_pileup_columns):
+        # once the chunk end is reached, the positions within the flanking window only complete the pileup tensors
+        is_chunk_end_reached = chunk_range_control is not None and pos > chunk_range_control.end_at(pos)
+        if is_chunk_end_reached and (not output_pileup_tensor or pos > chunk_range_control.ctg_end + flankingBaseNum):
+            break
+        if output_pileup_tensor:
+            if len(pileup_window) and pileup_window[-1][0] in candidates_set:
+                tensor_window_end = decode_pileup_window()
+            pileup_window.append((pos, tumor_column, normal_column))
+            if pos <= tensor_window_end:
+                pileup_tensor_dict[pos] = pileup_tensors_from(pos, tumor_column, normal_column)
+            if is_chunk_end_reached or (pileup_bed_tree is not None and not is_region_in(pileup_bed_tree, ctg_name, pos - 1)):
+                continue
+            if tumor_column is not None:
+                mq_sampling_changed_count += is_mq_sampling_changed(tumor_column[3], min_mapping_quality, max_depth)
+                base_list, read_name_list = mq_filtered_from(tumor_column[1], tumor_column[4], tumor_column[3],
+                                                             min_mapping_quality)
+                tumor_column = (pos, base_list, None, None, read_name_list, None) if len(base_list) else None
 
-        pileup_bases = columns[4]
-        read_name_list = columns[6].split(',') if store_tumor_infos else []
         reference_base = reference_sequence[pos - reference_start].upper()
         if reference_base.upper() not in "ACGT":
             continue
-        is_truth_candidate = pos in truths_variant_dict
-        minimum_snv_af_for_candidate = minimum_snv_af_for_truth if is_truth_candidate and minimum_snv_af_for_truth else minimum_snv_af_for_candidate
-        minimum_indel_af_for_candidate = minimum_indel_af_for_truth if is_truth_candidate and minimum_indel_af_for_truth else minimum_indel_af_for_candidate
-        base_list, depth, pass_af, af, af_infos, pileup_infos, tumor_pileup_infos, alt_list, pass_snv_af, pass_indel_af, pileup_list = decode_pileup_bases(
-            pileup_bases=pileup_bases,
-            reference_base=reference_base,
-            min_coverage=min_coverage,
-            minimum_snv_af_for_candidate=minimum_snv_af_for_candidate,
-            minimum_indel_af_for_candidate=minimum_indel_af_for_candidate,
-            alternative_base_num=alternative_base_num,
-            has_pileup_candidates=has_pileup_candidates,
-            read_name_list=read_name_list,
-            is_tumor=is_tumor,
-            select_indel_candidates=select_indel_candidates
-        )
-
 
-        if pos in hybrid_candidate_set:
-            tumor_alt_info = str(depth) + '-' + ' '.join([' '.join([item[0], str(item[1])]) for item in pileup_list])
-            hybrid_info_dict[pos] = AltInfo(ref_base=reference_base, tumor_alt_info=tumor_alt_info)
-
-        if pass_af and alt_fn:
-            depth_list = [str(depth)] if output_depth else []
-            alt_info_list = [af_infos, pileup_infos, tumor_pileup_infos] if output_alt_info else []
-            alt_fp.write('\t'.join([ctg_name, str(pos), reference_base] + depth_list + alt_info_list) + '\n')
-
-        if pass_af:
-            candidates_set.add(pos)
-            candidates_dict[pos] = (alt_list, depth)
-            if pass_snv_af:
+        if tumor_column is not None:
+            _, base_list, _, _, read_name_list, _ = tumor_column
+            read_name_list = read_name_list if store_tumor_infos else []
+            is_truth_candidate = pos in truths_variant_dict
+            minimum_snv_af_for_candidate = minimum_snv_af_for_truth if is_truth_candidate and minimum_snv_af_for_truth else minimum_snv_af_for_candidate
+            minimum_indel_af_for_candidate = minimum_indel_af_for_truth if is_truth_candidate and minimum_indel_af_for_truth else minimum_indel_af_for_candidate
+            base_list, depth, pass_af, af, af_infos, pileup_infos, tumor_pileup_infos, alt_list, pass_snv_af, pass_indel_af, pileup_list = decode_pileup_bases(
+                base_list=base_list,
+                reference_base=reference_base,
+                min_coverage=min_coverage,
+                minimum_snv_af_for_candidate=minimum_snv_af_for_candidate,
+                minimum_indel_af_for_candidate=minimum_indel_af_for_candidate,
+                alternative_base_num=alternative_base_num,
+                has_pileup_candidates=has_pileup_candidates,
+                read_name_list=read_name_list,
+                is_tumor=is_tumor,
+                select_indel_candidates=select_indel_candidates
+            )
+
+
+            if pos in hybrid_candidate_set:
+                tumor_alt_info = str(depth) + '-' + ' '.join([' '.join([item[0], str(item[1])]) for item in pileup_list])
+                hybrid_info_dict[pos] = AltInfo(ref_base=reference_base, tumor_alt_info=tumor_alt_info)
+
+            if pass_af and alt_fn:
+                depth_list = [str(depth)] if output_depth else []
+                alt_info_list = [af_infos, pileup_infos, tumor_pileup_infos] if output_alt_info else []
+                alt_fp.write('\t'.join([ctg_name, str(pos), reference_base] + depth_list + alt_info_list) + '\n')
+
+            if pass_af:
+                candidates_set.add(pos)
+                candidates_dict[pos] = (alt_list, depth)
+                if pass_snv_af:
+                    snv_candidates_set.add(pos)
+                if select_indel_candidates and pass_indel_af:
+                    indel_candidates_set.add(pos)
+
+            if not pass_af and (pos in hybrid_candidate_set):
+                candidates_set.add(pos)
                 snv_candidates_set.add(pos)
-            if select_indel_candidates and pass_indel_af:
-                indel_candidates_set.add(pos)
-
-        if not pass_af and (pos in hybrid_candidate_set):
-            candidates_set.add(pos)
-            snv_candidates_set.add(pos)
-            if select_indel_candidates:
-                indel_candidates_set.add(pos)
-
-    # scan the normal_bam
-    bed_path = os.path.join(candidates_folder, "bed", '{}_{}.bed'.format(ctg_name, chunk_id))
-    if not os.path.exists(os.path.join(candidates_folder, 'bed')):
-        output = subprocess.run("mkdir -p {}".format(os.path.join(candidates_folder, 'bed')), shell=True)
-    output_bed = open(bed_path, 'w')
-    for pos in sorted(list(candidates_set)):
-        output_bed.write('\t'.join([ctg_name, str(pos - 1), str(pos)]) + '\n')
-    output_bed.close()
-
-    normal_samtools_mpileup_process = subprocess_popen(
-        shlex.split(samtools_command + ' ' + args.normal_bam_fn + ' -l ' + bed_path), stdin=stdin, stderr=subprocess.PIPE)
-
-    high_normal_af_set = set()
-    high_af_gap_set = set()
-    for row in normal_samtools_mpileup_process.stdout:  # chr position N depth seq BQ read_name mapping_quality phasing_info
-        columns = row.strip().split('\t')
-        pos = int(columns[1])
+                if select_indel_candidates:
+                    indel_candidates_set.add(pos)
 
-        pileup_bases = columns[4]
-        read_name_list = columns[6].split(',') if store_tumor_infos else []
-        reference_base = reference_sequence[pos - reference_start].upper()
-        if pos not in candidates_set:
-            continue
-        if reference_base.upper() not in "ACGT":
+        if normal_column is None or pos not in candidates_set:
             continue
+        _, base_list, _, raw_mapping_quality, read_name_list, _ = normal_column
+        base_list = base_list()
+        if output_pileup_tensor:
+            mq_sampling_changed_count += is_mq_sampling_changed(raw_mapping_quality, min_mapping_quality, max_depth)
+            base_list, read_name_list = mq_filtered_from(base_list, read_name_list, raw_mapping_quality,
+                                                         min_mapping_quality)
+            if len(base_list) == 0:
+                continue
+        read_name_list = read_name_list if store_tumor_infos else []
         is_truth_candidate = pos in truths_variant_dict
         minimum_snv_af_for_candidate = minimum_snv_af_for_truth if is_truth_candidate and minimum_snv_af_for_truth else minimum_snv_af_for_candidate
         minimum_indel_af_for_candidate = minimum_indel_af_for_truth if is_truth_candidate and minimum_indel_af_for_truth else minimum_indel_af_for_candidate
         base_list, depth, pass_af, af, af_infos, pileup_infos, normal_pileup_infos, normal_alt_list, pass_snv_af, pass_indel_af, pileup_list = decode_pileup_bases(
-            pileup_bases=pileup_bases,
+            base_list=base_list,
             reference_base=reference_base,
             min_coverage=min_coverage,
             minimum_snv_af_for_candidate=minimum_snv_af_for_candidate,
@@ -466,6 +613,9 @@ def extract_pair_candidates(args):
                             indel_candidates_set.remove(pos)
                             high_af_gap_set.add(pos)
 
+    if output_pileup_tensor and len(pileup_window) and pileup_window[-1][0] in candidates_set:
+        decode_pileup_window()
+
     snv_candidates_list = sorted([pos for pos in candidates_set if pos in snv_candidates_set])
     if select_indel_candidates:
         indel_candidates_list = sorted([pos for pos in candidates_set if pos in indel_candidates_set])
@@ -515,6 +665,11 @@ def extract_pair_candidates(args):
                                                                          chunk_id,
                                                                          chunk_num,
                                                                          len(snv_candidates_list)))
+    if mq_sampling_changed_count:
+        print("[WARNING] {} chunk {}/{}: {} positions reached the max depth {} with low mapping quality reads, the "
+              "candidates around them may differ from a --min-MQ {} pileup".format(ctg_name, chunk_id, chunk_num,
+                                                                                   mq_sampling_changed_count,
+                                                                                   max_depth, min_mapping_quality))
     if candidates_folder is not None and len(snv_candidates_list):
         all_candidates_regions = []
         region_num = len(snv_candidates_list) // split_bed_size + 1 if len(
@@ -529,6 +684,14 @@ def extract_pair_candidates(args):
                 output_file.write('\n'.join(
                     ['\t'.join([ctg_name, str(x - flankingBaseNum - 1), str(x + flankingBaseNum + 1)]) for x in
                      split_output]) + '\n')  # bed format
+            if output_pileup_tensor:
+                write_pileup_tensors(tensor_fn=os.path.join(pileup_tensor_folder, os.path.basename(output_path)),
+                                     ctg_name=ctg_name,
+                                     pos_list=split_output,
+                                     pileup_tensor_dict=pileup_tensor_dict,
+                                     reference_sequence=reference_sequence,
+                                     reference_start=reference_start,
+                                     flanking_base_num=flankingBaseNum)
 
         all_candidates_regions_path = os.path.join(candidates_folder,
                                                    'CANDIDATES_FILE_{}_{}'.format(ctg_name, chunk_id))
@@ -549,6 +712,15 @@ def extract_pair_candidates(args):
                 output_file.write('\n'.join(
                     ['\t'.join([ctg_name, str(x - flankingBaseNum - 1), str(x + flankingBaseNum + 1)]) for x in
                      split_output]) + '\n')  # bed format
+            if output_pileup_tensor:
+                write_pileup_tensors(
+                    tensor_fn=os.path.join(pileup_tensor_folder, 'indel_' + os.path.basename(output_path)),
+                    ctg_name=ctg_name,
+                    pos_list=split_output,
+                    pileup_tensor_dict=pileup_tensor_dict,
+                    reference_sequence=reference_sequence,
+                    reference_start=reference_start,
+                    flanking_base_num=flankingBaseNum)
 
         all_candidates_regions_path = os.path.join(candidates_folder,
                                                    'INDEL_CANDIDATES_FILE_{}_{}'.format(ctg_name, chunk_id))
@@ -565,8 +737,10 @@ def extract_pair_candidates(args):
                 output_info = '\t'.join([ctg_name, str(k), v.ref_base, v.normal_alt_info, v.tumor_alt_info])
                 output_file.write(output_info + '\n')
 
-    samtools_mpileup_process.stdout.close()
-    samtools_mpileup_process.wait()
+    for process in (samtools_mpileup_process, normal_samtools_mpileup_process):
+        if process is not None:
+            process.stdout.close()
+            process.wait()
 
     if alt_fn:
         alt_fp.close()
@@ -686,9 +860,24 @@ def main():
     parser.add_argument('--chunk_id', type=int, default=None,
                         help=SUPPRESS)
 
+    ## Prefix of the progress and split files of the chunk scheduler
+    parser.add_argument('--chunk_control_prefix', type=str, default=None,
+                        help=SUPPRESS)
+
     parser.add_argument('--flanking', type=int, default=None,
                         help=SUPPRESS)
 
+    ## Pileup engine, samtools or pysam (in-process htslib pileup, falls back to samtools if pysam is not installed)
+    parser.add_argument('--pileup_engine', type=str, default="samtools",
+                        help=SUPPRESS)
+
+    ## Also write the binary pileup tensors of the candidates into the folder, create_pair_tensor_pileup is not needed
+    parser.add_argument('--pileup_tensor_folder', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Maximum indel length of the pileup tensors
+    parser.add_argument('--max_indel_length', type=int, default=None,
+                        help=SUPPRESS)
 
     args = parser.parse_args()
 
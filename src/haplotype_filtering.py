@@ -1,4 +1,5 @@
 import os
+import copy
 import shlex
 import gc
 import subprocess
@@ -6,11 +7,13 @@ import concurrent.futures
 
 from collections import Counter
 from argparse import ArgumentParser, SUPPRESS
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import shared.param as param
 from shared.vcf import VcfReader, VcfWriter
 from shared.utils import str2bool, str_none, reference_sequence_from, subprocess_popen
+from shared.haplotag import ReadHaplotypeAssigner
+from shared.pileup import base_list_with_read_ends_from
 
 HIGH_QUAL = 0.9
 LOW_AF = 0.1
@@ -18,42 +21,41 @@ min_hom_germline_af = 0.75
 eps = 0.2
 
 def get_base_list(columns):
-    pileup_bases = columns[4]
-
-    base_idx = 0
-    base_list = []
-    read_end_set = set()
-    read_start_set = set()
-    while base_idx < len(pileup_bases):
-        base = pileup_bases[base_idx].upper()
-        if base == '+' or base == '-':
-            base_idx += 1
-            advance = 0
-            while True:
-                num = pileup_bases[base_idx]
-                if num.isdigit():
-                    advance = advance * 10 + int(num)
-                    base_idx += 1
-                else:
-                    break
-            base_list[-1][1] = base + pileup_bases[base_idx: base_idx + advance].upper()  # add indel seq
-            base_idx += advance - 1
-
-        elif base in "ACGTNacgtn#*":
-            base_list.append([base, ""])
-        elif base == '^':  # start of read, next base is mq, update mq info
-            base_idx += 1
-            read_start_set.add(len(base_list) - 1)
-        # skip $, the end of read
-        if base == "$":
-            read_end_set.add(len(base_list) - 1)
-        base_idx += 1
+    base_list, read_start_set, read_end_set = base_list_with_read_ends_from(columns[4])
+    base_list = [[base.upper(), indel.upper()] for base, indel in base_list]
     read_start_end_set = read_start_set if len(read_start_set) > len(read_end_set) else read_end_set
     upper_base_counter = Counter([''.join(item).upper() for item in base_list])
     return upper_base_counter, base_list, read_start_end_set
 
 
-def haplotype_filter_per_pos(args):
+def phased_vcf_fn_from(args, ctg_name):
+    """
+    Return the phased VCF of the contig for assigning the read haplotypes, or None if the HP tags in the BAM are used.
+    """
+    phased_vcf_fn = args.tumor_phased_vcf_fn
+    if phased_vcf_fn is None:
+        return None
+    if not os.path.exists(phased_vcf_fn):
+        phased_vcf_fn += ctg_name + '.vcf.gz'
+    return phased_vcf_fn
+
+
+def read_haplotype_assigner_from(args, phased_vcf_fn, ctg_name):
+    return ReadHaplotypeAssigner(phased_vcf_fn=phased_vcf_fn,
+                                 ctg_name=ctg_name,
+                                 samtools=args.samtools,
+                                 tabix=args.tabix,
+                                 min_mq=args.min_mq)
+
+
+def haplotype_filter_per_pos(args, pileup_rows=None, reference_sequence=None, read_hap_dict=None):
+    """
+    Haplotype filtering of the variant at args.pos, return the output row "ctg_name pos pass_hap phaseable".
+    pileup_rows: `samtools mpileup --output-QNAME --output-extra HP` rows of the window, and reference_sequence: the
+    reference of the window, both are generated for the single position if not given.
+    read_hap_dict: {read_name: HP} assigned from the phased VCF, the pileup rows have no HP column if it is given, it
+    is assigned for the reads of the window if args.tumor_phased_vcf_fn is given.
+    """
     pos = args.pos
     ctg_name = args.ctg_name
     ref_base = args.ref_base
@@ -94,17 +96,22 @@ def haplotype_filter_per_pos(args):
     flanking = args.flanking
 
     ctg_range = "{}:{}-{}".format(ctg_name, pos - flanking, pos + flanking + 1)
-    samtools_command = "{} mpileup  --min-MQ {} --min-BQ {} --excl-flags 2316 -r {} --output-QNAME --output-extra HP ".format(
-        samtools, min_mq, min_bq, ctg_range)
+    phased_vcf_fn = phased_vcf_fn_from(args, ctg_name)
+    if read_hap_dict is None and phased_vcf_fn is not None:
+        read_hap_dict = read_haplotype_assigner_from(args, phased_vcf_fn, ctg_name).read_haplotypes_of_bam(
+            bam_fn=tumor_bam_fn, regions=[ctg_range])
+    phasing_option = "--output-extra HP " if read_hap_dict is None else ""
+    samtools_command = "{} mpileup  --min-MQ {} --min-BQ {} --excl-flags 2316 -r {} --output-QNAME {}".format(
+        samtools, min_mq, min_bq, ctg_range, phasing_option)
 
     tumor_samtools_command = samtools_command + tumor_bam_fn
 
-
-    reference_sequence = reference_sequence_from(
-        samtools_execute_command=samtools,
-        fasta_file_path=ref_fn,
-        regions=[ctg_range]
-    )
+    if reference_sequence is None:
+        reference_sequence = reference_sequence_from(
+            samtools_execute_command=samtools,
+            fasta_file_path=ref_fn,
+            regions=[ctg_range]
+        )
 
     # tumor
     pos_dict = defaultdict(defaultdict)
@@ -117,8 +124,11 @@ def haplotype_filter_per_pos(args):
     homo_germline_pos_set = set([int(item[0]) for item in homo_germline_set])
     hetero_germline_pos_set = set([int(item[0]) for item in hetero_germline_set])
 
-    samtools_mpileup_tumor_process = subprocess_popen(shlex.split(tumor_samtools_command), stderr=subprocess.PIPE,)
-    for row in samtools_mpileup_tumor_process.stdout:
+    samtools_mpileup_tumor_process = None
+    if pileup_rows is None:
+        samtools_mpileup_tumor_process = subprocess_popen(shlex.split(tumor_samtools_command), stderr=subprocess.PIPE,)
+        pileup_rows = samtools_mpileup_tumor_process.stdout
+    for row in pileup_rows:
         columns = row.split('\t')
         read_name_list = columns[6].split(',')
 
@@ -126,10 +136,15 @@ def haplotype_filter_per_pos(args):
         ctg = columns[0]
         ctg = p if args.ctg_name is not None else (ctg, p)
         if ctg in hetero_germline_pos_set or p == pos:
-            phasing_info = columns[7].split(',')
-            for hap_idx, hap in enumerate(phasing_info):
-                if hap in '12' and read_name_list[hap_idx] not in hap_dict:
-                    hap_dict[read_name_list[hap_idx]] = int(hap)
+            if read_hap_dict is not None:
+                for read_name in read_name_list:
+                    if read_name in read_hap_dict:
+                        hap_dict[read_name] = read_hap_dict[read_name]
+            else:
+                phasing_info = columns[7].split(',')
+                for hap_idx, hap in enumerate(phasing_info):
+                    if hap in '12' and read_name_list[hap_idx] not in hap_dict:
+                        hap_dict[read_name_list[hap_idx]] = int(hap)
 
         base_counter, base_list, read_start_end_set = get_base_list(columns)
 
@@ -177,8 +192,9 @@ def haplotype_filter_per_pos(args):
             continue
         pos_counter_dict[p] = base_counter
 
-    samtools_mpileup_tumor_process.stdout.close()
-    samtools_mpileup_tumor_process.wait()
+    if samtools_mpileup_tumor_process is not None:
+        samtools_mpileup_tumor_process.stdout.close()
+        samtools_mpileup_tumor_process.wait()
 
     # near to read start end and have high overlap
     if len(all_read_start_end_set.intersection(alt_base_read_name_set)) >= 0.3 * len(alt_base_read_name_set):
@@ -337,9 +353,119 @@ def haplotype_filter_per_pos(args):
 
     if debug:
         info_list = [str(item) for item in [pass_hetero, pass_homo, pass_hetero_both_side, pass_read_start_end, pass_bq, pass_co_exist] + ALL_HAP_LIST + HAP_LIST]
-        print(' '.join([ctg_name, str(pos), str(pass_hap), str(phaseable)] + info_list))
-    else:
-        print(' '.join([ctg_name, str(pos), str(pass_hap), str(phaseable)]))
+        return ' '.join([ctg_name, str(pos), str(pass_hap), str(phaseable)] + info_list)
+    return ' '.join([ctg_name, str(pos), str(pass_hap), str(phaseable)])
+
+
+def haplotype_filter_batch(variant_batch):
+    """
+    Haplotype filtering of a batch of variants of one contig in process. The reference is fetched once for the batch,
+    the reads of all variant windows are streamed by one `samtools view -M` (multi-region iterator, each read once) into
+    one `samtools mpileup`, and each pileup row is dispatched to the windows covering it.
+    variant_batch: (ctg_name, [(pos, ref_base, alt_base, af, qual, hetero_info, homo_info), ...] sorted by pos)
+    """
+    ctg_name, variant_list = variant_batch
+    flanking = args.flanking
+    tumor_bam_fn = args.tumor_bam_fn
+    if not os.path.exists(tumor_bam_fn):
+        tumor_bam_fn += ctg_name + '.bam'
+
+    # 1-based inclusive windows, the same as the ctg_range of haplotype_filter_per_pos
+    window_list = [(item[0] - flanking, item[0] + flanking + 1) for item in variant_list]
+    region_list = []
+    for start, end in window_list:
+        if len(region_list) and start <= region_list[-1][1] + 1:
+            region_list[-1][1] = max(end, region_list[-1][1])
+        else:
+            region_list.append([start, end])
+
+    reference_start = window_list[0][0]
+    reference_sequence = reference_sequence_from(
+        samtools_execute_command=args.samtools,
+        fasta_file_path=args.ref_fn,
+        regions=["{}:{}-{}".format(ctg_name, reference_start, window_list[-1][1])]
+    )
+
+    regions = ["{}:{}-{}".format(ctg_name, start, end) for start, end in region_list]
+    read_hap_dict = None
+    phased_vcf_fn = phased_vcf_fn_from(args, ctg_name)
+    if phased_vcf_fn is not None:
+        read_hap_dict = read_haplotype_assigner_from(args, phased_vcf_fn, ctg_name).read_haplotypes_of_bam(
+            bam_fn=tumor_bam_fn, regions=regions)
+    phasing_option = "--output-extra HP " if read_hap_dict is None else ""
+    view_command = "{} view -u -M {} {}".format(args.samtools, tumor_bam_fn, ' '.join(regions))
+    mpileup_command = "{} mpileup  --min-MQ {} --min-BQ {} --excl-flags 2316 --output-QNAME {}-".format(
+        args.samtools, args.min_mq, args.min_bq, phasing_option)
+    samtools_view_process = subprocess.Popen(shlex.split(view_command), stdout=subprocess.PIPE)
+    samtools_mpileup_process = subprocess_popen(shlex.split(mpileup_command), stdin=samtools_view_process.stdout,
+                                                stderr=subprocess.PIPE)
+    samtools_view_process.stdout.close()
+
+    output_rows = []
+
+    def filter_variant(variant_idx):
+        pos, ref_base, alt_base, af, qual, hetero_info, homo_info = variant_list[variant_idx]
+        start, end = window_list[variant_idx]
+        variant_args = copy.copy(args)
+        variant_args.ctg_name = ctg_name
+        variant_args.pos = pos
+        variant_args.ref_base = ref_base
+        variant_args.alt_base = alt_base
+        variant_args.af = af
+        variant_args.qual = qual
+        variant_args.hetero_info = hetero_info
+        variant_args.homo_info = homo_info
+        output_rows.append(haplotype_filter_per_pos(
+            args=variant_args,
+            pileup_rows=[row for p, row in pileup_row_buffer if start <= p <= end],
+            reference_sequence=reference_sequence[start - reference_start: end - reference_start + 1],
+            read_hap_dict=read_hap_dict))
+
+    # rows arrive sorted by position, a variant is filtered once the rows pass the end of its window
+    pileup_row_buffer = deque()
+    variant_idx = 0
+    for row in samtools_mpileup_process.stdout:
+        if variant_idx == len(variant_list):
+            continue
+        p = int(row.split('\t', 2)[1])
+        while variant_idx < len(variant_list) and p > window_list[variant_idx][1]:
+            filter_variant(variant_idx)
+            variant_idx += 1
+        if variant_idx == len(variant_list):
+            continue
+        while len(pileup_row_buffer) and pileup_row_buffer[0][0] < window_list[variant_idx][0]:
+            pileup_row_buffer.popleft()
+        if p >= window_list[variant_idx][0]:
+            pileup_row_buffer.append((p, row))
+    while variant_idx < len(variant_list):
+        filter_variant(variant_idx)
+        variant_idx += 1
+
+    samtools_mpileup_process.stdout.close()
+    samtools_mpileup_process.wait()
+    samtools_view_process.wait()
+    return output_rows
+
+
+def batched_haplotype_filter_rows_from(variant_dict, batch_size, threads):
+    """
+    Group the variants by contig, sort them by position and filter batch_size variants per task in a worker pool.
+    variant_dict: (ctg_name, pos): (ref_base, alt_base, af, qual, hetero_info, homo_info)
+    """
+    ctg_variant_dict = defaultdict(list)
+    for (ctg_name, pos), variant_infos in variant_dict.items():
+        ctg_variant_dict[ctg_name].append((pos,) + variant_infos)
+
+    variant_batch_list = []
+    for ctg_name, variant_list in ctg_variant_dict.items():
+        variant_list = sorted(variant_list, key=lambda x: x[0])
+        for idx in range(0, len(variant_list), batch_size):
+            variant_batch_list.append((ctg_name, variant_list[idx: idx + batch_size]))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as exec:
+        for output_rows in exec.map(haplotype_filter_batch, variant_batch_list):
+            for row in output_rows:
+                yield row
 
 
 def update_filter_info(args, key, row_str, phasable_set, fail_set_list, fail_dict=None):
@@ -461,6 +587,7 @@ def haplotype_filter(args):
                              show_ref_calls=True)
 
     hap_info_output_path = os.path.join(output_dir, "HAP_INFO")
+    batch_variant_dict = {}
     with open(hap_info_output_path, 'w') as f:
         for key, POS in input_variant_dict.items():
             ctg_name = args.ctg_name if args.ctg_name is not None else key[0]
@@ -480,6 +607,8 @@ def haplotype_filter(args):
             info_list = [ctg_name, str(pos), POS.reference_bases, POS.alternate_bases[0], str(POS.af), str(POS.qual), \
                          ','.join(hetero_flanking_list), ','.join(homo_flanking_list)]
             f.write(' '.join(info_list) + '\n')
+            batch_variant_dict[(ctg_name, pos)] = (POS.reference_bases, POS.alternate_bases[0], POS.af, POS.qual,
+                                                   ','.join(hetero_flanking_list), ','.join(homo_flanking_list))
 
     file_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
     main_entry = os.path.join(file_directory, "clairs.py")
@@ -495,19 +624,28 @@ def haplotype_filter(args):
     parallel_command += " --homo_info {8}"
     parallel_command += " --samtools " + str(args.samtools)
     parallel_command += " --tumor_bam_fn " + str(args.tumor_bam_fn)
+    parallel_command += " --tumor_phased_vcf_fn " + str(args.tumor_phased_vcf_fn) if args.tumor_phased_vcf_fn is not None else ""
+    parallel_command += " --tabix " + str(args.tabix)
     parallel_command += " --ref_fn " + str(args.ref_fn)
     parallel_command += " --debug " if args.debug else ""
     parallel_command += " --flanking " + str(args.flanking) if args.flanking is not None else ""
     parallel_command += " :::: " + str(hap_info_output_path)
 
-    haplotype_filter_process = subprocess_popen(shlex.split(parallel_command))
+    haplotype_filter_process = None
+    if args.batch_size is not None:
+        haplotype_filter_rows = batched_haplotype_filter_rows_from(variant_dict=batch_variant_dict,
+                                                                   batch_size=args.batch_size,
+                                                                   threads=threads_low)
+    else:
+        haplotype_filter_process = subprocess_popen(shlex.split(parallel_command))
+        haplotype_filter_rows = haplotype_filter_process.stdout
 
     total_num = 0
     phasable_set = set()
     fail_set = set()
     fail_dict = defaultdict()
 
-    for row in haplotype_filter_process.stdout:
+    for row in haplotype_filter_rows:
         columns = row.rstrip().split()
         if len(columns) < 4:
             continue
@@ -523,8 +661,9 @@ def haplotype_filter(args):
         if total_num > 0 and total_num % 1000 == 0:
             print("[INFO] Processing in {}, total processed positions: {}".format(ctg_name, total_num))
 
-    haplotype_filter_process.stdout.close()
-    haplotype_filter_process.wait()
+    if haplotype_filter_process is not None:
+        haplotype_filter_process.stdout.close()
+        haplotype_filter_process.wait()
 
     fail_set_list = [fail_set]
 
@@ -647,13 +786,25 @@ def main():
     parser.add_argument('--qual', type=float, default=None,
                         help=SUPPRESS)
 
+    ## Filter batches of variants sorted by position in a worker pool instead of one process per variant
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help=SUPPRESS)
+
+    ## Assign the read haplotypes from the phased VCF (or the prefix of the contig VCFs) instead of the HP tags in the BAM
+    parser.add_argument('--tumor_phased_vcf_fn', type=str, default=None,
+                        help=SUPPRESS)
+
+    ## Path to the 'tabix' for reading the phased VCF
+    parser.add_argument('--tabix', type=str, default="tabix",
+                        help=SUPPRESS)
+
     global args
     args = parser.parse_args()
 
     if args.pos is None:
         haplotype_filter(args)
     else:
-        haplotype_filter_per_pos(args)
+        print(haplotype_filter_per_pos(args))
 
 if __name__ == "__main__":
     main()
@@ -355,7 +355,12 @@ def samtools_view_generator_from(samtools_view_process, aligned_reads, pileup, c
     yield None, None
 
 
-def reads_realignment(args):
+def reads_realignment(args, save_file_fp=None):
+    """
+    Realign the reads near the candidate position and output the realigned reads in SAM format.
+    save_file_fp: object with a writable `stdin` taking the realigned reads (e.g. a samtools process), in place of
+    --read_fn.
+    """
     POS = args.pos
     args.ctg_start = POS - args.realign_flanking_window
     args.ctg_end = POS + args.realign_flanking_window
@@ -415,7 +420,9 @@ def reads_realignment(args):
         shlex.split(samtools_view_command)
     )
 
-    if read_fn and read_fn == 'PIPE':
+    if save_file_fp is not None:
+        read_fn = 'PIPE'
+    elif read_fn and read_fn == 'PIPE':
         save_file_fp = TensorStdout(sys.stdout)
     elif read_fn:
         save_file_fp = subprocess_popen(shlex.split("{} view -bh - -o {}".format(samtools_execute_command, read_fn + (
@@ -659,7 +666,7 @@ def reads_realignment(args):
         save_file_fp.wait()
 
 
-def main():
+def realign_reads_parser():
     parser = ArgumentParser(description="Reads realignment")
 
     parser.add_argument('--bam_fn', type=str, default=None,
@@ -719,6 +726,12 @@ def main():
     parser.add_argument('--max_distance', type=int, default=50,
                         help=SUPPRESS)
 
+    return parser
+
+
+def main():
+    parser = realign_reads_parser()
+
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         sys.exit(1)
@@ -1,5 +1,7 @@
 import sys
 import os
+import shlex
+import tempfile
 import subprocess
 import concurrent.futures
 
@@ -9,11 +11,15 @@ from collections import defaultdict
 
 import shared.param as param
 from shared.vcf import VcfReader, VcfWriter
-from shared.utils import str2bool
+from shared.utils import str2bool, subprocess_popen
 
 file_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 main_entry = os.path.join(file_directory, "{}.py".format(param.caller_name))
 
+# nearby variants share one worker task and one raw samtools mpileup
+max_variant_group_distance = 1000
+max_variant_group_span = 5000
+
 
 def get_base_list(columns):
     pileup_bases = columns[4]
@@ -45,71 +51,123 @@ def get_base_list(columns):
     return upper_base_counter, base_list
 
 
-def extract_base(POS):
-    pos = POS.pos
-    ref_base = POS.reference_bases
-    alt_base = POS.alternate_bases[0]
-
+def pileup_rows_from(samtools_mpileup_output, pos_set):
+    pileup_rows = {}
+    for row in samtools_mpileup_output:
+        columns = row.rstrip().split('\t')
+        if len(columns) >= 4 and int(columns[1]) in pos_set:
+            pileup_rows[int(columns[1])] = columns
+    return pileup_rows
+
+
+def variant_groups_from(variant_list):
+    """
+    Split the variants into groups of nearby variants of the same contig, which share one worker task.
+    """
+    variant_groups = []
+    for POS in sorted(variant_list, key=lambda x: (x.ctg_name, x.pos)):
+        if len(variant_groups) and variant_groups[-1][-1].ctg_name == POS.ctg_name and \
+                POS.pos - variant_groups[-1][-1].pos <= max_variant_group_distance and \
+                POS.pos - variant_groups[-1][0].pos <= max_variant_group_span:
+            variant_groups[-1].append(POS)
+        else:
+            variant_groups.append([POS])
+    return variant_groups
+
+
+def realign_pileup_row_from(ctg_name, pos):
+    """
+    Realign the reads around pos in process and return the samtools mpileup columns of the realigned reads at pos, or
+    None. Each variant is realigned on its own, the same as `realign_reads --pos`, so that the realignment windows of
+    the nearby variants do not change the realigned reads at pos.
+    """
+    # the realignment libraries are loaded on import, only when the realignment is enabled
+    from src.realign_reads import reads_realignment, realign_reads_parser
+
+    # the realigned reads are piled up into a temporary file, and only the row at pos is kept
+    realign_pileup_fp = tempfile.TemporaryFile(mode='w+')
+    samtools_mpileup_command = "{} mpileup - --reverse-del --min-MQ {} --min-BQ {} --excl-flags 2316".format(
+        args.samtools, args.min_mq, args.min_bq)
+    samtools_mpileup_process = subprocess_popen(shlex.split(samtools_mpileup_command), stdin=subprocess.PIPE,
+                                                stdout=realign_pileup_fp, stderr=subprocess.DEVNULL)
+    realign_args = realign_reads_parser().parse_args(['--pos', str(pos),
+                                                      '--ctg_name', ctg_name,
+                                                      '--bam_fn', args.bam_fn,
+                                                      '--ref_fn', args.ref_fn,
+                                                      '--samtools', args.samtools])
+    reads_realignment(realign_args, save_file_fp=samtools_mpileup_process)
+    samtools_mpileup_process.stdin.close()
+    samtools_mpileup_process.wait()
+    realign_pileup_fp.seek(0)
+    realign_pileup_rows = pileup_rows_from(realign_pileup_fp, {pos})
+    realign_pileup_fp.close()
+    return realign_pileup_rows.get(pos)
+
+
+def extract_base(variant_group):
+    """
+    Realignment filter of a group of nearby variants sorted by position. The raw pileup rows come from one samtools
+    mpileup over the group span, the reads around each variant are realigned in process and piled up by samtools
+    mpileup.
+    """
     bam_fn = args.bam_fn
-    ref_fn = args.ref_fn
     samtools = args.samtools
-    ctg_name = args.ctg_name if args.ctg_name is not None else POS.ctg_name
     min_mq = args.min_mq
     min_bq = args.min_bq
-    python = args.python
-    qual = float(POS.qual) if POS.qual is not None else None
-    if POS.extra_infos is False or (qual is not None and qual >= 0.95):
-        return ctg_name, pos, True, (-1, -1, -1, -1)
 
-    ctg_range = "{}:{}-{}".format(ctg_name, pos, pos)
+    results = []
+    realign_variant_list = []
+    for POS in variant_group:
+        ctg_name = args.ctg_name if args.ctg_name is not None else POS.ctg_name
+        qual = float(POS.qual) if POS.qual is not None else None
+        if POS.extra_infos is False or (qual is not None and qual >= 0.95):
+            results.append((ctg_name, POS.pos, True, (-1, -1, -1, -1)))
+        else:
+            realign_variant_list.append(POS)
+    if len(realign_variant_list) == 0:
+        return results
+
+    ctg_name = args.ctg_name if args.ctg_name is not None else realign_variant_list[0].ctg_name
+    pos_list = [POS.pos for POS in realign_variant_list]
+    pos_set = set(pos_list)
+
+    ctg_range = "{}:{}-{}".format(ctg_name, pos_list[0], pos_list[-1])
     samtools_command = "{} mpileup {} --min-MQ {} --min-BQ {} --excl-flags 2316 -r {}".format(samtools,
                                                                                               bam_fn,
                                                                                               min_mq,
                                                                                               min_bq,
                                                                                               ctg_range)
+    samtools_mpileup_process = subprocess_popen(shlex.split(samtools_command), stderr=subprocess.DEVNULL)
+    raw_pileup_rows = pileup_rows_from(samtools_mpileup_process.stdout, pos_set)
+    samtools_mpileup_process.stdout.close()
+    samtools_mpileup_process.wait()
+
+    for POS in realign_variant_list:
+        pos = POS.pos
+        alt_base = POS.alternate_bases[0]
+        if pos not in raw_pileup_rows:
+            results.append((ctg_name, pos, True, (-1, -1, -1, -1)))
+            continue
+        realign_pileup_row = realign_pileup_row_from(ctg_name, pos)
+        if realign_pileup_row is None:
+            results.append((ctg_name, pos, True, (-1, -1, -1, -1)))
+            continue
+
+        base_counter, base_list = get_base_list(raw_pileup_rows[pos])
+        realign_base_counter, realign_base_list = get_base_list(realign_pileup_row)
+
+        raw_depth = len(base_list)
+        realign_depth = len(realign_base_list)
+        raw_support_read_num = base_counter[alt_base]
+        realign_support_read_num = realign_base_counter[alt_base]
 
-    output = subprocess.run(samtools_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    output = output.stdout.rstrip()
-
-    columns = output.split('\t')
-    if len(columns) < 4:
-        return ctg_name, pos, True, (-1, -1, -1, -1)
-    base_counter, base_list = get_base_list(columns)
-
-    realign_command = "{} {} realign_reads --pos {} --ctg_name {} --bam_fn {} --ref_fn {} --samtools {}".format(python,
-                                                                                                                main_entry,
-                                                                                                                pos,
-                                                                                                                ctg_name,
-                                                                                                                bam_fn,
-                                                                                                                ref_fn,
-                                                                                                                samtools)
-
-    samtools_mpileup_command = "{} mpileup - --reverse-del --min-MQ {} --min-BQ {} --excl-flags 2316 | grep -w {}".format(
-                                                                                                                samtools,
-                                                                                                                min_mq,
-                                                                                                                min_bq,
-                                                                                                                pos)
-    realign_command += " | " + samtools_mpileup_command
-    realign_output = subprocess.run(realign_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-
-    realign_output = realign_output.stdout.rstrip()
-    columns = realign_output.split('\t')
-    if len(columns) < 4:
-        return ctg_name, pos, True, (-1, -1, -1, -1)
-
-    realign_base_counter, realign_base_list = get_base_list(columns)
-
-    raw_depth = len(base_list)
-    realign_depth = len(realign_base_list)
-    raw_support_read_num = base_counter[alt_base]
-    realign_support_read_num = realign_base_counter[alt_base]
-
-    pass_realign_filter = True
-    if raw_support_read_num / float(
-            raw_depth) > realign_support_read_num / realign_depth and realign_support_read_num < raw_support_read_num:
-        pass_realign_filter = False
-    return ctg_name, pos, pass_realign_filter, (
-    raw_support_read_num, raw_depth, realign_support_read_num, realign_depth)
+        pass_realign_filter = True
+        if raw_support_read_num / float(
+                raw_depth) > realign_support_read_num / realign_depth and realign_support_read_num < raw_support_read_num:
+            pass_realign_filter = False
+        results.append((ctg_name, pos, pass_realign_filter, (
+        raw_support_read_num, raw_depth, realign_support_read_num, realign_depth)))
+    return results
 
 
 def realign_variants(args):
@@ -166,13 +224,14 @@ def realign_variants(args):
     total_num = 0
     realign_fail_pos_set = set()
     with concurrent.futures.ProcessPoolExecutor(max_workers=threads_low) as exec:
-        for result in exec.map(extract_base, list(fa_input_variant_dict.values())):
-            contig, pos, pass_realign_filter = result[:3]
-            if pass_realign_filter is False:
-                realign_fail_pos_set.add((contig, pos))
-            total_num += 1
-            if total_num > 0 and total_num % 1000 == 0:
-                print("[INFO] Processing in {}, total processed positions: {}".format(contig, total_num))
+        for results in exec.map(extract_base, variant_groups_from(fa_input_variant_dict.values())):
+            for result in results:
+                contig, pos, pass_realign_filter = result[:3]
+                if pass_realign_filter is False:
+                    realign_fail_pos_set.add((contig, pos))
+                total_num += 1
+                if total_num > 0 and total_num % 1000 == 0:
+                    print("[INFO] Processing in {}, total processed positions: {}".format(contig, total_num))
 
     #write output
     for k, v in p_input_variant_dict.items():
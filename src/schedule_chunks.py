@@ -0,0 +1,344 @@
+# BSD 3-Clause License
+#
+# Copyright 2023 The University of Hong Kong, Department of Computer Science
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import re
+import sys
+import shlex
+import shutil
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+from collections import deque
+from time import sleep
+
+from shared.scheduler import PROGRESS_SUFFIX, SPLIT_SUFFIX, ACK_SUFFIX, write_atomically, ints_from, \
+    candidate_center_from
+from shared.tensor_io import is_binary_tensor_file, BINARY_TENSOR_MAGIC
+
+PLACEHOLDER_PATTERN = re.compile(r'\{(\d+)(/\.|/)?\}')
+
+# smallest part of a straggler chunk run by another worker, in bp for the range chunks of candidate extraction and in
+# candidates for the tensor creation chunks
+MIN_SPLIT_LENGTH = 100000
+MIN_SPLIT_CANDIDATES = 200
+POLL_INTERVAL = 0.5
+
+
+def rendered_command_from(command, columns):
+    """
+    Replace the GNU parallel placeholders {n}, {n/} (basename) and {n/.} (basename without extension) of the command.
+    """
+    def replacement_from(match):
+        value = columns[int(match.group(1)) - 1]
+        if match.group(2) == '/':
+            value = os.path.basename(value)
+        elif match.group(2) == '/.':
+            value = os.path.splitext(os.path.basename(value))[0]
+        return shlex.quote(value)
+
+    return PLACEHOLDER_PATTERN.sub(replacement_from, command)
+
+
+def option_value_from(command, option):
+    tokens = shlex.split(command)
+    values = [tokens[idx + 1] for idx, token in enumerate(tokens[:-1]) if token == option]
+    return values[-1] if len(values) else None
+
+
+def jobs_from(jobs, default_jobs=1):
+    """
+    Return the number of jobs, jobs is a number or a procfile holding it, which is re-read during the run.
+    """
+    if jobs.isdigit():
+        return max(int(jobs), 1)
+    value = ints_from(jobs)
+    return max(value[0], 1) if value is not None and len(value) else default_jobs
+
+
+class ChunkTask(object):
+    def __init__(self, task_id, columns, command, parent=None):
+        self.task_id = task_id
+        self.columns = columns
+        self.command = command
+        self.root = self if parent is None else parent.root
+        self.candidates_fn = option_value_from(command, '--candidates_bed_regions')
+        self.tensor_fn = option_value_from(command, '--tensor_can_fn')
+        self.start = None
+        self.process = None
+        self.log_fn = None
+        self.control_prefix = None
+        # (pos, end) last reported by the running chunk, and (split_pos, end) of the split waiting for the
+        # acknowledgement
+        self.progress = None
+        self.split = None
+        self.candidate_centers = None
+
+    @property
+    def is_candidates_chunk(self):
+        return self.candidates_fn is not None
+
+    def candidate_centers_from(self):
+        if self.candidate_centers is None:
+            with open(self.candidates_fn) as f:
+                self.candidate_centers = sorted(candidate_center_from(row)[1] for row in f if row.strip())
+        return self.candidate_centers
+
+
+class ChunkScheduler(object):
+    def __init__(self, command, control_dir, jobs, min_split_length=MIN_SPLIT_LENGTH,
+                 min_split_candidates=MIN_SPLIT_CANDIDATES):
+        self.command = command
+        self.control_dir = control_dir
+        self.jobs = jobs
+        self.min_split_length = min_split_length
+        self.min_split_candidates = min_split_candidates
+        self.task_num = 0
+        self.pending_tasks = deque()
+        self.running_tasks = {}
+        self.split_tasks = []
+        self.failed_tasks = []
+
+    def add_task(self, columns, extra_options="", parent=None):
+        self.task_num += 1
+        task = ChunkTask(task_id=self.task_num,
+                         columns=columns,
+                         command=rendered_command_from(self.command, columns) + extra_options,
+                         parent=parent)
+        return task
+
+    def start(self, task):
+        task.control_prefix = os.path.join(self.control_dir, 'task_{}'.format(task.task_id))
+        task.log_fn = task.control_prefix + '.log'
+        command = task.command + ' --chunk_control_prefix ' + shlex.quote(task.control_prefix)
+        with open(task.log_fn, 'w') as log_fp:
+            task.process = subprocess.Popen(command, shell=True, stdout=log_fp, stderr=subprocess.STDOUT)
+        self.running_tasks[task.task_id] = task
+
+    def split_position_of(self, task):
+        """
+        Return the position at which a running chunk should end to leave half of its remaining work to another worker,
+        or None if the remaining work is too small to split.
+        """
+        if task.progress is None or task.split is not None:
+            return None
+        pos, end = task.progress
+        if task.is_candidates_chunk:
+            remaining_centers = [center for center in task.candidate_centers_from() if pos < center <= end]
+            if len(remaining_centers) < 2 * self.min_split_candidates:
+                return None
+            return remaining_centers[len(remaining_centers) // 2 - 1]
+        if end - pos < 2 * self.min_split_length:
+            return None
+        return pos + (end - pos) // 2
+
+    def remaining_work_of(self, task):
+        pos, end = task.progress
+        return end - pos
+
+    def request_splits(self, idle_workers):
+        requested_splits = sum(1 for task in self.running_tasks.values() if task.split is not None)
+        stragglers = sorted([task for task in self.running_tasks.values() if task.progress is not None],
+                            key=self.remaining_work_of, reverse=True)
+        for task in stragglers:
+            if requested_splits >= idle_workers:
+                break
+            split_pos = self.split_position_of(task)
+            if split_pos is None:
+                continue
+            task.split = (split_pos, task.progress[1])
+            write_atomically(task.control_prefix + SPLIT_SUFFIX, '{}\n'.format(split_pos))
+            requested_splits += 1
+
+    def split_task_from(self, task, split_pos, end):
+        """
+        Create the chunk running (split_pos, end] of a chunk that accepted to end at split_pos.
+        """
+        task_id = self.task_num + 1
+        if not task.is_candidates_chunk:
+            # a new chunk id out of the range of the original chunk ids, so that the outputs are not overwritten
+            extra_options = ' --chunk_id {} --ctg_start {} --ctg_end {}'.format(task_id, split_pos + 1, end)
+            split_task = self.add_task(task.columns, extra_options=extra_options, parent=task)
+        else:
+            candidates_fn = os.path.join(self.control_dir, 'task_{}.bed'.format(task_id))
+            with open(task.candidates_fn) as input_file, open(candidates_fn, 'w') as output_file:
+                for row in input_file:
+                    if row.strip() and split_pos < candidate_center_from(row)[1] <= end:
+                        output_file.write(row)
+            extra_options = ' --candidates_bed_regions {} --tensor_can_fn {}'.format(
+                shlex.quote(candidates_fn), shlex.quote(os.path.join(self.control_dir, 'task_{}.tensor'.format(task_id))))
+            split_task = self.add_task(task.columns, extra_options=extra_options, parent=task)
+        split_task.start = split_pos + 1
+        self.split_tasks.append(split_task)
+        print("[INFO] Split chunk {} at {}, run {}-{} in chunk {}".format(task.task_id, split_pos, split_pos + 1, end,
+                                                                           split_task.task_id))
+        return split_task
+
+    def update(self, task):
+        """
+        Read the progress of a chunk and the acknowledgement of its pending split.
+        """
+        progress = ints_from(task.control_prefix + PROGRESS_SUFFIX)
+        if progress is not None and len(progress) == 2:
+            task.progress = tuple(progress)
+        if task.split is None:
+            return
+        ack_fn = task.control_prefix + ACK_SUFFIX
+        ack = ints_from(ack_fn)
+        if ack is None:
+            return
+        os.remove(ack_fn)
+        split_pos, end = task.split
+        if len(ack) and ack[0] == split_pos:
+            task.progress = (min(task.progress[0], split_pos), split_pos)
+            self.pending_tasks.appendleft(self.split_task_from(task, split_pos, end))
+        task.split = None
+
+    def finish(self, task):
+        self.update(task)
+        if task.split is not None:
+            # the chunk finished before reading the split
+            split_fn = task.control_prefix + SPLIT_SUFFIX
+            if os.path.exists(split_fn):
+                os.remove(split_fn)
+            task.split = None
+        with open(task.log_fn) as log_fp:
+            sys.stdout.write(log_fp.read())
+        sys.stdout.flush()
+        if task.process.returncode != 0:
+            print("[ERROR] Chunk {} exited with code {}: {}".format(task.task_id, task.process.returncode,
+                                                                     task.command), file=sys.stderr)
+            self.failed_tasks.append(task)
+        del self.running_tasks[task.task_id]
+
+    def merge_split_tensors(self):
+        """
+        Append the tensors of the split chunks to the tensor file of their original chunk, in the order of the
+        positions, the binary tensor header is written only once.
+        """
+        for split_task in sorted([task for task in self.split_tasks if task.is_candidates_chunk],
+                                 key=lambda task: (task.root.task_id, task.start)):
+            if not os.path.exists(split_task.tensor_fn):
+                continue
+            header_size = len(BINARY_TENSOR_MAGIC) + 1 if is_binary_tensor_file(split_task.tensor_fn) else 0
+            with open(split_task.root.tensor_fn, 'ab') as output_file, open(split_task.tensor_fn, 'rb') as input_file:
+                input_file.seek(header_size)
+                shutil.copyfileobj(input_file, output_file)
+            os.remove(split_task.tensor_fn)
+
+    def run(self, tasks):
+        """
+        Run the chunks with up to jobs workers, return the number of failed chunks.
+        """
+        self.pending_tasks.extend(tasks)
+        default_jobs = 1
+        while len(self.pending_tasks) or len(self.running_tasks):
+            for task in list(self.running_tasks.values()):
+                if task.process.poll() is None:
+                    self.update(task)
+                else:
+                    self.finish(task)
+
+            jobs = jobs_from(self.jobs, default_jobs=default_jobs)
+            default_jobs = jobs
+            while len(self.pending_tasks) and len(self.running_tasks) < jobs and not len(self.failed_tasks):
+                self.start(self.pending_tasks.popleft())
+            if len(self.failed_tasks):
+                self.pending_tasks.clear()
+            elif not len(self.pending_tasks) and len(self.running_tasks) < jobs:
+                self.request_splits(idle_workers=jobs - len(self.running_tasks))
+
+            if len(self.running_tasks):
+                sleep(POLL_INTERVAL)
+
+        if not len(self.failed_tasks):
+            self.merge_split_tensors()
+        return len(self.failed_tasks)
+
+
+def schedule_chunks(args):
+    control_dir = args.control_dir
+    if os.path.exists(control_dir):
+        shutil.rmtree(control_dir)
+    os.makedirs(control_dir)
+
+    with open(args.input_list_fn) as f:
+        input_rows = [row.rstrip('\n') for row in f if row.strip()]
+
+    scheduler = ChunkScheduler(command=args.command,
+                               control_dir=control_dir,
+                               jobs=args.jobs,
+                               min_split_length=args.min_split_length,
+                               min_split_candidates=args.min_split_candidates)
+    tasks = [scheduler.add_task(row.split(args.colsep) if args.colsep is not None else [row]) for row in input_rows]
+    # the tensor creation chunks start from the one with the most candidates, the chunk list of the candidate
+    # extraction is already ordered
+    tasks = sorted(tasks, key=lambda task: -os.path.getsize(task.candidates_fn) if task.is_candidates_chunk and
+                   os.path.exists(task.candidates_fn) else 0)
+
+    failed_task_num = scheduler.run(tasks)
+    if failed_task_num:
+        sys.exit(min(failed_task_num, 101))
+    shutil.rmtree(control_dir)
+
+
+def main():
+    parser = ArgumentParser(description="Run chunked commands with a process pool, splitting the straggler chunks "
+                                        "for the idle workers")
+
+    parser.add_argument('--command', type=str, default=None, required=True,
+                        help="Command of each chunk, with the GNU parallel placeholders {n}, {n/} and {n/.}")
+
+    parser.add_argument('--input_list_fn', type=str, default=None, required=True,
+                        help="Input list, one chunk per line")
+
+    parser.add_argument('--control_dir', type=str, default=None, required=True,
+                        help="Directory of the chunk progress and split files")
+
+    parser.add_argument('-j', '--jobs', type=str, default="1",
+                        help="Number of workers, or a procfile holding it which is re-read during the run")
+
+    parser.add_argument('--colsep', type=str, default=None,
+                        help="Column separator of the input list, the whole line is {1} if not set")
+
+    ## Smallest part of a straggler range chunk run by another worker, in bp
+    parser.add_argument('--min_split_length', type=int, default=MIN_SPLIT_LENGTH,
+                        help=SUPPRESS)
+
+    ## Smallest part of a straggler tensor creation chunk run by another worker, in candidates
+    parser.add_argument('--min_split_candidates', type=int, default=MIN_SPLIT_CANDIDATES,
+                        help=SUPPRESS)
+
+    args = parser.parse_args()
+
+    schedule_chunks(args)
+
+
+if __name__ == "__main__":
+    main()
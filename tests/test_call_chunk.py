@@ -0,0 +1,42 @@
+import os
+from argparse import Namespace
+
+import pytest
+
+pytest.importorskip('torch')
+
+from clairs.call_chunk import is_chunk_done, fingerprint_from
+
+
+def chunk_files_from(tmp_path):
+    candidates_bed_regions = tmp_path / 'chr1.0_0_1'
+    candidates_bed_regions.write_text('chr1\t100\t200\n')
+    call_fn = tmp_path / 'p_chr1.0_0_1.vcf'
+    call_fn.write_text('')
+    done_fn = tmp_path / 'chr1.0_0_1.done'
+    return str(done_fn), str(candidates_bed_regions), str(call_fn)
+
+
+def test_fingerprint_is_shared_by_workers():
+    args = Namespace(chkpnt_fn='pileup.pkl', worker_id=1, worker_num=4)
+    other_worker_args = Namespace(chkpnt_fn='pileup.pkl', worker_id=3, worker_num=4)
+    assert fingerprint_from(args) == fingerprint_from(other_worker_args)
+    assert fingerprint_from(args) != fingerprint_from(Namespace(chkpnt_fn='indel.pkl', worker_id=1, worker_num=4))
+
+
+def test_chunk_is_done_with_same_fingerprint(tmp_path):
+    done_fn, candidates_bed_regions, call_fn = chunk_files_from(tmp_path)
+    assert not is_chunk_done(done_fn, 'fingerprint', candidates_bed_regions, call_fn)
+    with open(done_fn, 'w') as done_file:
+        done_file.write('fingerprint\n')
+    assert is_chunk_done(done_fn, 'fingerprint', candidates_bed_regions, call_fn)
+    assert not is_chunk_done(done_fn, 'other_fingerprint', candidates_bed_regions, call_fn)
+
+
+def test_chunk_is_not_done_after_new_candidates(tmp_path):
+    done_fn, candidates_bed_regions, call_fn = chunk_files_from(tmp_path)
+    with open(done_fn, 'w') as done_file:
+        done_file.write('fingerprint\n')
+    done_mtime = os.path.getmtime(done_fn)
+    os.utime(candidates_bed_regions, (done_mtime + 10, done_mtime + 10))
+    assert not is_chunk_done(done_fn, 'fingerprint', candidates_bed_regions, call_fn)
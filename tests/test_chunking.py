@@ -0,0 +1,96 @@
+import struct
+
+import shared.chunking as chunking
+from shared.chunking import BAI_MAGIC, LINEAR_INDEX_WINDOW, linear_index_list_from, window_work_dict_from, \
+    work_aware_chunks_from
+
+MIN_CHUNK_LENGTH = 200000
+MAX_CHUNK_LENGTH = 20000000
+CHUNK_SIZE = 5000000
+
+
+def bai_from(linear_index_list):
+    """
+    A BAI with one binned chunk and the pseudo-bin of each reference, the linear indexes hold virtual file offsets.
+    """
+    data = BAI_MAGIC + struct.pack('<i', len(linear_index_list))
+    for linear_index in linear_index_list:
+        data += struct.pack('<i', 2)
+        data += struct.pack('<Ii', 4681, 1) + struct.pack('<2Q', 1 << 16, 2 << 16)
+        data += struct.pack('<Ii', 37450, 2) + struct.pack('<4Q', 1 << 16, 2 << 16, 10, 0)
+        data += struct.pack('<i', len(linear_index))
+        data += struct.pack('<{}Q'.format(len(linear_index)), *[(coffset << 16) | 7 for coffset in linear_index])
+    return data + struct.pack('<Q', 0)
+
+
+def test_linear_index_list_from_bai(tmp_path):
+    bai_fn = tmp_path / 'reads.bam.bai'
+    bai_fn.write_bytes(bai_from([[100, 250, 0, 400], [], [900]]))
+    assert linear_index_list_from(str(bai_fn)) == [[100, 250, 0, 400], [], [900]]
+
+    csi_fn = tmp_path / 'reads.bam.csi'
+    csi_fn.write_bytes(b'CSI\x01' + bai_from([[100]])[4:])
+    assert linear_index_list_from(str(csi_fn)) is None
+
+
+def test_window_work_dict_from_back_fills_empty_windows(tmp_path, monkeypatch):
+    bam_fn = tmp_path / 'reads.bam'
+    bam_fn.write_bytes(b'')
+    (tmp_path / 'reads.bam.bai').write_bytes(bai_from([[0, 100, 0, 250, 400], []]))
+    monkeypatch.setattr(chunking, 'idxstats_from', lambda bam_fn, samtools: [
+        ('chr1', 6 * LINEAR_INDEX_WINDOW + 10, 1000), ('chr2', 2 * LINEAR_INDEX_WINDOW, 30)])
+
+    window_work_dict = window_work_dict_from(str(bam_fn), 'samtools', {'chr1', 'chr2'})
+    # the leading empty window takes the first offset, the inner one the previous offset, the last window the average
+    assert window_work_dict['chr1'] == [0, 0, 150, 150, 75.0, 0, 0]
+    # a reference without linear index spreads the mapped reads
+    assert window_work_dict['chr2'] == [10.0, 10.0, 10.0]
+
+
+def chunk_size_count_from(contig_length_dict):
+    return sum((contig_length - 1) // CHUNK_SIZE + 1 for contig_length in contig_length_dict.values())
+
+
+def assert_chunks_tile_contigs(chunk_list, contig_length_dict):
+    for contig_name, contig_length in contig_length_dict.items():
+        contig_chunks = sorted(chunk for chunk in chunk_list if chunk[0] == contig_name)
+        assert [chunk[1] for chunk in contig_chunks] == list(range(1, len(contig_chunks) + 1))
+        assert all(chunk[2] == len(contig_chunks) for chunk in contig_chunks)
+        assert contig_chunks[0][3] == 1 and contig_chunks[-1][4] == contig_length
+        for chunk, next_chunk in zip(contig_chunks, contig_chunks[1:]):
+            assert chunk[3] <= chunk[4] and next_chunk[3] == chunk[4] + 1
+
+
+def test_work_aware_chunks_tile_contigs_with_chunk_size_count():
+    contig_length_dict = {'chr1': 12500000, 'chr2': 7300001, 'chr3': 300000}
+    window_work_dict = {}
+    for contig_name, contig_length in contig_length_dict.items():
+        window_num = contig_length // LINEAR_INDEX_WINDOW + 1
+        # a high-depth region in the middle of each contig
+        window_work_dict[contig_name] = [50.0 if window_num // 3 <= idx < window_num // 2 else 5.0
+                                         for idx in range(window_num)]
+    chunk_num = chunk_size_count_from(contig_length_dict)
+
+    chunk_list = work_aware_chunks_from(contig_length_dict=contig_length_dict,
+                                        window_work_dict=window_work_dict,
+                                        chunk_num=chunk_num,
+                                        min_chunk_length=MIN_CHUNK_LENGTH,
+                                        max_chunk_length=MAX_CHUNK_LENGTH)
+    assert len(chunk_list) == chunk_num
+    assert_chunks_tile_contigs(chunk_list, contig_length_dict)
+    assert [chunk[5] for chunk in chunk_list] == sorted((chunk[5] for chunk in chunk_list), reverse=True)
+    # the high-depth region gets shorter chunks
+    chr1_chunk_length_list = [chunk[4] - chunk[3] + 1 for chunk in sorted(chunk_list) if chunk[0] == 'chr1']
+    assert min(chr1_chunk_length_list) < 12500000 / len(chr1_chunk_length_list) < max(chr1_chunk_length_list)
+
+
+def test_work_aware_chunks_of_contigs_without_work_are_split_by_length():
+    contig_length_dict = {'chr1': 10 * LINEAR_INDEX_WINDOW * 100, 'chr2': 5 * LINEAR_INDEX_WINDOW * 100}
+    chunk_list = work_aware_chunks_from(contig_length_dict=contig_length_dict,
+                                        window_work_dict={},
+                                        chunk_num=3,
+                                        min_chunk_length=MIN_CHUNK_LENGTH,
+                                        max_chunk_length=MAX_CHUNK_LENGTH)
+    assert len(chunk_list) == 3
+    assert_chunks_tile_contigs(chunk_list, contig_length_dict)
+    assert sorted(chunk[4] - chunk[3] + 1 for chunk in chunk_list) == [500 * LINEAR_INDEX_WINDOW] * 3
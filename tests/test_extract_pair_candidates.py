@@ -0,0 +1,36 @@
+from src.extract_pair_candidates import mq_filtered_from, is_mq_sampling_changed
+
+MIN_MQ = 5
+
+
+def column_from(mapping_quality_list):
+    base_list = [['A', ''] if idx % 2 else ['c', '-N'] for idx in range(len(mapping_quality_list))]
+    read_name_list = ['read_{}'.format(idx) for idx in range(len(mapping_quality_list))]
+    raw_mapping_quality = ''.join(chr(mq + 33) for mq in mapping_quality_list)
+    return base_list, read_name_list, raw_mapping_quality
+
+
+def test_mq_filtered_from_keeps_min_mq_reads():
+    mapping_quality_list = [60, 0, 4, 5, 60, 1]
+    base_list, read_name_list, raw_mapping_quality = column_from(mapping_quality_list)
+    filtered_base_list, filtered_read_name_list = mq_filtered_from(base_list, read_name_list, raw_mapping_quality,
+                                                                   MIN_MQ)
+    kept_idx_list = [idx for idx, mq in enumerate(mapping_quality_list) if mq >= MIN_MQ]
+    assert filtered_base_list == [base_list[idx] for idx in kept_idx_list]
+    assert filtered_read_name_list == [read_name_list[idx] for idx in kept_idx_list]
+
+
+def test_mq_sampling_is_unchanged_below_max_depth():
+    _, _, raw_mapping_quality = column_from([60, 0, 1, 60])
+    assert not is_mq_sampling_changed(raw_mapping_quality, MIN_MQ, max_depth=5)
+
+
+def test_mq_sampling_is_unchanged_at_max_depth_without_low_mq_reads():
+    _, _, raw_mapping_quality = column_from([60, 5, 60, 60])
+    assert not is_mq_sampling_changed(raw_mapping_quality, MIN_MQ, max_depth=4)
+
+
+def test_mq_sampling_is_changed_at_max_depth_with_low_mq_reads():
+    # the low mapping quality read takes the place of a read that --min-MQ would have sampled
+    _, _, raw_mapping_quality = column_from([60, 0, 60, 60])
+    assert is_mq_sampling_changed(raw_mapping_quality, MIN_MQ, max_depth=4)
@@ -0,0 +1,125 @@
+import gzip
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from shared.haplotag import ReadHaplotypeAssigner
+
+VCF_HEADER = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n'
+
+
+def phased_vcf_from(tmp_path, snv_list):
+    phased_vcf_fn = str(tmp_path / 'phased.vcf.gz')
+    with gzip.open(phased_vcf_fn, 'wt') as f:
+        f.write(VCF_HEADER)
+        for pos, ref_base, alt_base, genotype, phase_set in snv_list:
+            f.write('\t'.join(['chr1', str(pos), '.', ref_base, alt_base, '.', 'PASS', '.', 'GT:PS',
+                               genotype + ':' + phase_set]) + '\n')
+    return phased_vcf_fn
+
+
+def sam_row_from(read_name, start, cigar, seq, qual):
+    return '\t'.join([read_name, '0', 'chr1', str(start), '60', cigar, '*', '0', '0', seq, qual]) + '\n'
+
+
+def test_reads_are_assigned_with_base_quality_weighted_scores(tmp_path):
+    # 1-based SNVs at 3, 5 and 7 in phase set 1, SNV at 9 in phase set 9
+    phased_vcf_fn = phased_vcf_from(tmp_path, [(3, 'A', 'C', '0|1', '1'), (5, 'A', 'C', '1|0', '1'),
+                                               (7, 'A', 'C', '0|1', '1'), (9, 'A', 'C', '0|1', '9')])
+    sam_rows = [
+        # two low quality hap2 alleles against one high quality hap1 allele
+        sam_row_from('quality', 1, '10M', 'AACAAAAAAA', '!!#!#!+!!!'),
+        # equal scores stay untagged
+        sam_row_from('tie', 1, '6M', 'AACACA', '!!+!+!'),
+        # the SNV at 5 is deleted, the alleles at 7 and 9 are read after the insertion
+        sam_row_from('cigar', 1, '3M2D1M2I3M', 'AACAGGCAA', '+++++++++'),
+    ]
+    hap_dict = ReadHaplotypeAssigner(phased_vcf_fn=phased_vcf_fn, ctg_name='chr1').read_haplotypes_from(sam_rows)
+    assert hap_dict == {'quality': 1, 'cigar': 2}
+
+
+def test_phase_set_with_largest_score_difference_is_used(tmp_path):
+    phased_vcf_fn = phased_vcf_from(tmp_path, [(2, 'A', 'C', '0|1', '1'), (3, 'A', 'C', '1|0', '1'),
+                                               (4, 'A', 'C', '0|1', '1'), (6, 'A', 'C', '0|1', '6')])
+    # phase set 1 has three informative alleles with a score difference of 10, phase set 6 one with 20
+    sam_rows = [sam_row_from('read', 1, '6M', 'AAAAAC', '!+++!5')]
+    hap_dict = ReadHaplotypeAssigner(phased_vcf_fn=phased_vcf_fn, ctg_name='chr1').read_haplotypes_from(sam_rows)
+    assert hap_dict == {'read': 2}
+
+
+def synthetic_region_from(tmp_path, pysam, read_num=200, region_length=20000, read_length=3000):
+    """
+    Write a reference, a phased VCF with two phase sets and a sorted and indexed BAM of reads drawn from the two
+    haplotypes with 2% substitution errors, return (reference, phased VCF, BAM).
+    """
+    random.seed(0)
+    reference = ''.join(random.choice('ACGT') for _ in range(region_length))
+    ref_fn = str(tmp_path / 'ref.fa')
+    with open(ref_fn, 'w') as f:
+        f.write('>chr1\n' + reference + '\n')
+    pysam.faidx(ref_fn)
+
+    haplotypes = [list(reference), list(reference)]
+    vcf_fn = str(tmp_path / 'phased.vcf')
+    with open(vcf_fn, 'w') as f:
+        f.write(VCF_HEADER.replace('#CHROM', '##contig=<ID=chr1,length={}>\n#CHROM'.format(region_length)))
+        for pos in range(500, region_length, 400):
+            alt_base = 'C' if reference[pos - 1] != 'C' else 'G'
+            genotype = random.choice(['0|1', '1|0'])
+            haplotypes[1 if genotype == '0|1' else 0][pos - 1] = alt_base
+            phase_set = 500 if pos < region_length // 2 else region_length // 2 + 100
+            f.write('\t'.join(['chr1', str(pos), '.', reference[pos - 1], alt_base, '50', 'PASS', '.', 'GT:PS',
+                               '{}:{}'.format(genotype, phase_set)]) + '\n')
+    phased_vcf_fn = pysam.tabix_index(vcf_fn, preset='vcf', force=True)
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': region_length}]}
+    unsorted_bam_fn, bam_fn = str(tmp_path / 'unsorted.bam'), str(tmp_path / 'reads.bam')
+    with pysam.AlignmentFile(unsorted_bam_fn, 'wb', header=header) as f:
+        for read_idx in range(read_num):
+            start = random.randrange(0, region_length - read_length)
+            seq = haplotypes[read_idx % 2][start:start + read_length]
+            for idx in range(len(seq)):
+                if random.random() < 0.02:
+                    seq[idx] = random.choice([base for base in 'ACGT' if base != seq[idx]])
+            segment = pysam.AlignedSegment()
+            segment.query_name = 'read_{}'.format(read_idx)
+            segment.reference_id = 0
+            segment.reference_start = start
+            segment.mapping_quality = 60
+            segment.cigarstring = '{}M'.format(read_length)
+            segment.query_sequence = ''.join(seq)
+            segment.query_qualities = pysam.qualitystring_to_array('5' * read_length)
+            f.write(segment)
+    pysam.sort('-o', bam_fn, unsorted_bam_fn)
+    pysam.index(bam_fn)
+    return ref_fn, phased_vcf_fn, bam_fn
+
+
+def test_assignment_agrees_with_whatshap_haplotag(tmp_path):
+    pysam = pytest.importorskip('pysam')
+    for command in ('whatshap', 'samtools', 'tabix'):
+        if shutil.which(command) is None:
+            pytest.skip('{} is not installed'.format(command))
+    ref_fn, phased_vcf_fn, bam_fn = synthetic_region_from(tmp_path, pysam)
+
+    haplotag_list_fn = str(tmp_path / 'haplotag.tsv')
+    subprocess.check_call(['whatshap', 'haplotag', '--output', str(tmp_path / 'haplotagged.bam'),
+                           '--reference', ref_fn, '--ignore-read-groups', '--output-haplotag-list',
+                           haplotag_list_fn, phased_vcf_fn, bam_fn])
+    whatshap_hap_dict = {}
+    with open(haplotag_list_fn) as f:
+        for row in f:
+            if row.startswith('#'):
+                continue
+            read_name, haplotype = row.split('\t')[:2]
+            if haplotype in ('H1', 'H2'):
+                whatshap_hap_dict[read_name] = int(haplotype[1])
+
+    hap_dict = ReadHaplotypeAssigner(phased_vcf_fn=phased_vcf_fn, ctg_name='chr1').read_haplotypes_of_bam(
+        bam_fn=bam_fn, regions=['chr1'])
+    agreed_read_num = sum(1 for read_name, hap in whatshap_hap_dict.items() if hap_dict.get(read_name) == hap)
+    assert len(whatshap_hap_dict) > 0
+    assert agreed_read_num >= 0.99 * len(whatshap_hap_dict)
+    assert len(hap_dict) <= len(whatshap_hap_dict) * 1.01
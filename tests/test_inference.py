@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from clairs.inference import input_matrix_from, InferenceModel, compare_probabilities, load_model, \
+    MAX_PROBABILITY_DIFF, MIN_CLASS_AGREEMENT, AUTOCAST_DTYPE
+from clairs.model import BiGRU, ResNet
+
+BATCH_FN = os.path.join(os.path.dirname(__file__), 'data', 'inference_batch.npz')
+# directory of the trained pileup.pkl and full_alignment.pkl (ont) to check instead of the randomly initialized models
+MODEL_DIR = os.environ.get('CLAIRS_TEST_MODEL_DIR')
+# the randomly initialized models are undecided on most candidates, only the decided ones are compared
+MIN_MARGIN = 0.1 if MODEL_DIR is None else 0.0
+
+
+def model_from(pileup):
+    if MODEL_DIR is not None:
+        return load_model(os.path.join(MODEL_DIR, 'pileup.pkl' if pileup else 'full_alignment.pkl'))
+    torch.manual_seed(0)
+    return BiGRU() if pileup else ResNet(platform='ont')
+
+
+def is_precision_supported(precision):
+    """
+    Whether the CPU runs the layers of the models in a precision, checked on small layers before any model is run.
+    """
+    if precision == 'int8':
+        return any(engine != 'none' for engine in torch.backends.quantized.supported_engines)
+    layers = [(torch.nn.Conv2d(2, 2, 3), torch.zeros(1, 2, 4, 4)),
+              (torch.nn.BatchNorm2d(2).eval(), torch.zeros(1, 2, 4, 4)),
+              (torch.nn.Linear(4, 2), torch.zeros(1, 4)),
+              (torch.nn.GRU(4, 2, batch_first=True), torch.zeros(1, 3, 4))]
+    try:
+        with torch.no_grad(), torch.autocast(device_type='cpu', dtype=AUTOCAST_DTYPE[precision]):
+            for layer, layer_input in layers:
+                layer(layer_input)
+    except RuntimeError:
+        return False
+    return True
+
+
+def input_matrix_of(pileup):
+    batch = np.load(BATCH_FN)
+    return input_matrix_from(batch['pileup' if pileup else 'full_alignment'], pileup=pileup)
+
+
+def test_full_alignment_input_keeps_integer_dtype():
+    input_matrix = input_matrix_of(pileup=False)
+    assert input_matrix.dtype == torch.int8
+    assert input_matrix.shape[1] < input_matrix.shape[2]
+
+
+@pytest.mark.parametrize('pileup', [True, False], ids=['pileup', 'full_alignment'])
+@pytest.mark.parametrize('precision', ['bf16', 'fp16', 'int8'])
+def test_precision_matches_fp32(precision, pileup):
+    if not is_precision_supported(precision):
+        pytest.skip('{} inference is not supported here'.format(precision))
+    model = InferenceModel(model_from(pileup), precision=precision)
+    assert model.precision == precision
+    input_matrix = input_matrix_of(pileup)
+    probabilities = model.forward(model.model, input_matrix, precision, scale=not pileup)
+    fp32_probabilities = model.forward(model.fp32_model, input_matrix, 'fp32', scale=not pileup)
+    max_probability_diff, class_agreement = compare_probabilities(probabilities, fp32_probabilities,
+                                                                  min_margin=MIN_MARGIN)
+    assert max_probability_diff <= MAX_PROBABILITY_DIFF
+    assert class_agreement >= MIN_CLASS_AGREEMENT
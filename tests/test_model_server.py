@@ -0,0 +1,27 @@
+import socket
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+
+from clairs.model_server import ModelRequestHandler, REQUEST_HEADER
+
+
+def handle_truncated_request(request):
+    server_socket, client_socket = socket.socketpair()
+    client_socket.sendall(request)
+    client_socket.close()
+    try:
+        ModelRequestHandler(server_socket, None, SimpleNamespace(models={}))
+    finally:
+        server_socket.close()
+
+
+def test_request_truncated_in_shape_is_dropped():
+    handle_truncated_request(REQUEST_HEADER.pack(b'pileup', 3) + struct.pack('<I', 16))
+
+
+def test_request_truncated_in_tensor_is_dropped():
+    handle_truncated_request(REQUEST_HEADER.pack(b'pileup', 2) + struct.pack('<2I', 2, 4) + b'\0' * 12)
@@ -0,0 +1,13 @@
+from shared.pileup import base_list_from, base_list_with_read_ends_from
+
+
+def test_base_list_from_decodes_indels_and_skips_read_markers():
+    assert base_list_from('^]A+2CGc$*-3NNNg') == [['A', '+CG'], ['c', ''], ['*', '-NNN'], ['g', '']]
+
+
+def test_base_list_with_read_ends_from_matches_base_list_from():
+    pileup_bases = 'A^$c+12ACGTACGTACGTt$#^!G-1N'
+    base_list, read_start_set, read_end_set = base_list_with_read_ends_from(pileup_bases)
+    assert base_list == base_list_from(pileup_bases)
+    assert read_start_set == {0, 3}
+    assert read_end_set == {2}
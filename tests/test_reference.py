@@ -0,0 +1,94 @@
+import gzip
+import shutil
+import subprocess
+
+import pytest
+
+from shared.reference import ReferenceStore, build_reference_store
+
+LINE_WIDTH = 60
+# mixed case contigs, a contig of exactly one line and a contig name with ':'
+CONTIG_SEQUENCES = [
+    ('chr1', ''.join('ACGTacgtNn'[(idx * 7) % 10] for idx in range(150))),
+    ('chr2', 'acgtACGTAC' * 6),
+    ('HLA-A*01:01:01:01', ''.join('ACGTacgt'[(idx * 3) % 8] for idx in range(70))),
+]
+REGIONS = [
+    'chr1',
+    'chr1:1-10',
+    # across the line breaks
+    'chr1:55-125',
+    # clipped at the contig end
+    'chr1:140-200',
+    # without an end
+    'chr1:100',
+    'chr2:60',
+    'chr2:1-60',
+    'HLA-A*01:01:01:01',
+    'HLA-A*01:01:01:01:5-20',
+    'HLA-A*01:01:01:01:65-100',
+]
+
+
+def fasta_from(tmp_path, name='ref.fa', with_fai=True):
+    fasta_fn = str(tmp_path / name)
+    fai_rows = []
+    offset = 0
+    with open(fasta_fn, 'w') as f:
+        for contig_name, sequence in CONTIG_SEQUENCES:
+            header = '>{} description\n'.format(contig_name)
+            lines = [sequence[idx:idx + LINE_WIDTH] + '\n' for idx in range(0, len(sequence), LINE_WIDTH)]
+            offset += len(header)
+            fai_rows.append('\t'.join([contig_name, str(len(sequence)), str(offset), str(LINE_WIDTH),
+                                       str(LINE_WIDTH + 1)]))
+            f.write(header + ''.join(lines))
+            offset += sum(len(line) for line in lines)
+    if with_fai:
+        with open(fasta_fn + '.fai', 'w') as f:
+            f.write('\n'.join(fai_rows) + '\n')
+    return fasta_fn
+
+
+def faidx_sequence_of(region):
+    """
+    The uppercase sequence `samtools faidx` outputs for a region of CONTIG_SEQUENCES.
+    """
+    sequence_dict = dict(CONTIG_SEQUENCES)
+    if region in sequence_dict:
+        return sequence_dict[region].upper()
+    contig_name, coordinates = region.rsplit(':', 1)
+    start, end = (coordinates.split('-') + [None])[:2]
+    sequence = sequence_dict[contig_name].upper()
+    return sequence[int(start) - 1:len(sequence) if end is None else int(end)]
+
+
+def reference_store_of(tmp_path, build_path):
+    if build_path == 'fai':
+        fasta_fn = fasta_from(tmp_path)
+    elif build_path == 'text':
+        fasta_fn = fasta_from(tmp_path, with_fai=False)
+    else:
+        plain_fasta_fn = fasta_from(tmp_path, with_fai=False)
+        fasta_fn = plain_fasta_fn + '.gz'
+        with open(plain_fasta_fn, 'rb') as input_file, gzip.open(fasta_fn, 'wb') as output_file:
+            output_file.write(input_file.read())
+    return ReferenceStore(build_reference_store(fasta_file_path=fasta_fn, store_dir=str(tmp_path / 'store')))
+
+
+@pytest.mark.parametrize('build_path', ['fai', 'text', 'gz'])
+def test_store_sequence_of_regions(tmp_path, build_path):
+    reference_store = reference_store_of(tmp_path, build_path)
+    for region in REGIONS:
+        assert reference_store.sequence_of(region) == faidx_sequence_of(region), region
+    assert reference_store.sequence_of('chr4:1-10') is None
+
+
+@pytest.mark.parametrize('build_path', ['fai', 'gz'])
+def test_store_sequence_of_regions_matches_samtools_faidx(tmp_path, build_path):
+    if shutil.which('samtools') is None:
+        pytest.skip('samtools is not installed')
+    reference_store = reference_store_of(tmp_path, build_path)
+    fasta_fn = fasta_from(tmp_path, name='faidx.fa', with_fai=False)
+    for region in REGIONS:
+        output = subprocess.check_output(['samtools', 'faidx', fasta_fn, region], universal_newlines=True)
+        assert reference_store.sequence_of(region) == ''.join(output.splitlines()[1:]).upper(), region
@@ -0,0 +1,47 @@
+from shared.scheduler import ChunkRangeControl, CANDIDATE_CHECK_STRIDE, candidate_center_from
+from src.schedule_chunks import ChunkScheduler
+
+CANDIDATE_NUM = 500
+
+
+def candidates_bed_from(tmp_path):
+    candidates_fn = tmp_path / 'chr1.0_0_1'
+    with open(str(candidates_fn), 'w') as output_file:
+        for idx in range(CANDIDATE_NUM):
+            center = 1000 + idx * 10
+            output_file.write('\t'.join(['chr1', str(center - 17), str(center + 16)]) + '\n')
+    return str(candidates_fn)
+
+
+def test_tensor_chunk_of_a_few_hundred_candidates_is_split(tmp_path):
+    candidates_fn = candidates_bed_from(tmp_path)
+    with open(candidates_fn) as f:
+        centers = [candidate_center_from(row)[1] for row in f]
+    scheduler = ChunkScheduler(command='create_pair_tensor --candidates_bed_regions {1} --tensor_can_fn {1}.tensor',
+                               control_dir=str(tmp_path), jobs=2)
+    task = scheduler.add_task([candidates_fn])
+    task.control_prefix = str(tmp_path / 'task_1')
+    scheduler.running_tasks[task.task_id] = task
+
+    # the candidate stream of the tensor creation, end_at is called once per candidate
+    control = ChunkRangeControl(control_prefix=task.control_prefix, ctg_end=centers[-1],
+                                check_stride=CANDIDATE_CHECK_STRIDE, report_interval=0)
+    emitted_centers = []
+    for center in centers:
+        if center > control.end_at(center):
+            break
+        emitted_centers.append(center)
+        if len(emitted_centers) == 10:
+            scheduler.update(task)
+            scheduler.request_splits(idle_workers=1)
+            assert task.split is not None
+        if len(emitted_centers) == 11:
+            scheduler.update(task)
+
+    assert len(scheduler.pending_tasks) == 1
+    split_task = scheduler.pending_tasks[0]
+    with open(split_task.candidates_fn) as f:
+        split_centers = [candidate_center_from(row)[1] for row in f]
+    # each candidate is emitted by exactly one of the two chunks
+    assert emitted_centers + split_centers == centers
+    assert len(emitted_centers) > 11 and len(split_centers) >= scheduler.min_split_candidates
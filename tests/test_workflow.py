@@ -0,0 +1,167 @@
+import os
+
+from shared.workflow import WorkflowRunner, workflow_steps_from, DONE_SUFFIX
+
+
+def runner_from(tmp_path, **kwargs):
+    return WorkflowRunner(workflow_dir=str(tmp_path / 'tmp' / 'workflow'),
+                          output_dir=str(tmp_path),
+                          logging=lambda *args: None,
+                          **kwargs)
+
+
+def steps_from(commands, branches=None, tolerant_branches=()):
+    branches = ['main'] * len(commands) if branches is None else branches
+    return workflow_steps_from(commands_list=commands,
+                               echo_list=[''] * len(commands),
+                               branch_list=branches,
+                               branch_dependencies={},
+                               tolerant_branches=tolerant_branches)
+
+
+def test_failed_piped_step_has_no_done_marker(tmp_path):
+    runner = runner_from(tmp_path)
+    steps = steps_from(['( false ) 2>&1 | tee /dev/null', 'true'])
+    assert runner.run(steps) == 1
+    assert runner.failed_steps == {0}
+    assert not os.path.exists(runner.marker_prefix_of(steps[0]) + DONE_SUFFIX)
+    assert not os.path.exists(runner.marker_prefix_of(steps[1]) + DONE_SUFFIX)
+
+
+def test_succeeded_piped_step_has_done_marker(tmp_path):
+    runner = runner_from(tmp_path)
+    steps = steps_from(['( true ) 2>&1 | tee /dev/null'])
+    assert runner.run(steps) is None
+    assert os.path.exists(runner.marker_prefix_of(steps[0]) + DONE_SUFFIX)
+
+
+def test_failed_piped_job_of_tolerant_branch_is_hidden(tmp_path):
+    runner = runner_from(tmp_path)
+    steps = steps_from(['( false ) 2>&1 | tee /dev/null', '( false ) 2>&1 | tee /dev/null && false'],
+                       branches=['germline', 'germline'], tolerant_branches=['germline'])
+    # the last command of the step still fails it
+    assert runner.run(steps) == 2
+    assert runner.failed_steps == {1}
+    assert os.path.exists(runner.marker_prefix_of(steps[0]) + DONE_SUFFIX)
+
+
+def test_keep_going_runs_independent_steps(tmp_path):
+    runner = runner_from(tmp_path, keep_going=True, max_concurrent_steps=2)
+    output_fn = str(tmp_path / 'b.txt')
+    steps = steps_from(['( false ) 2>&1 | tee /dev/null', 'true', 'echo b > ' + output_fn],
+                       branches=['a', 'a', 'b'])
+    assert runner.run(steps) == 1
+    assert runner.failed_steps == {0}
+    assert runner.blocked_steps == {1}
+    assert os.path.exists(output_fn)
+
+
+def runs_of(runs_fn):
+    with open(runs_fn) as f:
+        return len(f.readlines())
+
+
+def test_resume_skips_done_step_and_reruns_missing_output(tmp_path):
+    runs_fn, output_fn = str(tmp_path / 'runs.txt'), str(tmp_path / 'a.txt')
+    steps = steps_from(['echo run >> {} && echo a > {}'.format(runs_fn, output_fn)])
+    assert runner_from(tmp_path, resume=True).run(steps) is None
+    assert runner_from(tmp_path, resume=True).run(steps) is None
+    assert runs_of(runs_fn) == 1
+
+    os.remove(output_fn)
+    assert runner_from(tmp_path, resume=True).run(steps) is None
+    assert runs_of(runs_fn) == 2
+    assert os.path.exists(output_fn)
+
+
+def test_resume_reruns_step_after_its_dependency(tmp_path):
+    runs_fn, a_fn, b_fn = str(tmp_path / 'runs.txt'), str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')
+    steps = steps_from(['echo a > {}'.format(a_fn),
+                        'echo run >> {} && cat {} > {}'.format(runs_fn, a_fn, b_fn)])
+    assert runner_from(tmp_path, resume=True).run(steps) is None
+    with open(a_fn, 'w') as f:
+        f.write('changed\n')
+    runner = runner_from(tmp_path, resume=True)
+    assert runner.run(steps) is None
+    assert runner.ran_steps == {0, 1}
+    assert runs_of(runs_fn) == 2
+
+
+JOBLOG_HEADER = 'Seq\tHost\tStarttime\tJobRuntime\tSend\tReceive\tExitval\tSignal\tCommand\n'
+
+
+def write_joblog(joblog_fn, jobs):
+    with open(joblog_fn, 'w') as f:
+        f.write(JOBLOG_HEADER)
+        for seq, end_time, exit_value, command in jobs:
+            f.write('{}\t:\t{:.3f}\t{:.3f}\t0\t0\t{}\t0\t{}\n'.format(seq, end_time - 1, 1.0, exit_value, command))
+
+
+def seqs_of(joblog_fn):
+    with open(joblog_fn) as f:
+        return [row.split('\t')[0] for row in f.readlines()[1:]]
+
+
+def test_prune_stale_jobs_keeps_current_chunks(tmp_path):
+    (tmp_path / 'logs').mkdir()
+    joblog_fn = str(tmp_path / 'logs' / 'parallel.log')
+    chunk_fns = [str(tmp_path / 'chunk_{}.vcf'.format(idx)) for idx in range(4)]
+    for fn in chunk_fns:
+        with open(fn, 'w') as f:
+            f.write('chunk\n')
+    step = steps_from(['parallel --joblog {} -j 2 predict --call_fn {}/chunk_{{1}}.vcf ::: 0 1 2 3'.format(
+        joblog_fn, tmp_path)])[0]
+    end_time = max(os.stat(fn).st_mtime for fn in chunk_fns)
+    write_joblog(joblog_fn, [(str(idx + 1), end_time, 1 if idx == 3 else 0, 'predict --call_fn ' + fn)
+                             for idx, fn in enumerate(chunk_fns)])
+
+    runner = runner_from(tmp_path, resume=True)
+    runner.write_outputs(step, 'fingerprint')
+    outputs = runner.outputs_of(step, 'fingerprint')
+    assert sorted(outputs['jobs'][joblog_fn]) == ['1', '2', '3']
+
+    os.remove(chunk_fns[0])
+    with open(chunk_fns[1], 'a') as f:
+        f.write('changed\n')
+    # chunk 0 is removed, chunk 1 is changed and chunk 3 failed
+    assert runner.prune_stale_jobs(step, outputs) == 3
+    assert seqs_of(joblog_fn) == ['3', '4']
+
+
+def test_prune_stale_jobs_of_interrupted_step(tmp_path):
+    (tmp_path / 'logs').mkdir()
+    joblog_fn = str(tmp_path / 'logs' / 'parallel.log')
+    chunk_fns = [str(tmp_path / 'chunk_{}.vcf'.format(idx)) for idx in range(2)]
+    for fn in chunk_fns:
+        with open(fn, 'w') as f:
+            f.write('chunk\n')
+    step = steps_from(['parallel --joblog {} predict --call_fn {}/chunk_{{1}}.vcf ::: 0 1'.format(
+        joblog_fn, tmp_path)])[0]
+    end_time = max(os.stat(fn).st_mtime for fn in chunk_fns)
+    write_joblog(joblog_fn, [('1', end_time, 0, 'predict --call_fn ' + chunk_fns[0]),
+                             ('2', end_time, 0, 'predict --call_fn ' + chunk_fns[1])])
+    # chunk 1 was rewritten after its job ended
+    os.utime(chunk_fns[1], (end_time + 60, end_time + 60))
+
+    assert runner_from(tmp_path, resume=True).prune_stale_jobs(step, None) == 1
+    assert seqs_of(joblog_fn) == ['1']
+
+
+def test_resume_skips_done_parallel_step(tmp_path):
+    (tmp_path / 'logs').mkdir()
+    joblog_fn = str(tmp_path / 'logs' / 'parallel.log')
+    chunk_fn = str(tmp_path / 'chunk_0.vcf')
+    with open(chunk_fn, 'w') as f:
+        f.write('chunk\n')
+    step = steps_from(['parallel --joblog {} predict --call_fn {}/chunk_{{1}}.vcf ::: 0'.format(
+        joblog_fn, tmp_path)])[0]
+    write_joblog(joblog_fn, [('1', os.stat(chunk_fn).st_mtime, 0, 'predict --call_fn ' + chunk_fn)])
+    runner = runner_from(tmp_path, resume=True)
+    runner.write_outputs(step, 'fingerprint')
+    runner.write_marker(runner.marker_prefix_of(step) + DONE_SUFFIX, 'fingerprint')
+    assert runner.command_to_run(step, 'fingerprint') is None
+
+    os.remove(chunk_fn)
+    command = runner.command_to_run(step, 'fingerprint')
+    assert ' --resume-failed --joblog ' in command
+    assert seqs_of(joblog_fn) == []